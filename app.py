@@ -84,6 +84,11 @@ genefab3_client = GeneFabClient(
             # cycles, set this value to whatever you like
         full_update_retry_delay=600, # seconds before retrying the full update
             # cycle if the cold storage server was unreachable
+        warmup_top_n=32, # after responses have been invalidated, this many
+            # most requested ones are replayed in the background to be cached
+            # again before users request them; set to 0 to disable
+        warmup_budget=600, # seconds after which replaying stops
+        warmup_interval=1, # seconds between replayed requests
     ),
     flask_params=dict(
         app=flask_app,
@@ -1,15 +1,25 @@
 from functools import lru_cache, partial
 from flask import request
-from urllib.request import quote, unquote
+from urllib.request import unquote
 from json import dumps
+from hashlib import sha256
 from genefab3.common.utils import EmptyIterator, BranchTracer
 from genefab3.common.exceptions import is_debug, GeneFabParserException
 from genefab3.common.utils import make_safe_token, space_quote, is_regex
 from genefab3.common.exceptions import GeneFabConfigurationException
-from re import search
+from re import search, sub
 
 
-CONTEXT_ARGUMENTS = {"debug": "0", "format": None, "schema": "0"}
+MAX_DATA_ROWS = 900 # keeps SQLite query under 999 placeholders
+BROWSER_DATA_PAGE_SIZE = 1000 # rows per page fetched by browser view of /data/
+WARMUP_ENVIRON_KEY = "genefab3.warmup" # marks requests replayed to warm cache
+
+CONTEXT_ARGUMENTS = {
+    "debug": "0", "format": None, "schema": "0", "limit": None, "cursor": None,
+    "aggregate": None, "per": None, "sort": None, "order": None,
+}
+
+COMMUTATIVE_QUERY_OPERATORS = {"$and", "$or", "$in", "$nin", "$all"}
 
 KEYVALUE_PARSER_DISPATCHER = lru_cache(maxsize=1)(lambda: {
     "id": partial(KeyValueParsers.kvp_assay,
@@ -33,6 +43,7 @@ KEYVALUE_PARSER_DISPATCHER = lru_cache(maxsize=1)(lambda: {
     ),
     "column": partial(KeyValueParsers.kvp_column, category="column"),
     "c": partial(KeyValueParsers.kvp_column, category="column"),
+    "row": partial(KeyValueParsers.kvp_row, category="row"),
 })
 
 
@@ -45,28 +56,58 @@ class Context():
         self.complete_kwargs = request.args.to_dict(flat=False)
         self.url_root = request.url_root.rstrip("/")
         self.view, self.full_path = request.path.strip("/"), request.full_path
+        self.method = request.method
+        self.is_warmup = bool(request.environ.get(WARMUP_ENVIRON_KEY))
+        self.accept_encodings = [
+            encoding for encoding, q in request.accept_encodings if q > 0
+        ]
         self.query, self.unwind = {"$and": []}, set()
         self.projection = {"id.accession": True, "id.assay name": True}
         self.sort_by = ["id.accession", "id.assay name"]
         self.data_columns, self.data_comparisons = [], []
+        self.data_rows = []
         self.processed_args = {
             arg for arg, values in request.args.lists()
             if self.update(arg, values, auto_reduce=False)
         }
+        if request.method == "POST":
+            self.update_rows_from_body()
         self.update_special_fields()
         self.reduce_projection()
         self.update_attributes()
+        self.update_browser_paging()
         if not self.query["$and"]:
             self.query = {}
-        self.identity = quote(dumps(sort_keys=True, separators=(",", ":"), obj={
-            "?": self.view, "query": self.query, "sort_by": self.sort_by,
-            "unwind": sorted(self.unwind), "projection": self.projection,
-            "data_columns": self.data_columns,
-            "data_comparisons": self.data_comparisons,
-            "format": self.format, "schema": self.schema, "debug": self.debug,
-        }))
+        self.canonical_identity = self.make_canonical_identity()
+        self.identity = sha256(self.canonical_identity.encode()).hexdigest()
         if self.debug != "0" and (not is_debug()):
             raise GeneFabParserException("Setting 'debug' is not allowed")
+        if (self.limit or self.cursor) and (self.view != "data"):
+            raise GeneFabParserException("Paging is only valid for /data/")
+        if (self.aggregate or self.per) and (self.view != "data"):
+            msg = "Aggregation is only valid for /data/"
+            raise GeneFabParserException(msg)
+        if (self.sort or self.order) and (self.view != "data"):
+            raise GeneFabParserException("Sorting is only valid for /data/")
+ 
+    def make_canonical_identity(self):
+        """Serialize parsed request so that equivalent requests are represented identically: commutative query clauses and values, data comparisons and rows (but not columns, which define output order) are sorted (rows by their JSON representation, which orders values of any type) and deduplicated, defaults of `order` and `per` are made explicit"""
+        return canonical_dumps({
+            "?": self.view, "query": canonicalize_query(self.query),
+            "sort_by": self.sort_by, "unwind": sorted(self.unwind),
+            "projection": self.projection, "data_columns": self.data_columns,
+            "data_comparisons": sorted({
+                sub(r'^(`[^`]*`) = ', r'\1 == ', dc)
+                for dc in self.data_comparisons
+            }),
+            "data_rows": sorted(set(self.data_rows), key=canonical_dumps),
+            "format": self.format, "schema": self.schema, "debug": self.debug,
+            "limit": self.limit, "cursor": self.cursor,
+            "aggregate": self.aggregate,
+            "per": (self.per or "column") if self.aggregate else self.per,
+            "sort": self.sort,
+            "order": (self.order or "asc") if self.sort else self.order,
+        })
  
     def update(self, arg, values=("",), auto_reduce=True):
         """Interpret key-value pair; return False/None if not interpretable, else return True and update queries, projections"""
@@ -84,26 +125,56 @@ class Context():
             for value in map(_make_safe_token, values):
                 yield from parser(arg=arg, fields=fields, value=value)
         n_iter, _en_it = None, enumerate(_it(), 1)
-        for n_iter, (query, projection_keys, columns, comparisons) in _en_it:
+        for n_iter, (query, projection_keys, columns, comparisons, rows) in _en_it:
             self.projection.update({k: True for k in projection_keys})
             if query:
                 if "$and" not in self.query:
                     self.query["$and"] = []
                 self.query["$and"].append(query)
-            if columns or comparisons:
+            if columns or comparisons or rows:
                 if self.view == "data":
                     _already_present = set(self.data_columns)
                     for column in columns:
                         if column not in _already_present:
                             self.data_columns.extend(columns)
                     self.data_comparisons.extend(comparisons)
+                    self.extend_data_rows(rows)
                 else:
-                    msg = "Column queries are only valid for /data/"
+                    msg = "Column and row queries are only valid for /data/"
                     raise GeneFabParserException(msg)
         if auto_reduce:
             self.reduce_projection()
         return n_iter
  
+    def extend_data_rows(self, rows):
+        """Add requested index values (row names) to self.data_rows, skipping duplicates"""
+        _already_present = set(self.data_rows)
+        for row in rows:
+            if row not in _already_present:
+                self.data_rows.append(row)
+                _already_present.add(row)
+        if len(self.data_rows) > MAX_DATA_ROWS:
+            msg = "Too many rows requested"
+            sug = f"Limit request to {MAX_DATA_ROWS} rows"
+            raise GeneFabParserException(msg, suggestion=sug)
+ 
+    def update_rows_from_body(self):
+        """Interpret body of POST request as list of index values (row names): either a JSON list of strings (as row names passed with GET are) or newline- or pipe-separated text"""
+        if self.view != "data":
+            msg = "POST requests are only valid for /data/"
+            raise GeneFabParserException(msg)
+        elif request.is_json:
+            rows = request.get_json(silent=True)
+            if not (isinstance(rows, list) and all(
+                isinstance(row, str) for row in rows
+            )):
+                msg = "Request body must be a JSON list of row names as strings"
+                raise GeneFabParserException(msg)
+        else:
+            body = request.get_data(as_text=True)
+            rows = [r.strip() for r in body.replace("|", "\n").split("\n")]
+        self.extend_data_rows([r for r in rows if r != ""])
+ 
     def update_special_fields(self):
         """Automatically adjust projection and unwind pipeline for special fields ('file')"""
         if set(self.projection) & {"file", "file.datatype", "file.filename"}:
@@ -132,6 +203,35 @@ class Context():
                     raise GeneFabConfigurationException(msg, **{k: safe_v})
         for k, v in CONTEXT_ARGUMENTS.items():
             setattr(self, k, getattr(self, k, v))
+ 
+    def update_browser_paging(self):
+        """Page /data/ in browser format by default, so that only the first page is embedded, and further pages are fetched as table is scrolled; unless paging is already requested or is not valid for request"""
+        if (self.view == "data") and (self.format == "browser"):
+            if (self.limit is None) and (self.schema != "1"):
+                if (self.aggregate is None) or (self.per == "row"):
+                    self.limit = str(BROWSER_DATA_PAGE_SIZE)
+
+
+canonical_dumps = partial(dumps, sort_keys=True, separators=(",", ":"))
+
+
+def canonicalize_query(query):
+    """Recursively sort and deduplicate clauses and values of commutative operators in MongoDB query"""
+    if isinstance(query, dict):
+        return {
+            k: (
+                [v for _, v in sorted({
+                    canonical_dumps(v): v for v in map(canonicalize_query, vv)
+                }.items())]
+                if (k in COMMUTATIVE_QUERY_OPERATORS) and isinstance(vv, list)
+                else canonicalize_query(vv)
+            )
+            for k, vv in query.items()
+        }
+    elif isinstance(query, list):
+        return [canonicalize_query(v) for v in query]
+    else:
+        return query
 
 
 class KeyValueParsers():
@@ -147,7 +247,7 @@ class KeyValueParsers():
                         expr.split(mix_separator, 2),
                     )
                 })
-            yield query, projection_keys, None, None
+            yield query, projection_keys, None, None, None
         else: # standard syntax: 'id', 'id.accession', 'id.assay name=name', ...
             yield from KeyValueParsers.kvp_generic(
                 arg=arg, fields_depth=fields_depth, constrain_to=constrain_to,
@@ -191,7 +291,7 @@ class KeyValueParsers():
                 _pfx = "." if (block_match.group()[-1] == ".") else ""
                 lookup_keys = {k+_pfx for k in projection_keys}
                 query = {"$or": [{k: {"$exists": True}} for k in lookup_keys]}
-        yield query, projection_keys, None, None
+        yield query, projection_keys, None, None, None
  
     def kvp_column(arg, category, fields, value):
         """Interpret data table constraint"""
@@ -202,7 +302,7 @@ class KeyValueParsers():
             expr = f"{'.'.join(fields)}={value}" if value else ".".join(fields)
             unq_expr = unquote(expr)
         if not ({"<", "=", ">"} & set(unq_expr)):
-            yield None, (), [expr], ()
+            yield None, (), [expr], (), ()
         else:
             match = search(r'^([^<>=]+)(<|<=|=|==|>=|>)([^<>=]*)$', unq_expr)
             if match:
@@ -213,7 +313,20 @@ class KeyValueParsers():
                     msg = "Only comparisons to numbers are currently supported"
                     raise GeneFabParserException(msg, **{arg: value})
                 else:
-                    yield None, (), (), [f"`{space_quote(name)}` {op} {value}"]
+                    comparison = f"`{space_quote(name)}` {op} {value}"
+                    yield None, (), (), [comparison], ()
             else:
                 msg = "Unparseable expression"
                 raise GeneFabParserException(msg, expression=expr)
+ 
+    def kvp_row(arg, category, fields, value):
+        """Interpret data table row selection by index values ('row=ENSG1|ENSG2')"""
+        if fields:
+            msg = "Row selection does not accept subfields"
+            raise GeneFabParserException(msg, **{arg: value})
+        elif not value:
+            msg = "Row selection requires values"
+            raise GeneFabParserException(msg, **{arg: value})
+        else:
+            rows = [r for r in unquote(value).split("|") if r != ""]
+            yield None, (), (), (), rows
@@ -1,9 +1,11 @@
 from collections import OrderedDict
-from flask import Response
+from flask import Response, request
 from genefab3.common.types import StreamedAnnotationTable, StreamedDataTable
 from genefab3.common.types import StreamedSchema
 from genefab3.api.renderers import PlaintextStreamedTableRenderers
 from genefab3.api.renderers import BrowserStreamedTableRenderers
+from genefab3.api.renderers import BinaryStreamedTableRenderers
+from genefab3.api.renderers.BrowserStreamedTableRenderers import build_url
 from genefab3.api.renderers import SimpleRenderers
 from genefab3.common.types import StringIterator
 from genefab3.common.exceptions import GeneFabFormatException
@@ -11,9 +13,13 @@ from genefab3.common.exceptions import GeneFabConfigurationException
 from genefab3.db.sql.response_cache import ResponseCache
 from genefab3.common.utils import ExceptionPropagatingThread
 from functools import wraps
-from genefab3.api.parser import Context
+from genefab3.api.parser import Context, canonical_dumps
 from copy import deepcopy
 from genefab3.common.types import ResponseContainer
+from genefab3.db.mongo.epochs import get_metadata_epochs
+from genefab3.db.mongo.epochs import get_constrained_accessions
+from hashlib import sha256
+from datetime import datetime, timezone
 
 
 TYPE_RENDERERS = OrderedDict((
@@ -33,6 +39,9 @@ TYPE_RENDERERS = OrderedDict((
         "tsv": PlaintextStreamedTableRenderers.tsv,
         "json": PlaintextStreamedTableRenderers.json,
         "browser": BrowserStreamedTableRenderers.html,
+        "arrow": BinaryStreamedTableRenderers.arrow,
+        "parquet": BinaryStreamedTableRenderers.parquet,
+        "npy": BinaryStreamedTableRenderers.npy,
     }),
     (StreamedSchema, {
         "csv": PlaintextStreamedTableRenderers.csv,
@@ -50,6 +59,9 @@ TYPE_RENDERERS = OrderedDict((
 ))
 
 
+UNCONDITIONAL_VIEWS = {"status"} # responses change regardless of (meta)data
+
+
 class CacheableRenderer():
     """Renders objects returned by routes, and keeps them in LRU cache by `context.identity`"""
  
@@ -76,8 +88,60 @@ class CacheableRenderer():
             msg = "Route returned unsupported object"
             raise GeneFabConfigurationException(msg, type=type(obj).__name__)
  
+    def make_headers(self, obj, context):
+        """Make extra response headers for `obj`: link to next page, if `obj` is a page of paged data"""
+        next_cursor = getattr(obj, "next_cursor", None)
+        if next_cursor is None:
+            return {}
+        else:
+            url = build_url(context, drop={"cursor"}) + f"cursor={next_cursor}"
+            return {"Link": f'<{url}>; rel="next"'}
+ 
+    def make_validators(self, context):
+        """Make weak ETag and Last-Modified for response to `context` from its identity, app version, and metadata epochs of accessions it is constrained to (or global metadata epoch); None if response must not be conditional"""
+        if (context.view in UNCONDITIONAL_VIEWS) or (request.method != "GET"):
+            return None
+        epochs = get_metadata_epochs(
+            self.genefab3_client.mongo_collections.records,
+            get_constrained_accessions(context.query),
+        )
+        etag = sha256(canonical_dumps([
+            context.identity, self.genefab3_client.app_version,
+            sorted(epochs.items(), key=lambda kv: str(kv[0])),
+        ]).encode()).hexdigest()
+        last_modified = max(epochs.values(), default=0) or None
+        if last_modified is not None:
+            last_modified = datetime.fromtimestamp(last_modified, timezone.utc)
+        return etag, last_modified
+ 
+    def make_not_modified_response(self, validators):
+        """If request is conditional and `validators` match, return 304 Not Modified response (If-Modified-Since is only considered in absence of If-None-Match); otherwise, return None"""
+        etag, last_modified = validators
+        if request.if_none_match:
+            not_modified = request.if_none_match.contains_weak(etag)
+        elif request.if_modified_since and last_modified:
+            since = request.if_modified_since
+            if since.tzinfo is None: # depends on version of werkzeug
+                since = since.replace(tzinfo=timezone.utc)
+            not_modified = (last_modified <= since)
+        else:
+            not_modified = False
+        if not_modified:
+            return self.apply_validators(Response(status=304), validators)
+        else:
+            return None
+ 
+    def apply_validators(self, response, validators):
+        """Set ETag and Last-Modified headers of successful or 304 `response`"""
+        etag, last_modified = validators
+        if response.status_code in {200, 304}:
+            response.set_etag(etag, weak=True)
+            if last_modified is not None:
+                response.last_modified = last_modified
+        return response
+ 
     def _get_response_container_via_cache(self, context, method, args, kwargs):
-        """Render object returned from `method`, put in LRU cache by `context.identity`"""
+        """Render object returned from `method`, put in LRU cache by `context.identity` as it is streamed to client"""
         response_cache = ResponseCache(self.genefab3_client.sqlite_dbs)
         response_container = response_cache.get(context)
         if response_container.empty:
@@ -93,7 +157,8 @@ class CacheableRenderer():
                 content, mimetype = self.dispatch_renderer(
                     obj, context=context, default_format=default_format,
                 )
-                response_container.update(content, mimetype, obj)
+                headers = self.make_headers(obj, context=context)
+                response_container.update(content, mimetype, obj, headers)
                 if getattr(obj, "cacheable", None) is True:
                     if response_cache is not None:
                         response_cache.put(response_container, context)
@@ -107,6 +172,7 @@ class CacheableRenderer():
         @wraps(method)
         def wrapper(*args, **kwargs):
             context = Context(self.genefab3_client.flask_app)
+            validators = None
             try:
                 if context.debug == "1":
                     obj, context.format = deepcopy(context.__dict__), "json"
@@ -117,11 +183,21 @@ class CacheableRenderer():
                         content, mimetype, obj,
                     )
                 else:
+                    validators = self.make_validators(context)
+                    if validators is not None:
+                        response = self.make_not_modified_response(validators)
+                        if response is not None:
+                            return response
                     response_container = self._get_response_container_via_cache(
                         context, method, args, kwargs,
                     )
             finally:
                 if not self.genefab3_client.metadata_cacher_thread.isAlive():
                     self.genefab3_client.mongo_client.close()
-            return response_container.make_response()
+            if validators is None:
+                return response_container.make_response()
+            else:
+                return self.apply_validators(
+                    response_container.make_response(), validators,
+                )
         return wrapper
@@ -0,0 +1,138 @@
+from io import BytesIO
+from copy import copy
+from numpy import array as nparray
+from numpy.lib.format import write_array_header_1_0
+from genefab3.common.types import StreamedDataTable
+from genefab3.common.exceptions import GeneFabFormatException
+from genefab3.common.exceptions import GeneFabConfigurationException
+try:
+    import pyarrow
+    from pyarrow import ArrowException
+    from pyarrow.ipc import new_stream as new_arrow_stream
+    from pyarrow.parquet import ParquetWriter
+except ImportError: # optional dependency for arrow and parquet formats
+    pyarrow, ArrowException = None, Exception
+
+
+class DrainableSink():
+    """Writable file-like object that accumulates bytes written by pyarrow writers until they are taken out with `drain()`"""
+    closed = False
+    def __init__(self): self._chunks = []
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+    def flush(self): pass
+    def drain(self):
+        data, self._chunks = b"".join(self._chunks), []
+        return data
+
+
+def _validate_streamed_data_table(obj, fmt, needs_pyarrow):
+    """Check if `obj` is a StreamedDataTable and if dependencies of format `fmt` are present"""
+    if not isinstance(obj, StreamedDataTable):
+        msg = "Format is only valid for tabular data"
+        raise GeneFabFormatException(msg, type=type(obj).__name__, format=fmt)
+    elif needs_pyarrow and (pyarrow is None):
+        msg = "Format is not supported by this server (pyarrow not installed)"
+        raise GeneFabConfigurationException(msg, format=fmt)
+
+
+def _copy_for_streaming(obj, n_index_levels):
+    """Make shallow copy of `obj` with missing values as None and index boundary moved to `n_index_levels`, leaving `obj` itself unchanged"""
+    table = copy(obj)
+    table.na_rep = None
+    table.move_index_boundary(to=n_index_levels)
+    return table
+
+
+def _infer_arrow_schema(obj, fmt):
+    """Infer Arrow schema of `obj` with its index as leading column(s) from storage classes of values over all rows (before anything is streamed): integers as int64, reals (also mixed with integers) and all-NULL columns as float64, text as string, blobs as binary"""
+    arrow_types = {
+        frozenset(): pyarrow.float64(),
+        frozenset({"integer"}): pyarrow.int64(),
+        frozenset({"real"}): pyarrow.float64(),
+        frozenset({"integer", "real"}): pyarrow.float64(),
+        frozenset({"text"}): pyarrow.string(),
+        frozenset({"blob"}): pyarrow.binary(),
+    }
+    table = _copy_for_streaming(obj, n_index_levels=0)
+    columns = list(table.columns)
+    names = [
+        *(c[-1] for c in columns[:obj.n_index_levels]),
+        *("/".join(c) for c in columns[obj.n_index_levels:]),
+    ]
+    fields = []
+    for name, classes in zip(names, table.get_storage_classes()):
+        if frozenset(classes) in arrow_types:
+            fields.append((name, arrow_types[frozenset(classes)]))
+        else:
+            msg = "Columns have values of inconsistent types"
+            raise GeneFabFormatException(msg, format=fmt, column=name)
+    return table, pyarrow.schema(fields)
+
+
+def _iter_record_batches(table, schema, fmt):
+    """Yield record batches built from blocks of rows of `table` as fetched from database, with column types of `schema`"""
+    try:
+        for block in table.value_blocks:
+            yield pyarrow.RecordBatch.from_arrays([
+                pyarrow.array(column, type=t)
+                for column, t in zip(zip(*block), schema.types)
+            ], schema=schema)
+    except (ArrowException, TypeError, ValueError):
+        msg = "Columns have values of inconsistent types"
+        raise GeneFabFormatException(msg, format=fmt)
+
+
+def _make_arrow_writer_content(obj, fmt, make_writer):
+    """Infer schema of `obj` before streaming starts, make function that writes record batches of `obj` with writer returned by `make_writer(sink, schema)` and yields bytes as they are written"""
+    table, schema = _infer_arrow_schema(obj, fmt)
+    def content():
+        sink = DrainableSink()
+        writer = make_writer(sink, schema)
+        for batch in _iter_record_batches(table, schema, fmt):
+            writer.write_batch(batch)
+            yield sink.drain()
+        writer.close()
+        yield sink.drain()
+    return content
+
+
+def arrow(obj, context=None, indent=None):
+    """Display StreamedDataTable in Arrow IPC streaming format"""
+    _validate_streamed_data_table(obj, "arrow", needs_pyarrow=True)
+    content = _make_arrow_writer_content(obj, "arrow", new_arrow_stream)
+    return content, "application/vnd.apache.arrow.stream"
+
+
+def parquet(obj, context=None, indent=None):
+    """Display StreamedDataTable in Parquet format, one row group per block of rows"""
+    _validate_streamed_data_table(obj, "parquet", needs_pyarrow=True)
+    content = _make_arrow_writer_content(obj, "parquet", ParquetWriter)
+    return content, "application/vnd.apache.parquet"
+
+
+def npy(obj, context=None, indent=None):
+    """Display values of StreamedDataTable (without index and column names) as NumPy float64 array; missing values become NaN"""
+    _validate_streamed_data_table(obj, "npy", needs_pyarrow=False)
+    table = _copy_for_streaming(obj, n_index_levels=1)
+    numeric = {"integer", "real"}
+    if not all(c <= numeric for c in table.get_storage_classes()[1:]):
+        msg = "NPY format is only valid for numeric data"
+        raise GeneFabFormatException(msg, format="npy")
+    def content():
+        shape, n_rows = table.shape, 0
+        with BytesIO() as handle:
+            write_array_header_1_0(handle, {
+                "descr": "<f8", "fortran_order": False, "shape": shape,
+            })
+            yield handle.getvalue()
+        for block in table.value_blocks:
+            # explicit number of rows, as -1 is ambiguous with zero columns:
+            array = nparray(block, dtype="<f8").reshape(len(block), shape[1])
+            n_rows += array.shape[0]
+            yield array.tobytes()
+        if n_rows != shape[0]:
+            msg = "Number of rows changed while streaming"
+            raise GeneFabFormatException(msg, format="npy", shape=shape)
+    return content, "application/octet-stream"
@@ -1,9 +1,11 @@
 from genefab3.common.utils import space_quote, repr_quote
 from re import compile, escape
 from pathlib import Path
+from json import dumps
 from genefab3.common.exceptions import GeneFabLogger
 from genefab3.common.types import StreamedAnnotationTable
 from genefab3.api.renderers.PlaintextStreamedTableRenderers import _iter_json_chunks
+from genefab3.api.renderers.PlaintextStreamedTableRenderers import _iter_json_blocks
 from genefab3.common.exceptions import GeneFabConfigurationException
 
 
@@ -82,6 +84,27 @@ def get_view_dependent_links(obj, context):
         return ""
 
 
+def get_paging(obj, context, n_index_levels):
+    """Get JSON description of server-side paging for SlickGrid (URL of next page in JSON format, URL and column keys for server-side sorting), or null if table is not paged or has no more rows"""
+    next_cursor = getattr(obj, "next_cursor", None)
+    if next_cursor is None:
+        return "null"
+    else:
+        next_url = build_url(context, drop={"format", "limit", "cursor"}) + (
+            f"format=json&limit={context.limit}&cursor={next_cursor}"
+        )
+        sort_keys = [
+            None if (i < n_index_levels) else "/".join(c)
+            for i, c in enumerate(obj.columns)
+        ]
+        return dumps({
+            "next": next_url, "sort": context.sort,
+            "order": context.order or "asc",
+            "sort_url": build_url(context, drop={"sort", "order", "cursor"}),
+            "sort_keys": sort_keys,
+        })
+
+
 def _iter_html_chunks(template_file, replacements):
     """Return list of lines of HTML template and subsitute variables with generated data"""
     pattern = compile(r'|'.join(map(escape, replacements.keys())))
@@ -110,6 +133,7 @@ SQUASHED_PREHEADER_CSS = """
 def twolevel(obj, context, squash_preheader=False, frozen=0, indent=None):
     """Display StreamedTable with two-level columns using SlickGrid"""
     GeneFabLogger.info("HTML: converting StreamedTable into interactive table")
+    n_index_levels = getattr(obj, "n_index_levels", 0)
     obj.move_index_boundary(to=0)
     title_postfix = repr_quote(f"{context.view} {context.complete_kwargs}")
     def content():
@@ -134,8 +158,9 @@ def twolevel(obj, context, squash_preheader=False, frozen=0, indent=None):
             "$ASSAYSVIEW": build_url(context, "assays"),
             "$SAMPLESVIEW": build_url(context, "samples"),
             "$DATAVIEW": build_url(context, "data"),
-            "$COLUMNDATA": _iter_json_chunks(data=columns, length=obj.shape[1]),
-            "$ROWDATA": _iter_json_chunks(data=obj.values, length=obj.shape[0]),
+            "$COLUMNDATA": _iter_json_chunks(data=columns),
+            "$ROWDATA": _iter_json_blocks(blocks=obj.value_blocks),
+            "$PAGING": iter([get_paging(obj, context, n_index_levels)]),
             "$CONTEXTURL": build_url(context),
             "$FORMATTERS": "\n".join(formatters),
             "$FROZENCOLUMN": "undefined" if frozen is None else str(frozen),
@@ -3,47 +3,97 @@ from json import dumps
 from io import StringIO
 from csv import writer as CSVWriter
 from re import sub
+from itertools import islice
+from functools import partial
+from operator import is_not
+from math import isfinite
 from genefab3.common.exceptions import GeneFabFormatException
 from genefab3.common.utils import as_is
 from genefab3.common.types import StreamedDataTable
 from genefab3.common.exceptions import GeneFabConfigurationException
+try:
+    from orjson import dumps as orjson_dumps, JSONEncodeError
+except ImportError: # optional fast native encoder
+    orjson_dumps, JSONEncodeError = None, TypeError
 
 
-def _list_continuous_cls(obj, target, target_name):
-    """Iterate over entire `obj` before returning CLS-formatted data; fails if cannot be represented as continuous"""
+def _list_continuous_cls(targets, target_name):
+    """Return CLS-formatted data from list of all `targets`; fails if cannot be represented as continuous"""
     return [
         "#numeric\n", f"#{target_name}\n",
-        "\t".join(str(float(row[target])) for row in obj.values),
+        "\t".join(str(float(v)) for v in targets),
     ]
 
 
-def _iter_discrete_cls(obj, target, space_formatter):
-    """Iterate lines one by one as discrete CLS-formatted data"""
+def _iter_discrete_cls(targets, space_formatter):
+    """Iterate lines one by one as discrete CLS-formatted data from list of all `targets`"""
     classes, _classes_set = [], set()
-    for row in obj.values:
-        v = row[target]
+    for v in targets:
         if v not in _classes_set:
             classes.append(v)
             _classes_set.add(v)
     class2id = {c: str(i) for i, c in enumerate(classes)}
-    yield f"{obj.shape[0]}\t{len(classes)}\t1\n# "
+    yield f"{len(targets)}\t{len(classes)}\t1\n# "
     yield "\t".join(space_formatter(c) for c in classes) + "\n"
-    yield "\t".join(class2id[row[target]] for row in obj.values) + "\n"
+    yield "\t".join(class2id[v] for v in targets) + "\n"
 
 
-def _iter_json_chunks(prefix="", data=None, length=None, postfix="", default=json_permissive_default):
-    """Iterate chunks in bracketed `delimiter`-separated format"""
-    def _foreach(chunks, end):
-        for chunk in chunks:
-            yield dumps(chunk, separators=(",", ":"), default=default) + end
+def _iter_json_chunks(prefix="", data=None, postfix="", default=json_permissive_default):
+    """Iterate chunks in bracketed comma-separated format; does not need to know length of `data` in advance"""
+    _dumps = lambda chunk: dumps(chunk, separators=(",", ":"), default=default)
     leveliter = iter(data)
-    chunks = (next(leveliter) for _ in range(length-1))
     yield f"{prefix}["
+    for chunk in leveliter:
+        yield _dumps(chunk)
+        break
+    for chunk in leveliter:
+        yield "," + _dumps(chunk)
+    yield f"]{postfix}"
+
+
+def _dumps_json_block(block, default=json_permissive_default):
+    """Serialize block of rows at once, as comma-separated JSON arrays"""
+    return dumps(block, separators=(",", ":"), default=default)[1:-1]
+
+
+def _orjson_block_is_native(block, native_types=frozenset({int, float, bool, str, type(None)}), _is_not_none=partial(is_not, None)):
+    """Test if orjson would serialize block of rows to the same values as `_dumps_json_block()`: only native types, no non-finite floats (that json.dumps writes as NaN/Infinity, but orjson as null), and no columns mixing floats with strings (where finiteness cannot be checked in bulk)"""
+    for column in zip(*block):
+        types = set(map(type, column))
+        if not native_types.issuperset(types):
+            return False
+        elif float in types:
+            if str in types:
+                return False
+            elif not isfinite(sum(filter(_is_not_none, column))):
+                return False
+    return True
+
+
+def _orjson_dumps_json_block(block, default=json_permissive_default):
+    """Serialize block of rows at once with orjson if it is safe to do so (see `_orjson_block_is_native()`), otherwise with `_dumps_json_block()`"""
     try:
-        yield from _foreach(chunks, end=",")
-        yield from _foreach([next(leveliter)], end="")
-    except StopIteration:
+        if _orjson_block_is_native(block):
+            return orjson_dumps(block).decode()[1:-1]
+    except (JSONEncodeError, OverflowError): # e.g., integers over 64 bits
         pass
+    return _dumps_json_block(block, default=default)
+
+
+if orjson_dumps is None:
+    dumps_json_block = _dumps_json_block
+else:
+    dumps_json_block = _orjson_dumps_json_block
+
+
+def _iter_json_blocks(prefix="", blocks=(), postfix="", dumps_block=dumps_json_block):
+    """Iterate blocks of rows in bracketed comma-separated format, each block serialized with a single call to `dumps_block`"""
+    yield f"{prefix}["
+    separator = ""
+    for block in blocks:
+        if len(block):
+            yield separator + dumps_block(block)
+            separator = ","
     yield f"]{postfix}"
 
 
@@ -61,12 +111,50 @@ def _iter_xsv_chunks(chunks, prefix="", delimiter=",", quoting=2, lineterminator
             handle.truncate()
 
 
+def _iter_xsv_blocks(blocks, delimiter=",", quoting=2, lineterminator="\r\n", buffer_size=65536, numeric_types=frozenset({int, float})):
+    """Iterate blocks of rows in `delimiter`-separated format, yielding buffers of at least `buffer_size` characters (except the last one); trailing columns of only ints and floats are formatted in bulk by joining their string representations (which is what csv.writer does for numbers), leading columns with csv.writer (in QUOTE_NONNUMERIC mode, where fields are quoted independently of their neighbors)"""
+    lines, buffer, buffered = [], [], 0
+    sink = type("Sink", (), dict(write=staticmethod(lines.append)))()
+    _kw = dict(delimiter=delimiter, quoting=quoting)
+    writer = CSVWriter(sink, **_kw, lineterminator=lineterminator)
+    lead_writer = CSVWriter(sink, **_kw, lineterminator=delimiter)
+    for block in blocks:
+        is_numeric = [
+            numeric_types.issuperset(map(type, column))
+            for column in zip(*block)
+        ]
+        n_lead = len(is_numeric)
+        while n_lead and is_numeric[n_lead-1]:
+            n_lead -= 1
+        if n_lead == 0:
+            lines.extend([
+                delimiter.join(map(str, row)) + lineterminator
+                for row in block
+            ])
+        elif (n_lead == len(is_numeric)) or (quoting != 2):
+            writer.writerows(block)
+        else:
+            lead_writer.writerows([row[:n_lead] for row in block])
+            lines[:] = [
+                lead + delimiter.join(map(str, row[n_lead:])) + lineterminator
+                for lead, row in zip(lines, block)
+            ]
+        buffer.extend(lines)
+        buffered += sum(map(len, lines))
+        lines.clear()
+        if buffered >= buffer_size:
+            yield "".join(buffer)
+            buffer, buffered = [], 0
+    if buffer:
+        yield "".join(buffer)
+
+
 def _xsv(obj, delimiter):
     """Display StreamedTable in plaintext `delimiter`-separated format"""
     obj.move_index_boundary(to=0)
     def content():
         yield from _iter_xsv_chunks(obj.column_levels, "#", delimiter, 0)
-        yield from _iter_xsv_chunks(obj.values, "", delimiter, 2)
+        yield from _iter_xsv_blocks(obj.value_blocks, delimiter, 2)
     return content, "text/plain"
 
 
@@ -80,9 +168,10 @@ def cls(obj, context=None, continuous=None, space_formatter=lambda s: sub(r'\s',
         target_name = ".".join(obj.metadata_columns[0])
         target = obj._column_key_dispatcher[target_name]
     def content(continuous=continuous, space_formatter=space_formatter):
+        targets = [values[target] for _, values in obj.iter_rows()]
         if (continuous is None) or (continuous is True):
             try:
-                lines = _list_continuous_cls(obj, target, target_name)
+                lines = _list_continuous_cls(targets, target_name)
             except ValueError:
                 if continuous is True:
                     msg = "Cannot represent target annotation as continuous"
@@ -92,11 +181,22 @@ def cls(obj, context=None, continuous=None, space_formatter=lambda s: sub(r'\s',
                     continuous = False
         if continuous is False:
             space_formatter = space_formatter or as_is
-            lines = _iter_discrete_cls(obj, target, space_formatter)
+            lines = _iter_discrete_cls(targets, space_formatter)
         yield from lines
     return content, "text/plain"
 
 
+def _iter_gct_lines(rows):
+    """Iterate GCT body lines from pairs of index and values (e.g. from `StreamedDataTable.iter_rows()`): index as both Name and Description, then tab-separated values"""
+    with StringIO() as handle:
+        writer = CSVWriter(handle, delimiter="\t", quoting=0)
+        for (index, *_), values in rows:
+            writer.writerow(values)
+            handle.seek(0)
+            yield f"{index}\t{index}\t{handle.getvalue()}"
+            handle.truncate()
+
+
 def gct(obj, context=None, indent=None, level_formatter="/".join):
     """Display StreamedDataTable in plaintext GCT format, if supported"""
     if (not isinstance(obj, StreamedDataTable)) or (len(obj.datatypes) == 0):
@@ -116,9 +216,7 @@ def gct(obj, context=None, indent=None, level_formatter="/".join):
             for level in obj.columns:
                 yield "\t" + level_formatter(level)
             yield "\n"
-            _iter_value_lines = _iter_xsv_chunks(obj.values, "", "\t", 0)
-            for (index, *_), value_line in zip(obj.index, _iter_value_lines):
-                yield f"{index}\t{index}\t{value_line}"
+            yield from _iter_gct_lines(obj.iter_rows())
     return content, "text/plain"
 
 
@@ -132,13 +230,21 @@ def tsv(obj, context=None, indent=None):
     return _xsv(obj, delimiter="\t")
 
 
+def _iter_index_blocks(obj):
+    """Iterate index of `obj` in blocks (lists) of `obj.rows_per_block` rows"""
+    rows, n = iter(obj.index), obj.rows_per_block
+    block = list(islice(rows, n))
+    while block:
+        yield block
+        block = list(islice(rows, n))
+
+
 def json(obj, context=None, indent=None):
-    """Display StreamedTable as JSON"""
-    _iw, _h, _w = obj.n_index_levels, *obj.shape
+    """Display StreamedTable as JSON; index and data are each streamed in blocks, in their own pass over rows"""
     def content():
         yield '{"meta":{"index_names":'
-        yield from _iter_json_chunks('', obj.index_names, _iw, "},")
-        yield from _iter_json_chunks('"columns":', obj.columns, _w, ",")
-        yield from _iter_json_chunks('"index":', obj.index, _h, ",")
-        yield from _iter_json_chunks('"data":', obj.values, _h, "}")
+        yield from _iter_json_chunks('', obj.index_names, "},")
+        yield from _iter_json_chunks('"columns":', obj.columns, ",")
+        yield from _iter_json_blocks('"index":', _iter_index_blocks(obj), ",")
+        yield from _iter_json_blocks('"data":', obj.value_blocks, "}")
     return content, "application/json"
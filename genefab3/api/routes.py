@@ -72,7 +72,7 @@ class DefaultRoutes(Routes):
             locale=self.genefab3_client.locale, context=context,
         )
  
-    @Routes.register_endpoint()
+    @Routes.register_endpoint(methods=("GET", "POST"))
     def data(self, context):
         return views.data.get(
             mongo_collections=self.genefab3_client.mongo_collections,
@@ -173,11 +173,13 @@ def combine_objects(objects, context, limit=None):
             raise GeneFabFormatException(msg, **_kw)
         else:
             combined.constrain_columns(context=context)
+            combined.constrain_rows(context=context)
             return combined.get(context=context)
-    elif context.data_columns or context.data_comparisons:
+    elif context.data_columns or context.data_comparisons or context.data_rows:
         raise GeneFabFileException(
-            "Column operations on non-table data objects are not supported",
+            "Column/row operations on non-table data objects are not supported",
             columns=context.data_columns, comparisons=context.data_comparisons,
+            rows=context.data_rows,
         )
     else:
         return combined
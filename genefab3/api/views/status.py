@@ -4,6 +4,8 @@ from genefab3.db.mongo.utils import iterate_mongo_connections
 from genefab3.common.utils import iterate_terminal_leaves
 from genefab3.common.exceptions import GeneFabParserException
 from genefab3.common.types import StreamedAnnotationTable
+from genefab3.db.sql.response_cache import RESPONSE_CACHE_HOT_TIER
+from genefab3.db.sql.utils import get_page_stats
 from itertools import chain
 
 
@@ -15,6 +17,7 @@ ATTR_COLUMNS = "args", "kwargs"
 
 
 def sqlite_db_report(db_name, descriptor):
+    """Report size of SQLite database file"""
     return {"information": {
         "report type": f"size of {db_name}, GiB",
         "status": (
@@ -25,7 +28,31 @@ def sqlite_db_report(db_name, descriptor):
     }}
 
 
+def sqlite_db_vacuum_reports(db_name, descriptor, auto_vacuum_modes=("none", "full", "incremental")):
+    """Report reclaimable space and fragmentation (share of free pages) of SQLite database"""
+    if descriptor["db"] and path.isfile(descriptor["db"]):
+        stats = get_page_stats(descriptor["db"])
+    else:
+        stats = dict(page_size=0, page_count=0, freelist_count=0)
+    mode = dict(enumerate(auto_vacuum_modes)).get(stats.get("auto_vacuum"))
+    yield {"information": {
+        "report type": f"reclaimable space of {db_name}, GiB",
+        "status": format(
+            stats["freelist_count"] * stats["page_size"] / GiB, ".3f",
+        ),
+        "report timestamp": int(datetime.now().timestamp()),
+    }}
+    yield {"information": {
+        "report type": f"fragmentation of {db_name}, % of pages free",
+        "status": format(
+            100 * stats["freelist_count"] / (stats["page_count"] or 1), ".1f",
+        ) + (f" (auto_vacuum: {mode})" if mode else ""),
+        "report timestamp": int(datetime.now().timestamp()),
+    }}
+
+
 def mongo_db_report(mongo_client):
+    """Report number of active MongoDB connections"""
     return {"information": {
         "report type": "number of active MongoDB connections",
         "status": sum(1 for _ in iterate_mongo_connections(mongo_client)),
@@ -33,14 +60,34 @@ def mongo_db_report(mongo_client):
     }}
 
 
+def response_cache_hot_tier_report():
+    """Report occupancy and hit statistics of response cache hot tier of current process"""
+    report = RESPONSE_CACHE_HOT_TIER.report()
+    return {"information": {
+        "report type": "response cache hot tier of process {}".format(
+            report["pid"],
+        ),
+        "status": ", ".join(
+            f"{k}: {v}" for k, v in report.items() if k != "pid"
+        ),
+        "report timestamp": int(datetime.now().timestamp()),
+    }}
+
+
 def get(*, genefab3_client, sqlite_dbs, context):
+    """Collect status reports of databases and log entries into annotation table"""
     for _ in iterate_terminal_leaves(context.query):
         msg = "Metadata queries are not valid for view"
         raise GeneFabParserException(msg, view="status")
     table = StreamedAnnotationTable(
         cursor=chain(
             [sqlite_db_report(n, d) for n, d in sqlite_dbs.__dict__.items()],
+            *(
+                sqlite_db_vacuum_reports(n, d)
+                for n, d in sqlite_dbs.__dict__.items()
+            ),
             [mongo_db_report(genefab3_client.mongo_client)],
+            [response_cache_hot_tier_report()],
             genefab3_client.mongo_collections.status.aggregate([
                 {"$group": {"_id": {
                     "id": {c: f"${c}" for c in ID_COLUMNS},
@@ -6,6 +6,7 @@ from socket import create_connection, error as SocketError
 from types import SimpleNamespace
 from genefab3.common.exceptions import GeneFabLogger, exception_catcher
 from genefab3.db.mongo.utils import iterate_mongo_connections
+from genefab3.db.mongo.epochs import ensure_metadata_epoch_index
 from genefab3.db.cacher import MetadataCacherThread
 from genefab3.api.renderer import CacheableRenderer
 from functools import partial
@@ -23,6 +24,7 @@ class GeneFabClient():
              self.units_formatter) = (
                 self._get_mongo_db_connection(**mongo_params)
             )
+            ensure_metadata_epoch_index(self.mongo_collections.records)
             self.sqlite_dbs = self._get_validated_sqlite_dbs(**sqlite_params)
             self.adapter = AdapterClass()
             self._init_error_handlers()
@@ -96,7 +98,8 @@ class GeneFabClient():
         routes = RoutesClass(genefab3_client=self)
         renderer = CacheableRenderer(self)
         for endpoint, method in routes.items():
-            self.flask_app.route(endpoint, methods=["GET"])(renderer(method))
+            _methods = getattr(method, "methods", ["GET"])
+            self.flask_app.route(endpoint, methods=_methods)(renderer(method))
         return routes
  
     def _ok_to_loop_metadata_cacher_thread(self, enabled):
@@ -117,7 +120,7 @@ class GeneFabClient():
                 GeneFabLogger.info(f"{self.mongo_appname}:\n  {m}")
                 return True
  
-    def _ensure_metadata_cacher_thread(self, full_update_interval, full_update_retry_delay, dataset_init_interval, dataset_update_interval, enabled=True):
+    def _ensure_metadata_cacher_thread(self, full_update_interval, full_update_retry_delay, dataset_init_interval, dataset_update_interval, warmup_top_n=32, warmup_budget=600, warmup_interval=1, enabled=True):
         """Start background cacher thread"""
         if self._ok_to_loop_metadata_cacher_thread(enabled):
             metadata_cacher_thread = MetadataCacherThread(
@@ -126,6 +129,8 @@ class GeneFabClient():
                 full_update_retry_delay=full_update_retry_delay,
                 dataset_init_interval=dataset_init_interval,
                 dataset_update_interval=dataset_update_interval,
+                warmup_top_n=warmup_top_n, warmup_budget=warmup_budget,
+                warmup_interval=warmup_interval,
             )
             metadata_cacher_thread.start()
             return metadata_cacher_thread
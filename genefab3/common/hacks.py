@@ -1,5 +1,5 @@
 from functools import wraps
-from genefab3.common.types import NaN, StreamedDataTable
+from genefab3.common.types import NaN, StreamedTable, StreamedDataTable
 from sqlite3 import OperationalError
 from genefab3.common.exceptions import GeneFabDatabaseException
 from pandas import DataFrame
@@ -8,6 +8,7 @@ from genefab3.common.exceptions import GeneFabFormatException, GeneFabLogger
 from collections import OrderedDict
 from genefab3.common.exceptions import GeneFabConfigurationException
 from re import search
+from genefab3.db.sql.column_stats import aggregate_part
 
 
 def apply_hack(hack):
@@ -110,20 +111,22 @@ def convert_legacy_metadata_post(recache_single_dataset_metadata, self, accessio
 
 
 def get_sub_df(obj, partname, partcols):
-    """Retrieve only informative values from single part of table as pandas.DataFrame"""
+    """Retrieve only informative values from single part of table as pandas.DataFrame, reading them from column statistics in catalog if available (otherwise aggregating over part); also return index fingerprint (None if not in catalog)"""
     from genefab3.db.sql.streamed_tables import SQLiteIndexName
     found = lambda v: v is not None
-    index_name, data = None, {}
+    index_name, data, stats = None, {}, None
     with obj.sqltransactions.concurrent("hacks/get_sub_df") as (_, execute):
         try:
-            fetch = lambda query: execute(query).fetchone()
-            mktargets = lambda f: ",".join(f"{f}(`{c}`)" for c in partcols)
-            mkquery = lambda t: f"SELECT {t} FROM `{partname}` LIMIT 1"
-            minima = fetch(mkquery(mktargets("MIN")))
-            maxima = fetch(mkquery(mktargets("MAX")))
-            counts = fetch(mkquery(mktargets("COUNT")))
-            n_rows = fetch(f"SELECT COUNT(*) FROM `{partname}` LIMIT 1")[0]
-            hasnan = [(n_rows - c) > 0 for c in counts]
+            if getattr(obj, "column_stats", None) is not None:
+                stats = obj.column_stats.retrieve(execute, partname, partcols)
+            if stats is not None:
+                minima, maxima, hasnan, fingerprint = stats
+            else:
+                minima, maxima, counts, n_rows = aggregate_part(
+                    execute, partname, partcols,
+                )
+                hasnan = [(n_rows - c) > 0 for c in counts]
+                fingerprint = None
             for c, m, M, h in zip(partcols, minima, maxima, hasnan):
                 _min = m if found(m) else M if found(M) else NaN
                 _max = M if found(M) else _min
@@ -138,7 +141,7 @@ def get_sub_df(obj, partname, partcols):
     dataframe = DataFrame(data)
     if index_name is not None:
         dataframe.set_index(index_name, inplace=True)
-    return dataframe
+    return dataframe, fingerprint
 
 
 def get_part_index(obj, partname):
@@ -172,9 +175,10 @@ def merge_subs(self, sub_dfs, sub_indices):
 
 class StreamedDataTableSub(StreamedDataTable):
     """StreamedDataTable-like class that streams from underlying pandas.DataFrame"""
+    value_blocks = StreamedTable.value_blocks
  
     def __init__(self, sub_merged, sub_columns, na_rep=None):
-        self.shape, self.n_index_levels = tuple(sub_merged.shape), 1
+        self._n_rows, self.n_index_levels = sub_merged.shape[0], 1
         self._dataframe = sub_merged
         self._index_name = sub_merged.index.name
         self._columns = sub_columns
@@ -213,15 +217,29 @@ class StreamedDataTableSub(StreamedDataTable):
             else:
                 for r, vv in self._dataframe.iterrows():
                     yield [self.na_rep if v is None else v for v in (r, *vv)]
+ 
+    def iter_rows(self):
+        """Iterate pairs of index (as tuple of levels) and values line by line, both from a single pass over dataframe"""
+        _na = lambda v: self.na_rep if v is None else v
+        for r, vv in self._dataframe.iterrows():
+            if self.n_index_levels:
+                yield (_na(r),), [_na(v) for v in vv.tolist()]
+            else:
+                yield (), [_na(v) for v in (r, *vv)]
 
 
 def speed_up_data_schema(get, self, *, context, limit=None, offset=0):
     """If context.schema == '1', replaces underlying query with quick retrieval of just values informative for schema"""
     if context.schema != "1":
         return get(self, context=context, limit=limit, offset=offset)
-    elif context.data_columns or context.data_comparisons:
-        msg = "Data schema does not support column subsetting / comparisons"
-        sug = "Remove comparisons and/or column, row slicing from query"
+    elif any((
+        context.data_columns, context.data_comparisons, context.data_rows,
+        context.limit, context.aggregate, context.sort,
+    )):
+        msg = ("Data schema does not support subsetting, comparisons, " +
+            "paging, aggregation, sorting")
+        sug = ("Remove comparisons, column, row slicing, paging, " +
+            "aggregation and sorting from query")
         raise GeneFabFormatException(msg, suggestion=sug)
     else:
         from genefab3.db.sql.streamed_tables import (
@@ -229,17 +247,20 @@ def speed_up_data_schema(get, self, *, context, limit=None, offset=0):
             StreamedDataTableWizard_Single, StreamedDataTableWizard_OuterJoined,
         )
         GeneFabLogger.info(f"apply_hack(speed_up_data_schema) for {self.name}")
-        sub_dfs, sub_indices = OrderedDict(), {}
-        sub_columns, index_name = [], []
+        sub_dfs, sub_indices, fingerprints = OrderedDict(), {}, {}
+        sub_columns, index_name, part_objs = [], [], {}
         def _extend_parts(obj):
             for partname, partcols in obj._inverse_column_dispatcher.items():
                 if isinstance(partcols[0], SQLiteIndexName):
                     index_name.clear()
                     index_name.append(partcols[0])
-                    sub_df = get_sub_df(obj, partname, partcols)
+                    _partcols = partcols
                 else:
-                    sub_df = get_sub_df(obj, partname, [*index_name, *partcols])
-                sub_indices[partname] = get_part_index(obj, partname)
+                    _partcols = [*index_name, *partcols]
+                sub_df, fingerprints[partname] = get_sub_df(
+                    obj, partname, _partcols,
+                )
+                part_objs[partname] = obj
                 sub_dfs[partname] = sub_df
                 _ocr2f = obj._columns_raw2full
                 sub_columns.extend(_ocr2f[c] for c in sub_df.columns)
@@ -251,6 +272,10 @@ def speed_up_data_schema(get, self, *, context, limit=None, offset=0):
         else:
             msg = "Schema speedup applied to unsupported object type"
             raise GeneFabConfigurationException(msg, type=type(self))
+        _fps = set(fingerprints.values())
+        if (None in _fps) or (len(_fps) > 1): # compare actual index values
+            for partname, obj in part_objs.items():
+                sub_indices[partname] = get_part_index(obj, partname)
         sub_merged = merge_subs(self, sub_dfs, sub_indices)
         return StreamedDataTableSub(sub_merged, sub_columns)
 
@@ -267,11 +292,11 @@ def bypass_uncached_views(get, self, context):
 
 
 class NoCommitConnection():
-    """Wrapper for sqlite3 connection that forcefully prevents commits (for pandas.to_sql)"""
+    """Wrapper for sqlite3 connection that forcefully prevents commits and rollbacks (for pandas.to_sql); the caller decides the fate of the transaction"""
     def __init__(self, connection):
         self.__connection = connection
     def __getattr__(self, attr):
-        if attr == "commit":
+        if attr in {"commit", "rollback"}:
             return lambda: None
         else:
             return getattr(self.__connection, attr)
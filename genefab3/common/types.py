@@ -1,12 +1,15 @@
-from itertools import tee
+from itertools import tee, islice
 from collections.abc import Callable
 from genefab3.common.exceptions import GeneFabConfigurationException
-from functools import wraps
+from functools import wraps, partial
 from flask import Response
 from genefab3.common.utils import blackjack, KeyToPosition
 from genefab3.db.sql.utils import SQLTransactions, reraise_operational_error
 from sqlite3 import OperationalError
-from genefab3.common.exceptions import GeneFabLogger
+from collections import OrderedDict
+from numpy import array as nparray, nan, nanmean, nansum, nanmin, nanmax, nanvar
+from pandas import DataFrame, to_numeric
+from warnings import catch_warnings, simplefilter
 
 
 class ExtNaN(float):
@@ -71,12 +74,13 @@ class Routes():
     def __init__(self, genefab3_client):
         self.genefab3_client = genefab3_client
  
-    def register_endpoint(endpoint=None):
-        """Decorator that adds `endpoint` and `fmt` attributes to class method"""
+    def register_endpoint(endpoint=None, methods=("GET",)):
+        """Decorator that adds `endpoint` and `methods` (HTTP) attributes to class method"""
         def outer(method):
             @wraps(method)
             def inner(*args, **kwargs):
                 return method(*args, **kwargs)
+            inner.methods = list(methods)
             if endpoint:
                 inner.endpoint = endpoint
             elif hasattr(method, "__name__"):
@@ -94,21 +98,23 @@ class Routes():
 
 
 class ResponseContainer():
-    """Holds content (bytes, strings, streamer function, or Response), mimetype, and originating object"""
-    def update(self, content=None, mimetype=None, obj=None):
+    """Holds content (bytes, strings, streamer function, or Response), mimetype, originating object, and extra headers"""
+    def update(self, content=None, mimetype=None, obj=None, headers=None):
         self.content, self.mimetype, self.obj = content, mimetype, obj
-    def __init__(self, content=None, mimetype=None, obj=None):
-        self.update(content, mimetype, obj)
+        self.headers = headers or {}
+    def __init__(self, content=None, mimetype=None, obj=None, headers=None):
+        self.update(content, mimetype, obj, headers)
     @property
     def empty(self):
         return self.content is None
     def make_response(self):
+        _kw = dict(mimetype=self.mimetype, headers=self.headers)
         if isinstance(self.content, Response):
             return self.content
         elif isinstance(self.content, Callable):
-            return Response(self.content(), mimetype=self.mimetype)
+            return Response(self.content(), **_kw)
         elif self.content is not None:
-            return Response(self.content, mimetype=self.mimetype)
+            return Response(self.content, **_kw)
         else:
             msg = "Route returned no response"
             raise GeneFabConfigurationException(msg)
@@ -118,12 +124,14 @@ class StreamedTable():
     """Generalized streamed table (either from MongoDB or from SQLite)"""
     default_format = "csv"
     cacheable = True
+    rows_per_block = 256
     def placeholder(self, *, n_column_levels):
         return type("EmptyStreamedTable", (type(self),), dict(
             __init__=lambda *a, **k: None, shape=(0, 0),
             move_index_boundary=lambda *a, **k: None,
             index_levels=["*"], column_levels=["*"] * n_column_levels,
             n_index_levels=1, index=[[NaN]], values=[[NaN]],
+            value_blocks=[[[NaN]]], iter_rows=lambda s: iter([([NaN], [NaN])]),
             __getattr__=lambda s, a: (),
         ))()
     @property
@@ -132,6 +140,17 @@ class StreamedTable():
     def index_names(self): yield from zip(*list(self.index_levels))
     @property
     def columns(self): yield from zip(*list(self.column_levels))
+    @property
+    def value_blocks(self):
+        """Iterate values in blocks (lists) of `self.rows_per_block` rows"""
+        rows, n = iter(self.values), self.rows_per_block
+        block = list(islice(rows, n))
+        while block:
+            yield block
+            block = list(islice(rows, n))
+    def iter_rows(self):
+        """Iterate pairs of index and values line by line; subclasses override this to make a single pass over their source"""
+        yield from zip(self.index, self.values)
 
 
 class StreamedSchema(StreamedTable):
@@ -147,6 +166,16 @@ class StreamedSchema(StreamedTable):
     @property
     def values(self): yield from self._schemify(self.table.values)
  
+    def iter_rows(self):
+        """Yield pair of index and value descriptors once, aggregated over a single pass of `self.table.iter_rows()`"""
+        n = self.table.n_index_levels
+        if self.table.shape[0] == 0:
+            yield [NaN] * n, [NaN] * self.table.shape[1]
+        else:
+            rows = self.table.iter_rows()
+            schema = next(self._schemify([*i, *v] for i, v in rows))
+            yield schema[:n], schema[n:]
+ 
     def _schemify(self, target, isinstance=isinstance, str=str, min=min, max=max, TypeError=TypeError, zip=zip, ExtNaN=ExtNaN, float=float):
         """Aggregate and return (yield once) value descriptors (type, min, max, hasnan) for each column"""
         _mt = lambda a, b, bool=bool, type=type, isinstance=isinstance: (bool if
@@ -274,40 +303,97 @@ class StreamedAnnotationTable(StreamedTable):
         """Iterate values line by line, like in pandas"""
         dispatcher = self._column_key_dispatcher
         yield from self._iter_body_levels(self._cursor, dispatcher)
+ 
+    def iter_rows(self):
+        """Iterate pairs of index and values line by line from a single pass over cursor, flattening each entry once"""
+        index_dispatcher = self._index_key_dispatcher
+        column_dispatcher = self._column_key_dispatcher
+        for entry in self._cursor:
+            index = [self._na_rep] * len(index_dispatcher)
+            values = [self._na_rep] * len(column_dispatcher)
+            for key, value in blackjack(entry, max_level=2):
+                if key in index_dispatcher:
+                    index[index_dispatcher[key]] = value
+                elif key in column_dispatcher:
+                    values[column_dispatcher[key]] = value
+            yield index, values
 
 
 class StreamedDataTable(StreamedTable):
     """Table streamed from SQLite query"""
+    cells_per_block = 65536
  
-    def __init__(self, *, sqlite_db, source_select, targets, query_filter, na_rep=None):
-        """Infer index names and columns, retain connection and query information"""
+    def __init__(self, *, sqlite_db, source_select, targets, query_filter, query_params=(), na_rep=None, n_rows=None):
+        """Infer index names and columns, retain connection and query information (with values for placeholders in `query_filter`); number of rows is only counted if not passed and when requested"""
         from genefab3.db.sql.streamed_tables import SQLiteIndexName
         _split3 = lambda c: (c[0].split("/", 2) + ["*", "*"])[:3]
         self.sqlite_db = sqlite_db
         self.source_select = source_select
         self.sqltransactions = SQLTransactions(sqlite_db, source_select.name)
         self.targets = targets
-        self.query_filter = query_filter
+        self.query_filter, self.query_params = query_filter, query_params
         self.na_rep = na_rep
         self.query = f"""
             SELECT {targets} FROM `{source_select.name}` {query_filter}
         """
         desc = "tables/StreamedDataTable"
-        with self.sqltransactions.concurrent(desc) as (connection, execute):
+        with self.sqltransactions.concurrent(desc) as (connection, _):
             try:
                 cursor = connection.cursor()
-                cursor.execute(self.query)
+                cursor.execute(
+                    f"SELECT * FROM ({self.query}) LIMIT 0", self.query_params,
+                )
                 self._index_name = SQLiteIndexName(cursor.description[0][0])
                 self._columns = [_split3(c) for c in cursor.description[1:]]
-                _count_query = f"SELECT count(*) FROM ({self.query})"
-                _nrows = (execute(_count_query).fetchone() or [0])[0]
-                self.shape = (_nrows, len(self._columns))
             except OperationalError as e:
                 reraise_operational_error(self, e)
+        self._n_rows = n_rows
         self.accessions = {c[0] for c in self._columns}
         self.n_index_levels = 1
         self.datatypes, self.gct_validity_set = set(), set()
  
+    def _count_rows(self, desc="tables/StreamedDataTable/count"):
+        """Run the full query once to count rows (only if row count is requested and was not known upfront)"""
+        _count_query = f"SELECT count(*) FROM ({self.query})"
+        with self.sqltransactions.concurrent(desc) as (_, execute):
+            try:
+                _ret = execute(_count_query, self.query_params).fetchone()
+                return (_ret or [0])[0]
+            except OperationalError as e:
+                reraise_operational_error(self, e)
+ 
+    def get_storage_classes(self, desc="tables/StreamedDataTable/types"):
+        """Collect sets of SQLite storage classes of non-NULL values in index column and in each column, with a single aggregate query over all rows"""
+        classes = "integer", "real", "text", "blob"
+        with self.sqltransactions.concurrent(desc) as (connection, execute):
+            try:
+                cursor = connection.cursor()
+                cursor.execute(
+                    f"SELECT * FROM ({self.query}) LIMIT 0", self.query_params,
+                )
+                _mask = lambda c: "+".join( # one bit per storage class
+                    f"{1<<i}*MAX(typeof(`{c}`)=='{k}')"
+                    for i, k in enumerate(classes)
+                )
+                targets = [
+                    f"IFNULL({_mask(c[0])},0)" for c in cursor.description
+                ]
+                query = f"SELECT {','.join(targets)} FROM ({self.query})"
+                masks = execute(query, self.query_params).fetchone()
+            except OperationalError as e:
+                reraise_operational_error(self, e)
+        return [
+            {k for i, k in enumerate(classes) if mask & (1 << i)}
+            for mask in masks
+        ]
+ 
+    @property
+    def shape(self):
+        """Shape of table as in pandas; number of rows is evaluated lazily"""
+        if self._n_rows is None:
+            self._n_rows = self._count_rows()
+        return (self._n_rows, len(self._columns) + (not self.n_index_levels))
+ 
     @property
     def gct_valid(self):
         """Test if valid for GCT, i.e. has exactly one datatype, and the datatype is supported"""
@@ -318,12 +404,8 @@ class StreamedDataTable(StreamedTable):
  
     def move_index_boundary(self, *, to):
         """Like pandas methods reset_index() and set_index(), but by numeric position"""
-        if to == 0:
-            self.n_index_levels = 0
-            self.shape = (self.shape[0], len(self._columns) + 1)
-        elif to == 1:
-            self.n_index_levels = 1
-            self.shape = (self.shape[0], len(self._columns))
+        if to in {0, 1}:
+            self.n_index_levels = to
         else:
             msg = "StreamedDataTable.move_index_boundary() only moves to 0 or 1"
             raise GeneFabConfigurationException(msg, to=to)
@@ -342,49 +424,189 @@ class StreamedDataTable(StreamedTable):
         else:
             yield from zip(["*", "*", self._index_name], *self._columns)
  
+    def _iter_blocks(self, query, desc):
+        """Iterate rows returned by `query` (with `self.query_params`) in blocks fetched with `fetchmany()`, substituting NULLs with `self.na_rep` block by block (only in rows that have NULLs)"""
+        blocksize = max(1, self.cells_per_block // (len(self._columns) + 1))
+        na_rep = self.na_rep
+        with self.sqltransactions.concurrent(desc) as (connection, _):
+            try:
+                cursor = connection.cursor()
+                cursor.execute(query, self.query_params)
+                block = cursor.fetchmany(blocksize)
+                while block:
+                    if na_rep is None:
+                        yield block
+                    else:
+                        yield [
+                            [na_rep if v is None else v for v in row]
+                            if None in row else row for row in block
+                        ]
+                    block = cursor.fetchmany(blocksize)
+            except OperationalError as e:
+                reraise_operational_error(self, e)
+ 
     @property
     def index(self):
         """Iterate index line by line, like in pandas"""
         if self.n_index_levels:
             index_query = f"SELECT `{self._index_name}` FROM ({self.query})"
             desc = "tables/StreamedDataTable/index"
-            with self.sqltransactions.concurrent(desc) as (_, execute):
-                try:
-                    if self.na_rep is None:
-                        yield from execute(index_query)
-                    else:
-                        _na_tup = (self.na_rep,)
-                        for value, *_ in execute(index_query):
-                            yield _na_tup if value is None else (value,)
-                except OperationalError as e:
-                    reraise_operational_error(self, e)
+            for block in self._iter_blocks(index_query, desc):
+                yield from block
         else:
             yield from ([] for _ in range(self.shape[0]))
  
+    @property
+    def value_blocks(self):
+        """Iterate values in blocks of rows as fetched with `fetchmany()`"""
+        desc = "tables/StreamedDataTable/values"
+        if self.n_index_levels:
+            for block in self._iter_blocks(self.query, desc):
+                yield [vv for _, *vv in block]
+        else:
+            yield from self._iter_blocks(self.query, desc)
+ 
     @property
     def values(self):
         """Iterate values line by line, like in pandas"""
-        desc = "tables/StreamedDataTable/values"
-        try:
-            if self.na_rep is None:
-                if self.n_index_levels:
-                    with self.sqltransactions.concurrent(desc) as (_, execute):
-                        for _, *vv in execute(self.query):
-                            yield vv
+        for block in self.value_blocks:
+            yield from block
+ 
+    def iter_rows(self):
+        """Iterate pairs of index (as tuple of levels) and values line by line, both from a single query"""
+        desc = "tables/StreamedDataTable/rows"
+        if self.n_index_levels:
+            for block in self._iter_blocks(self.query, desc):
+                for i, *vv in block:
+                    yield (i,), vv
+        else:
+            for block in self._iter_blocks(self.query, desc):
+                for row in block:
+                    yield (), row
+
+
+class StreamedAggregatedDataTable(StreamedDataTable):
+    """StreamedDataTable reduced with an aggregation function, either per column (in SQLite) or per row within each assay (blockwise in NumPy); only numeric values are aggregated"""
+    sql_aggregators = {
+        "mean": "AVG({})", "sum": "SUM({})", "min": "MIN({})",
+        "max": "MAX({})", "count": "COUNT({})",
+    }
+    numpy_aggregators = {
+        "mean": nanmean, "sum": nansum, "min": nanmin, "max": nanmax,
+        "count": lambda a, axis: (a == a).sum(axis=axis),
+        "var": partial(nanvar, ddof=1),
+    }
+    value_blocks = StreamedTable.value_blocks
+ 
+    def __init__(self, data, *, aggregate, per):
+        """Retain source StreamedDataTable `data`, infer columns of reduced table: same as in `data` if reducing `per` column, one per assay if reducing `per` row"""
+        self.data, self.aggregate, self.per = data, aggregate, per
+        self.sqlite_db, self.sqltransactions = data.sqlite_db, data.sqltransactions
+        self.query, self.query_params = data.query, data.query_params
+        self.na_rep, self._index_name = data.na_rep, data._index_name
+        self.accessions, self.n_index_levels = data.accessions, 1
+        self.datatypes, self.gct_validity_set = set(), set()
+        self.cacheable = data.cacheable
+        self.next_cursor = getattr(data, "next_cursor", None)
+        if per == "column":
+            self._columns, self._n_rows = data._columns, 1
+        else:
+            self._groups = OrderedDict()
+            for i, (accession, assay_name, _) in enumerate(data._columns):
+                self._groups.setdefault((accession, assay_name), []).append(i)
+            self._columns = [[*g, aggregate] for g in self._groups]
+            self._n_rows = data._n_rows
+ 
+    def get_storage_classes(self):
+        """Collect sets of SQLite storage classes of index column (name of aggregate, or index of `self.data`) and of reduced values (always real or NULL)"""
+        if self.per == "column":
+            index_classes = {"text"}
+        else:
+            index_classes = self.data.get_storage_classes()[0]
+        return [index_classes, *({"real"} for _ in self._columns)]
+ 
+    def _iter_column_aggregates(self, desc="tables/StreamedAggregatedDataTable"):
+        """Reduce each column with SQL aggregate functions over non-numeric values masked as NULLs; variance is computed in two passes"""
+        with self.sqltransactions.concurrent(desc) as (connection, execute):
+            try:
+                cursor = connection.cursor()
+                cursor.execute(
+                    f"SELECT * FROM ({self.query}) LIMIT 0", self.query_params,
+                )
+                _num = lambda c: (
+                    f"CASE WHEN typeof(`{c}`) IN ('integer','real') " +
+                    f"THEN `{c}` END"
+                )
+                numeric = [_num(c[0]) for c in cursor.description[1:]]
+                def _aggregate(targets, params=()):
+                    query = f"SELECT {','.join(targets)} FROM ({self.query})"
+                    _params = (*params, *self.query_params)
+                    return execute(query, _params).fetchone()
+                if self.aggregate == "var": # means are bound, may be non-finite
+                    means = _aggregate(f"AVG({n})" for n in numeric)
+                    _var = "SUM(({0}-?)*({0}-?))/(COUNT({0})-1)".format
+                    yield from _aggregate(
+                        map(_var, numeric), [v for m in means for v in (m, m)],
+                    )
                 else:
-                    with self.sqltransactions.concurrent(desc) as (_, execute):
-                        yield from execute(self.query)
+                    _f = self.sql_aggregators[self.aggregate]
+                    yield from _aggregate(_f.format(n) for n in numeric)
+            except OperationalError as e:
+                reraise_operational_error(self, e)
+ 
+    def _iter_row_aggregates(self, desc="tables/StreamedAggregatedDataTable"):
+        """Reduce each block of rows within each assay with NumPy, non-numeric values treated as missing; yield rows with index"""
+        how = self.aggregate
+        _f = self.numpy_aggregators[how]
+        for block in self.data._iter_blocks(self.query, desc):
+            try:
+                array = nparray([row[1:] for row in block], dtype=float)
+            except (ValueError, TypeError): # has non-numeric columns
+                array = DataFrame([row[1:] for row in block]).apply(
+                    partial(to_numeric, errors="coerce"),
+                ).values.astype(float)
+            reduced = []
+            with catch_warnings():
+                simplefilter("ignore", category=RuntimeWarning)
+                for positions in self._groups.values():
+                    subarray = array[:, positions]
+                    _reduced = _f(subarray, axis=1)
+                    if how != "count": # all-missing rows reduce to NaN
+                        _reduced = _reduced.astype(float)
+                        _reduced[(subarray == subarray).sum(axis=1) == 0] = nan
+                    reduced.append(_reduced)
+            for row, values in zip(block, zip(*reduced)):
+                yield (row[0], *(v.item() for v in values))
+ 
+    @property
+    def index(self):
+        """Iterate index line by line, like in pandas"""
+        if self.n_index_levels == 0:
+            yield from ([] for _ in range(self.shape[0]))
+        elif self.per == "column":
+            yield (self.aggregate,)
+        else:
+            yield from self.data.index
+ 
+    @property
+    def values(self):
+        """Iterate reduced values line by line, like in pandas"""
+        for _, values in self.iter_rows():
+            yield values
+ 
+    def iter_rows(self):
+        """Iterate pairs of index (as tuple of levels) and reduced values line by line, both from a single pass"""
+        _na_rep = self.na_rep
+        if _na_rep is None:
+            _na = lambda v: v
+        else:
+            _na = lambda v: _na_rep if (v is None) or (v != v) else v
+        if self.per == "column":
+            rows = [(self.aggregate, *self._iter_column_aggregates())]
+        else:
+            rows = self._iter_row_aggregates()
+        for r, *vv in rows:
+            if self.n_index_levels:
+                yield (r,), [_na(v) for v in vv]
             else:
-                if self.shape[0] > 50:
-                    msg = "StreamedDataTable with custom na_rep may be slow"
-                    GeneFabLogger.warning(msg)
-                if self.n_index_levels:
-                    with self.sqltransactions.concurrent(desc) as (_, execute):
-                        for _, *vv in execute(self.query):
-                            yield [self.na_rep if v is None else v for v in vv]
-                else:
-                    with self.sqltransactions.concurrent(desc) as (_, execute):
-                        for vv in execute(self.query):
-                            yield [self.na_rep if v is None else v for v in vv]
-        except OperationalError as e:
-            reraise_operational_error(self, e)
+                yield (), [r, *(_na(v) for v in vv)]
@@ -6,7 +6,9 @@ from genefab3.common.exceptions import GeneFabParserException
 from functools import partial, reduce
 from urllib.request import quote
 from itertools import chain, count
-from base64 import b64encode
+from base64 import b64encode, urlsafe_b64encode, urlsafe_b64decode
+from json import dumps, loads
+from binascii import Error as BinasciiError
 from uuid import uuid3, uuid4
 from contextlib import contextmanager
 from genefab3.common.exceptions import GeneFabLogger
@@ -47,6 +49,26 @@ def random_unique_string(seed=""):
     return b64encode(uuid3(uuid4(), seed).bytes, b'_-').decode().rstrip("=")
 
 
+def encode_page_cursor(last, skip):
+    """Encode last key of page (index value, or [sort value, index value]) and number of rows with that key already returned as opaque URL-safe token"""
+    payload = dumps([last, skip]).encode()
+    return urlsafe_b64encode(payload).decode().rstrip("=")
+
+
+def decode_page_cursor(token):
+    """Decode token produced by `encode_page_cursor()` into last key of previous page and number of rows with that key to skip"""
+    try:
+        padded = token + "=" * (-len(token) % 4)
+        decoded = loads(urlsafe_b64decode(padded.encode()).decode())
+    except (BinasciiError, UnicodeDecodeError, ValueError):
+        decoded = None
+    if isinstance(decoded, list) and (len(decoded) == 2):
+        last, skip = decoded
+        if isinstance(skip, int) and (skip > 0):
+            return last, skip
+    raise GeneFabParserException("Invalid cursor", cursor=token)
+
+
 @contextmanager
 def pick_reachable_url(urls, name=None):
     """Iterate `urls` and get the first reachable URL"""
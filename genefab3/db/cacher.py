@@ -1,17 +1,22 @@
 from threading import Thread
 from genefab3.db.sql.response_cache import ResponseCache
-from time import sleep
+from genefab3.db.sql.vacuum import IncrementalVacuumScheduler
+from time import sleep, monotonic
 from genefab3.common.exceptions import GeneFabLogger
 from genefab3.db.mongo.index import ensure_info_index
 from collections import OrderedDict
+from functools import partial
 from genefab3.common.hacks import apply_hack, convert_legacy_metadata_pre
 from genefab3.common.hacks import convert_legacy_metadata_post
 from genefab3.db.mongo.index import update_metadata_value_lookup
 from genefab3.db.mongo.utils import iterate_mongo_connections
+from genefab3.db.mongo.utils import query_matches_accessions
 from genefab3.db.mongo.types import ValueCheckedRecord
 from genefab3.isa.types import Dataset
 from genefab3.db.mongo.utils import run_mongo_action, harmonize_document
 from genefab3.db.mongo.status import update_status
+from genefab3.db.mongo.epochs import bump_metadata_epochs
+from genefab3.api.parser import WARMUP_ENVIRON_KEY
 
 
 class MetadataCacherThread(Thread):
@@ -20,7 +25,7 @@ class MetadataCacherThread(Thread):
       "adapter", "mongo_collections", "locale", "sqlite_dbs", "units_formatter",
     )
  
-    def __init__(self, *, genefab3_client, full_update_interval, full_update_retry_delay, dataset_init_interval, dataset_update_interval):
+    def __init__(self, *, genefab3_client, full_update_interval, full_update_retry_delay, dataset_init_interval, dataset_update_interval, warmup_top_n=32, warmup_budget=600, warmup_interval=1):
         """Prepare background thread that iteratively watches for changes to datasets"""
         self.genefab3_client = genefab3_client
         self._id = genefab3_client.mongo_appname.replace(
@@ -32,18 +37,23 @@ class MetadataCacherThread(Thread):
         self.full_update_retry_delay = full_update_retry_delay
         self.dataset_init_interval = dataset_init_interval
         self.dataset_update_interval = dataset_update_interval
+        self.warmup_top_n = warmup_top_n
+        self.warmup_budget = warmup_budget
+        self.warmup_interval = warmup_interval
+        self.warmup_thread = None
         self.response_cache = ResponseCache(self.sqlite_dbs)
+        self.vacuum_scheduler = IncrementalVacuumScheduler(self.sqlite_dbs)
         self.status_kwargs = dict(collection=self.mongo_collections.status)
         super().__init__()
  
     def delay(self, timeout, desc=None):
-        """Sleep for `timeout` seconds, reporting via GeneFabLogger.info()"""
+        """Sleep for `timeout` seconds, reporting via GeneFabLogger.info(); meanwhile, reclaim free pages of idle SQLite databases"""
         if desc:
             msg = f"Sleeping for {timeout} seconds before {desc}"
         else:
             msg = f"Sleeping for {timeout} seconds"
         GeneFabLogger.info(f"{self._id}:\n  {msg}")
-        sleep(timeout)
+        self.vacuum_scheduler.run_until(monotonic() + timeout)
  
     def run(self):
         """Continuously run MongoDB and SQLite3 cachers"""
@@ -51,17 +61,77 @@ class MetadataCacherThread(Thread):
             ensure_info_index(self.mongo_collections, self.locale)
             accessions, success = self.recache_metadata()
             if success:
-                if accessions["updated"]:
-                    self.response_cache.drop_all()
+                changed = (
+                    accessions["updated"] | accessions["failed"] |
+                    accessions["dropped"]
+                )
+                if changed:
+                    n_dropped = self.response_cache.drop_affected(
+                        changed, partial(
+                            query_matches_accessions,
+                            self.mongo_collections.metadata,
+                            locale=self.locale, accessions=changed,
+                        ),
+                    )
+                    self.bump_metadata_epochs(accessions)
                 else:
-                    for acc in accessions["failed"] | accessions["dropped"]:
-                        self.response_cache.drop(acc)
+                    n_dropped = 0
                 self.response_cache.shrink()
+                if n_dropped:
+                    self.start_response_cache_warmup()
                 self.delay(self.full_update_interval, "full metadata update")
             else:
                 msg = "retrying connection for metadata update"
                 self.delay(self.full_update_retry_delay, msg)
  
+    def bump_metadata_epochs(self, accessions):
+        """Bump metadata epochs of datasets whose metadata changed (updated, dropped, or failed while previously cached); must only be run after affected cached responses are dropped, otherwise stale cached responses would be served under new ETags"""
+        changed = (
+            accessions["updated"] | accessions["dropped"] |
+            (accessions["failed"] & accessions["cached"])
+        )
+        if changed:
+            bump_metadata_epochs(self.mongo_collections.records, changed)
+ 
+    def start_response_cache_warmup(self):
+        """Warm response cache in a parallel thread, so that it does not hold up metadata updates; do not start another warmup while previous one is running"""
+        if (self.warmup_thread is not None) and self.warmup_thread.is_alive():
+            msg = "previous warmup still running, not starting another"
+            GeneFabLogger.info(f"{self._id}:\n  {msg}")
+        else:
+            self.warmup_thread = Thread(target=self.warm_response_cache)
+            self.warmup_thread.start()
+ 
+    def warm_response_cache(self):
+        """Replay up to `self.warmup_top_n` most requested GET requests whose responses are not cached, one at a time with pauses, with URL root (host and script root) they were requested with, until `self.warmup_budget` seconds run out (a replay still running by then is abandoned and not cached), so that they are cached again before users request them; replays are marked with WARMUP_ENVIRON_KEY and are not counted as requests"""
+        if self.response_cache.sqlite_db is None:
+            return
+        self.response_cache.flush_requests()
+        requests = self.response_cache.get_most_requested(self.warmup_top_n)
+        client = self.genefab3_client.flask_app.test_client()
+        deadline = monotonic() + self.warmup_budget
+        for i, (url_root, full_path) in enumerate(requests):
+            if monotonic() > deadline:
+                msg = f"warmup budget exhausted after {i} of {len(requests)}"
+                GeneFabLogger.info(f"{self._id}:\n  {msg}")
+                break
+            sleep(self.warmup_interval)
+            GeneFabLogger.info(f"{self._id}:\n  warming up {full_path}")
+            try:
+                response = client.get(
+                    full_path, base_url=url_root, buffered=False,
+                    environ_overrides={WARMUP_ENVIRON_KEY: True},
+                )
+                for _ in response.response: # must be consumed to be cached
+                    if monotonic() > deadline:
+                        msg = f"warmup budget exhausted during {full_path}"
+                        GeneFabLogger.info(f"{self._id}:\n  {msg}")
+                        break
+                response.close()
+            except Exception as e:
+                msg = f"{self._id}:\n  could not warm up {full_path}: {e!r}"
+                GeneFabLogger.warning(msg, exc_info=e)
+ 
     def get_accession_dispatcher(self):
         """Return dict of sets of accessions; populates: 'cached', 'live'; prepares empty: 'fresh', 'updated', 'stale', 'dropped', 'failed'"""
         GeneFabLogger.info(f"{self._id}:\n  Checking metadata cache")
@@ -74,7 +144,7 @@ class MetadataCacherThread(Thread):
  
     @apply_hack(convert_legacy_metadata_pre)
     def recache_metadata(self):
-        """Instantiate each available dataset; if contents changed, dataset automatically updates db.metadata"""
+        """Instantiate each available dataset; if contents changed, dataset automatically updates db.metadata (metadata epochs of changed datasets are bumped by run(), once cached responses are dropped)"""
         try:
             accessions = self.get_accession_dispatcher()
         except Exception as e:
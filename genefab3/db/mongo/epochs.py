@@ -0,0 +1,63 @@
+from genefab3.common.exceptions import GeneFabLogger
+from pymongo import ASCENDING
+from datetime import datetime
+
+
+METADATA_EPOCH_KIND = "metadata epoch"
+
+
+def ensure_metadata_epoch_index(collection):
+    """Index metadata epochs by (kind, accession), so that conditional requests look them up without scanning `collection`"""
+    if METADATA_EPOCH_KIND not in collection.index_information():
+        msgmask = "Generating index for collection ('{}'), key {!r}"
+        GeneFabLogger.info(msgmask.format(collection.name, METADATA_EPOCH_KIND))
+        collection.create_index(
+            name=METADATA_EPOCH_KIND,
+            keys=[("kind", ASCENDING), ("accession", ASCENDING)],
+            partialFilterExpression={"kind": METADATA_EPOCH_KIND},
+        )
+
+
+def bump_metadata_epochs(collection, accessions):
+    """Set metadata epochs (timestamps of last change) of `accessions` and the global metadata epoch (accession None) to current time"""
+    timestamp = int(datetime.now().timestamp())
+    for accession in (*sorted(accessions), None):
+        query = {"kind": METADATA_EPOCH_KIND, "accession": accession}
+        collection.replace_one(
+            query, {**query, "timestamp": timestamp}, upsert=True,
+        )
+
+
+def get_metadata_epochs(collection, accessions=None):
+    """Retrieve metadata epochs of `accessions` as dict (0 for accessions that have not changed since epochs were introduced); if `accessions` is None, retrieve only global epoch, as {None: epoch}"""
+    keys = [None] if accessions is None else sorted(accessions)
+    query = {"kind": METADATA_EPOCH_KIND, "accession": {"$in": keys}}
+    projection = {"_id": False, "accession": True, "timestamp": True}
+    epochs = {
+        entry["accession"]: entry["timestamp"]
+        for entry in collection.find(query, projection)
+    }
+    return {key: epochs.get(key, 0) for key in keys}
+
+
+def get_constrained_accessions(query):
+    """Infer set of accessions that MongoDB `query` (as parsed by Context) is constrained to by its top-level clauses; None if not constrained"""
+    accessions = None
+    for clause in (query or {}).get("$and", []):
+        if set(clause) == {"id.accession"}:
+            constraint = clause["id.accession"]
+            if isinstance(constraint, dict) and (set(constraint) == {"$in"}):
+                clause_accessions = set(constraint["$in"])
+            else:
+                continue
+        elif (set(clause) == {"$or"}) and all(
+            isinstance(c.get("id.accession"), str) for c in clause["$or"]
+        ):
+            clause_accessions = {c["id.accession"] for c in clause["$or"]}
+        else:
+            continue
+        if accessions is None:
+            accessions = clause_accessions
+        else:
+            accessions &= clause_accessions
+    return accessions
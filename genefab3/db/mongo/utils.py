@@ -117,6 +117,18 @@ def aggregate_entries_by_context(collection, *, locale, context, id_fields=(), p
     return collection.aggregate(pipeline, collation=collation)
 
 
+def query_matches_accessions(collection, *, locale, query, unwind, accessions):
+    """Check if any document of `accessions` matches `query` (after unwinding `unwind` fields), under same collation as aggregate_entries_by_context()"""
+    pipeline = [
+        {"$match": {"id.accession": {"$in": sorted(accessions)}}},
+      *({"$unwind": f"${f}"} for f in unwind),
+        {"$match": query}, {"$limit": 1}, {"$project": {"_id": True}},
+    ]
+    collation = {"locale": locale, "numericOrdering": True}
+    cursor = collection.aggregate(pipeline, collation=collation)
+    return any(True for _ in cursor)
+
+
 def aggregate_file_descriptors_by_context(collection, *, locale, context, tech_type_locator="investigation.study assays.study assay technology type"):
     """Return DataFrame of file descriptors that match user query"""
     context.projection["file"] = True
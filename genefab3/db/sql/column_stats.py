@@ -0,0 +1,111 @@
+from genefab3.common.utils import validate_no_backtick
+from pandas.util import hash_pandas_object
+from numpy import array, concatenate, unique, uint64
+from hashlib import md5
+
+
+class SQLiteColumnStats():
+    """Per-column statistics of table parts (declared type, minimum, maximum, number of NULLs, estimated number of distinct values), computed at ingest time and stored in catalog"""
+    schema = {
+        "table": "TEXT", "part": "TEXT", "column": "TEXT", "type": "TEXT",
+        "min": "", "max": "", "n_null": "INTEGER", "n_distinct": "INTEGER",
+        "index_fingerprint": "TEXT",
+    }
+    sketch_size = 1024
+ 
+    def __init__(self, *, table, aux_table="AUX:column_stats"):
+        """Prepare empty distinct value sketches (KMV) for columns and full set of index value hashes"""
+        self.table, self.aux_table = table, aux_table
+        self._sketches, self._index_hashes = {}, array([], dtype=uint64)
+ 
+    def _hash(self, values):
+        """Hash non-null values of series or index with pandas' vectorized hashing"""
+        return hash_pandas_object(values.dropna(), index=False).values
+ 
+    def update(self, dataframe):
+        """Extend sketches with values of `dataframe` chunk (as it is inserted); index hashes include missing values, so that fingerprints of indices differ if only one of them has NULLs"""
+        for column, series in dataframe.items():
+            sketch = self._sketches.get(str(column), array([], dtype=uint64))
+            self._sketches[str(column)] = unique(
+                concatenate([sketch, self._hash(series)]),
+            )[:self.sketch_size]
+        index_hashes = hash_pandas_object(dataframe.index, index=False).values
+        self._index_hashes = unique(
+            concatenate([self._index_hashes, index_hashes]),
+        )
+ 
+    def _n_distinct(self, column, is_index):
+        """Number of distinct values: exact for index and small columns, KMV estimate otherwise"""
+        if is_index:
+            return len(self._index_hashes)
+        sketch = self._sketches.get(column, ())
+        if len(sketch) < self.sketch_size:
+            return len(sketch)
+        else:
+            kth = float(sketch[self.sketch_size - 1]) / 2**64
+            return int((self.sketch_size - 1) / kth)
+ 
+    def store(self, connection, parts):
+        """During an open connection, compute minima, maxima and NULL counts of all `parts` (as returned by SQLiteObject.iterparts()) in SQLite and store them in catalog along with sketch results"""
+        fingerprint = md5(self._index_hashes.tobytes()).hexdigest()
+        execute = connection.execute
+        for partname, index_name, columns in parts:
+            partcols = [index_name, *columns]
+            types = {
+                name: _type for _, name, _type, *_ in
+                execute(f"PRAGMA table_info(`{partname}`)").fetchall()
+            }
+            minima, maxima, counts, n_rows = aggregate_part(
+                execute, partname, partcols,
+            )
+            execute(f"""DELETE FROM `{self.aux_table}`
+                WHERE `table` == ? AND `part` == ?""", [self.table, partname])
+            connection.executemany(f"""INSERT INTO `{self.aux_table}`
+                (`table`,`part`,`column`,`type`,`min`,`max`,`n_null`,
+                `n_distinct`,`index_fingerprint`)
+                VALUES(?,?,?,?,?,?,?,?,?)""", [
+                (
+                    self.table, partname, c, types.get(c), _min, _max,
+                    n_rows - count,
+                    min(count, self._n_distinct(c, c == index_name)),
+                    fingerprint if (c == index_name) else None,
+                )
+                for c, _min, _max, count in zip(partcols, minima, maxima, counts)
+            ])
+ 
+    def retrieve(self, execute, partname, partcols):
+        """Read minima, maxima, whether there are NULLs, and index fingerprint of `partcols` of `partname` from catalog; None if any are missing"""
+        query = f"""SELECT `column`,`min`,`max`,`n_null`,`index_fingerprint`
+            FROM `{self.aux_table}` WHERE `table` == ? AND `part` == ?"""
+        stats = {
+            c: (_min, _max, n_null, fp) for c, _min, _max, n_null, fp
+            in execute(query, [self.table, partname]).fetchall()
+        }
+        if not all(c in stats for c in partcols):
+            return None
+        else:
+            minima = [stats[c][0] for c in partcols]
+            maxima = [stats[c][1] for c in partcols]
+            hasnan = [stats[c][2] > 0 for c in partcols]
+            fingerprints = {stats[c][3] for c in partcols} - {None}
+            return minima, maxima, hasnan, (fingerprints or {None}).pop()
+ 
+    def drop(self, *, connection, other=None):
+        """During an open connection, delete statistics of `self.table` (or `other`)"""
+        table = other or self.table
+        connection.execute(f"""DELETE FROM `{self.aux_table}`
+            WHERE `table` == "{table}" """)
+
+
+def aggregate_part(execute, partname, partcols):
+    """Run MIN, MAX, COUNT over `partcols` of `partname` (separately, to stay under SQLite column limit); return them with number of rows"""
+    for c in partcols:
+        validate_no_backtick(c, "column")
+    fetch = lambda query: execute(query).fetchone()
+    mktargets = lambda f: ",".join(f"{f}(`{c}`)" for c in partcols)
+    mkquery = lambda t: f"SELECT {t} FROM `{partname}` LIMIT 1"
+    minima = fetch(mkquery(mktargets("MIN")))
+    maxima = fetch(mkquery(mktargets("MAX")))
+    counts = fetch(mkquery(mktargets("COUNT")))
+    n_rows = fetch(f"SELECT COUNT(*) FROM `{partname}` LIMIT 1")[0]
+    return minima, maxima, counts, n_rows
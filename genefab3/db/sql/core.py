@@ -1,7 +1,7 @@
-from genefab3.db.sql.utils import SQLTransactions
+from genefab3.db.sql.utils import SQLTransactions, ensure_table_schema
 from genefab3.common.utils import validate_no_backtick, validate_no_doublequote
 from itertools import count
-from sqlite3 import OperationalError
+from sqlite3 import OperationalError, IntegrityError
 from genefab3.db.sql.streamed_tables import SQLiteIndexName
 from genefab3.common.exceptions import GeneFabLogger
 from threading import Thread
@@ -11,7 +11,9 @@ from genefab3.common.exceptions import GeneFabDatabaseException
 from math import inf
 from collections import OrderedDict
 from genefab3.db.sql.streamed_tables import StreamedDataTableWizard_Single
-from os import path
+from genefab3.db.sql.index_advisor import SQLiteIndexAdvisor
+from genefab3.db.sql.column_stats import SQLiteColumnStats
+from genefab3.db.sql.utils import get_used_size
 
 
 class SQLiteObject():
@@ -26,14 +28,7 @@ class SQLiteObject():
         desc = "tables/ensure_schema"
         with self.sqltransactions.concurrent(desc) as (_, execute):
             for table, schema in (table_schemas or {}).items():
-                execute(
-                    "CREATE TABLE IF NOT EXISTS `{}` ({})".format(
-                        validate_no_backtick(table, "table"), ", ".join(
-                            "`" + validate_no_backtick(f, "field") + "` " + k
-                            for f, k in schema.items()
-                        ),
-                    ),
-                )
+                ensure_table_schema(execute, table, schema)
  
     @classmethod
     def iterparts(cls, table, connection, *, must_exist=True, partname_mask="{table}://{i}"):
@@ -67,6 +62,40 @@ class SQLiteObject():
             else:
                 GeneFabLogger.info(f"Dropped {partname} (if it existed)")
  
+    @classmethod
+    def recreate_part(cls, partname, connection, *, keyed):
+        """During an open connection, recreate `partname` with same columns and data, either keyed by its index column (PRIMARY KEY; WITHOUT ROWID if rows are narrow) or with a plain index on it; raises IntegrityError if index is not unique"""
+        table_info = connection.execute(
+            f"PRAGMA table_info(`{partname}`)",
+        ).fetchall()
+        (_, index_name, index_type, *_), *_ = table_info
+        fields = [
+            "`" + validate_no_backtick(name, "column") + "` " + (_type or "")
+            for _, name, _type, *_ in table_info
+        ]
+        page_size = connection.execute("PRAGMA page_size").fetchone()[0]
+        if keyed:
+            fields[0] += " PRIMARY KEY NOT NULL"
+            # rough estimate of row size, assuming mostly numeric values:
+            is_narrow = (9 * len(fields) <= page_size / 20)
+            options = "WITHOUT ROWID" if is_narrow else ""
+        else:
+            options = ""
+        temp_partname = f"REKEY:{partname}"
+        connection.execute(f"DROP TABLE IF EXISTS `{temp_partname}`")
+        connection.execute(f"""CREATE TABLE `{temp_partname}`
+            ({",".join(fields)}) {options}""")
+        connection.execute(f"""INSERT INTO `{temp_partname}`
+            SELECT * FROM `{partname}`""")
+        connection.execute(f"DROP TABLE `{partname}`")
+        connection.execute(f"""ALTER TABLE `{temp_partname}`
+            RENAME TO `{partname}`""")
+        if not keyed:
+            connection.execute(f"""CREATE INDEX `ix_{partname}_{index_name}`
+                ON `{partname}` (`{index_name}`)""")
+        _how = f"keyed by {index_name}" if keyed else "unkeyed"
+        GeneFabLogger.info(f"Recreated {partname} ({_how}) {options}")
+ 
     def is_stale(self, *, timestamp_table=None, id_field=None, db_type=None, ignore_conflicts=False):
         """Evaluates to True if underlying data in need of update, otherwise False"""
         if (timestamp_table is None) or (id_field is None):
@@ -195,7 +224,7 @@ class SQLiteBlob(SQLiteObject):
 class SQLiteTable(SQLiteObject):
     """Represents an SQLiteObject initialized with a spec suitable for a generic table"""
  
-    def __init__(self, *, sqlite_db, table, aux_table, timestamp, maxpartcols=998, maxdbsize=None):
+    def __init__(self, *, sqlite_db, table, aux_table, timestamp, maxpartcols=998, maxdbsize=None, index_advisor_table="AUX:index_advisor", column_stats_table="AUX:column_stats"):
         if not table.startswith("TABLE:"):
             msg = "Table name for SQLiteTable must start with 'TABLE:'"
             raise GeneFabConfigurationException(msg, table=table)
@@ -212,7 +241,10 @@ class SQLiteTable(SQLiteObject):
                     aux_table: {
                         "table": "TEXT",
                         "timestamp": "INTEGER", "retrieved_at": "INTEGER",
+                        "n_rows": "INTEGER", "keyed": "INTEGER",
                     },
+                    index_advisor_table: SQLiteIndexAdvisor.schema,
+                    column_stats_table: SQLiteColumnStats.schema,
                 },
             )
             self.table = validate_no_backtick(
@@ -220,6 +252,13 @@ class SQLiteTable(SQLiteObject):
             )
             self.aux_table, self.timestamp = aux_table, timestamp
             self.maxpartcols, self.maxdbsize = maxpartcols, maxdbsize or inf
+            self.index_advisor = SQLiteIndexAdvisor(
+                sqltransactions=self.sqltransactions, table=self.table,
+                aux_table=index_advisor_table, maxdbsize=self.maxdbsize,
+            )
+            self.column_stats = SQLiteColumnStats(
+                table=self.table, aux_table=column_stats_table,
+            )
  
     def drop(self, *, connection, other=None):
         table = other or self.table
@@ -232,6 +271,8 @@ class SQLiteTable(SQLiteObject):
             raise
         else:
             GeneFabLogger.info(f"Deleted from {self.aux_table}: {table}")
+        self.index_advisor.drop(connection=connection, other=table)
+        self.column_stats.drop(connection=connection, other=table)
         SQLiteObject.drop_all_parts(table, connection)
  
     def is_stale(self, ignore_conflicts=False):
@@ -244,25 +285,65 @@ class SQLiteTable(SQLiteObject):
     def retrieve(self, desc="tables/retrieve"):
         """Create an StreamedDataTableWizard object dispatching columns to table parts"""
         column_dispatcher = OrderedDict()
-        with self.sqltransactions.concurrent(desc) as (connection, _):
+        with self.sqltransactions.concurrent(desc) as (connection, execute):
             parts = SQLiteObject.iterparts(self.table, connection)
             for partname, index_name, columns in parts:
                 if index_name not in column_dispatcher:
                     column_dispatcher[index_name] = partname
                 for c in columns:
                     column_dispatcher[c] = partname
+            query_aux = f"""SELECT `n_rows`,`keyed` FROM `{self.aux_table}`
+                WHERE `table` == "{self.table}" """
+            n_rows, keyed = execute(query_aux).fetchone() or [None, None]
         if not column_dispatcher:
             raise GeneFabDatabaseException("No data found", table=self.table)
         else:
+            if keyed is None: # cached before parts were keyed by index
+                Thread(target=self.rekey).start()
             return StreamedDataTableWizard_Single(
                 self.sqlite_db, column_dispatcher, identifier=self.identifier,
+                n_rows=n_rows, keyed=bool(keyed),
+                index_advisor=self.index_advisor,
+                column_stats=self.column_stats,
             )
  
+    def rekey(self, desc="tables/rekey"):
+        """Migrate table cached with unkeyed parts: recreate parts with index column as PRIMARY KEY, or record that the index is not unique"""
+        try:
+            with self.sqltransactions.exclusive(desc) as (connection, execute):
+                query_keyed = f"""SELECT `keyed` FROM `{self.aux_table}`
+                    WHERE `table` == "{self.table}" """
+                ret = execute(query_keyed).fetchone()
+                if (ret is None) or (ret[0] is not None):
+                    return # dropped or migrated while waiting to acquire lock
+                execute("SAVEPOINT `rekey`")
+                try:
+                    for partname, *_ in list(
+                        SQLiteObject.iterparts(self.table, connection),
+                    ):
+                        SQLiteObject.recreate_part(
+                            partname, connection, keyed=True,
+                        )
+                except IntegrityError:
+                    execute("ROLLBACK TO `rekey`")
+                    keyed = 0
+                else:
+                    keyed = 1
+                execute("RELEASE `rekey`")
+                execute(f"""UPDATE `{self.aux_table}` SET `keyed` = ?
+                    WHERE `table` == "{self.table}" """, [keyed])
+                self.index_advisor.drop(connection=connection)
+        except (OperationalError, GeneFabDatabaseException) as e:
+            msg = f"{desc}: could not migrate {self.table}"
+            GeneFabLogger.error(msg, exc_info=e)
+        else:
+            GeneFabLogger.info(f"{desc}: migrated {self.table}")
+ 
     def cleanup(self, max_iter=100, max_skids=20, desc="tables/cleanup"):
-        """Check size of underlying database file, drop oldest tables to keep file size under `self.maxdbsize`"""
+        """Check size of underlying database (not counting free pages), drop oldest tables to keep it under `self.maxdbsize`"""
         n_dropped, n_skids = 0, 0
         for _ in range(max_iter):
-            current_size = path.getsize(self.sqlite_db)
+            current_size = get_used_size(self.sqlite_db)
             if (n_skids < max_skids) and (current_size > self.maxdbsize):
                 with self.sqltransactions.concurrent(desc) as (_, execute):
                     query_oldest = f"""SELECT `table`
@@ -282,13 +363,13 @@ class SQLiteTable(SQLiteObject):
                     else:
                         connection.commit()
                         n_dropped += 1
-                n_skids += (path.getsize(self.sqlite_db) >= current_size)
+                n_skids += (get_used_size(self.sqlite_db) >= current_size)
             else:
                 break
         desc = f"SQLiteTable():\n  {self.sqlite_db}"
         if n_dropped:
             GeneFabLogger.info(f"{desc} shrunk by {n_dropped} entries")
-        elif path.getsize(self.sqlite_db) > self.maxdbsize:
+        elif get_used_size(self.sqlite_db) > self.maxdbsize:
             GeneFabLogger.warning(f"{desc} could not be shrunk")
         if n_skids:
             GeneFabLogger.warning(f"{desc} did not shrink {n_skids} times")
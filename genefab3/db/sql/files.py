@@ -1,9 +1,10 @@
 from genefab3.db.sql.core import SQLiteObject, SQLiteBlob, SQLiteTable
+from genefab3.db.sql.column_stats import SQLiteColumnStats
 from genefab3.common.exceptions import GeneFabLogger
 from requests import get as request_get
 from urllib.error import URLError
 from genefab3.common.exceptions import GeneFabDataManagerException
-from sqlite3 import Binary, OperationalError
+from sqlite3 import Binary, OperationalError, IntegrityError
 from datetime import datetime
 from genefab3.common.utils import as_is, random_unique_string
 from contextlib import contextmanager
@@ -146,9 +147,30 @@ class CachedTableFile(SQLiteTable):
                 msg = "Not recognized as a table file"
                 raise GeneFabFileException(msg, name=self.name, url=self.url)
  
+    def __extend_parts(self, connection, csv_chunk, bounds, chunksize, to_sql_kws, create_keyed):
+        """Insert `csv_chunk` into table parts, split by `bounds`; if `create_keyed`, first create parts keyed by index"""
+        parts = SQLiteObject.iterparts(self.table, connection, must_exist=0)
+        for bound, (partname, *_) in zip(bounds, parts):
+            bounded = csv_chunk.iloc[:,bound:bound+self.maxpartcols]
+            if create_keyed:
+                bounded.head(0).to_sql(
+                    partname, NoCommitConnection(connection), **to_sql_kws,
+                )
+                SQLiteObject.recreate_part(partname, connection, keyed=True)
+            bounded.to_sql(
+                partname, NoCommitConnection(connection),
+                **to_sql_kws, chunksize=chunksize,
+                method=ExecuteMany(partname, bounded.shape[1]),
+            )
+            msg = "Extended table for CachedTableFile"
+            GeneFabLogger.info(f"{msg}:\n  {self.name}, {partname}")
+ 
     def update(self, to_sql_kws=dict(index=True, if_exists="append"), chunksize=256, desc="tables/update"):
-        """Update `self.table` with result of `self.__download_as_pandas()`, update `self.aux_table` with timestamps"""
-        columns, width, bounds = None, None, None
+        """Update `self.table` with result of `self.__download_as_pandas()`, update `self.aux_table` with timestamps; parts are keyed by index unless it turns out not to be unique; per-column statistics are stored in catalog"""
+        columns, width, bounds, n_rows, keyed = None, None, None, 0, True
+        column_stats = SQLiteColumnStats(
+            table=self.table, aux_table=self.column_stats.aux_table,
+        )
         with self.sqltransactions.exclusive(desc) as (connection, execute):
             if self.is_stale(ignore_conflicts=True) is False:
                 return # data was updated while waiting to acquire lock
@@ -163,25 +185,42 @@ class CachedTableFile(SQLiteTable):
                         raise ValueError("Inconsistent chunk width")
                     if (csv_chunk.columns != columns).any():
                         raise ValueError("Inconsistent chunk column names")
-                    parts = SQLiteObject.iterparts(
-                        self.table, connection, must_exist=0,
-                    )
-                    for bound, (partname, *_) in zip(bounds, parts):
-                        bounded = csv_chunk.iloc[:,bound:bound+self.maxpartcols]
-                        bounded.to_sql(
-                            partname, NoCommitConnection(connection),
-                            **to_sql_kws, chunksize=chunksize,
-                            method=ExecuteMany(partname, bounded.shape[1]),
-                        )
-                        msg = "Extended table for CachedTableFile"
-                        GeneFabLogger.info(f"{msg}:\n  {self.name}, {partname}")
+                    _args = connection, csv_chunk, bounds, chunksize, to_sql_kws
+                    if keyed:
+                        execute("SAVEPOINT `extend`")
+                        try:
+                            self.__extend_parts(*_args, n_rows == 0)
+                        except IntegrityError:
+                            execute("ROLLBACK TO `extend`")
+                            msg = "Index not unique, storing table unkeyed"
+                            GeneFabLogger.info(f"{msg}:\n  {self.name}")
+                            _iterparts = SQLiteObject.iterparts
+                            for partname, *_ in list(
+                                _iterparts(self.table, connection),
+                            ):
+                                SQLiteObject.recreate_part(
+                                    partname, connection, keyed=False,
+                                )
+                            keyed = False
+                            self.__extend_parts(*_args, False)
+                        finally:
+                            execute("RELEASE `extend`")
+                    else:
+                        self.__extend_parts(*_args, False)
+                    n_rows += csv_chunk.shape[0]
+                    column_stats.update(csv_chunk)
                 except (OperationalError, PandasDatabaseError, ValueError) as e:
                     msg = "Failed to insert SQL chunk or chunk part"
                     _kw = dict(name=self.name, debug_info=repr(e))
                     raise GeneFabDatabaseException(msg, **_kw)
             execute(f"""INSERT INTO `{self.aux_table}`
-                (`table`,`timestamp`,`retrieved_at`) VALUES(?,?,?)""", [
+                (`table`,`timestamp`,`retrieved_at`,`n_rows`,`keyed`)
+                VALUES(?,?,?,?,?)""", [
                 self.table, self.timestamp, int(datetime.now().timestamp()),
+                n_rows, int(keyed),
             ])
+            column_stats.store(
+                connection, list(SQLiteObject.iterparts(self.table, connection)),
+            )
             msg = "Finished extending; all parts inserted for CachedTableFile"
             GeneFabLogger.info(f"{msg}:\n  {self.name}\n  {self.table}")
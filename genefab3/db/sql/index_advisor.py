@@ -0,0 +1,161 @@
+from genefab3.common.utils import validate_no_backtick
+from genefab3.common.exceptions import GeneFabLogger, GeneFabDatabaseException
+from threading import Thread, Lock
+from collections import Counter
+from time import monotonic
+from datetime import datetime
+from math import inf
+from operator import eq
+from sqlite3 import OperationalError
+
+
+INDEX_ADVISOR_FLUSH_INTERVAL = 60 # seconds between flushing hit counts
+INDEX_ADVISOR_BUILD_TIMEOUT = 10 # seconds an index build may hold write lock
+
+
+class SQLiteIndexAdvisorHitCounter():
+    """Counts data comparisons per column of table parts in memory of each worker process, to be flushed to index advisor tables in batches"""
+ 
+    def __init__(self, flush_interval=INDEX_ADVISOR_FLUSH_INTERVAL):
+        self.flush_interval = flush_interval
+        self._counts, self._flushed_at = Counter(), {}
+        self._lock = Lock()
+ 
+    def count(self, sqlite_db, aux_table, table, part, column, index_name):
+        """Count comparison; if `self.flush_interval` has passed since last flush for (`sqlite_db`, `aux_table`), drain and return its counts as list of (table, part, column, index_name, count), otherwise return None"""
+        with self._lock:
+            key = (sqlite_db, aux_table, table, part, column, index_name)
+            self._counts[key] += 1
+            flushed_at = self._flushed_at.setdefault(
+                (sqlite_db, aux_table), monotonic(),
+            )
+            if monotonic() - flushed_at >= self.flush_interval:
+                return self._drain(sqlite_db, aux_table)
+            else:
+                return None
+ 
+    def _drain(self, sqlite_db, aux_table):
+        """Return and forget counts for (`sqlite_db`, `aux_table`); caller holds lock"""
+        batch = [
+            (*key[2:], n) for key, n in list(self._counts.items())
+            if key[:2] == (sqlite_db, aux_table)
+        ]
+        for *key, _ in batch:
+            del self._counts[(sqlite_db, aux_table, *key)]
+        self._flushed_at[(sqlite_db, aux_table)] = monotonic()
+        return batch
+
+
+INDEX_ADVISOR_HIT_COUNTER = SQLiteIndexAdvisorHitCounter()
+
+
+class SQLiteIndexAdvisor():
+    """Counts data comparisons per column of table parts; once a column has been filtered on `min_hits` times, builds an index on it in the background"""
+    schema = {
+        "table": "TEXT", "part": "TEXT", "column": "TEXT",
+        "hits": "INTEGER", "indexed_at": "INTEGER",
+        "refused_at_maxsize": "INTEGER", "refused_at_timeout": "INTEGER",
+    }
+ 
+    def __init__(self, *, sqltransactions, table, aux_table="AUX:index_advisor", min_hits=5, maxdbsize=None, build_timeout=INDEX_ADVISOR_BUILD_TIMEOUT):
+        """Retain settings; the schema of `aux_table` is ensured by SQLiteTable; only unconditional transactions are used, as neither counts nor indexes change the data seen by readers; these still hold SQLite's write lock, blocking other writers, so an index build is abandoned after `build_timeout` seconds"""
+        self.sqltransactions = sqltransactions
+        self.table, self.aux_table = table, aux_table
+        self.min_hits, self.maxdbsize = min_hits, maxdbsize or inf
+        self.build_timeout = build_timeout
+ 
+    @staticmethod
+    def index_of(part, column):
+        """Name of index built by SQLiteIndexAdvisor on `column` of `part`"""
+        return f"INDEX:{part}/{column}"
+ 
+    def record(self, part, column, index_name):
+        """Count data comparison on `column` of `part` in memory; once in a while, flush counts of this process in a parallel thread, which also builds indexes if warranted"""
+        validate_no_backtick(part, "table_part")
+        validate_no_backtick(column, "column")
+        batch = INDEX_ADVISOR_HIT_COUNTER.count(
+            self.sqltransactions.sqlite_db, self.aux_table,
+            self.table, part, column, index_name,
+        )
+        if batch:
+            Thread(target=self.flush, kwargs={"batch": batch}).start()
+ 
+    def flush(self, *, batch, desc="tables/index_advisor/flush"):
+        """Add hit counts in `batch` (list of (table, part, column, index_name, count)), build indexes on columns that reached `self.min_hits`, unless they were refused under the current `self.maxdbsize` or `self.build_timeout`"""
+        where = "WHERE `table` == ? AND `part` == ? AND `column` == ?"
+        to_build = []
+        try:
+            with self.sqltransactions.unconditional(desc) as (_, execute):
+                for table, part, column, index_name, n in batch:
+                    args = [table, part, column]
+                    cursor = execute(f"""UPDATE `{self.aux_table}`
+                        SET `hits` = `hits` + ? {where}""", [n, *args])
+                    if cursor.rowcount == 0:
+                        execute(f"""INSERT INTO `{self.aux_table}`
+                            (`table`,`part`,`column`,`hits`,`indexed_at`)
+                            VALUES(?,?,?,?,NULL)""", [*args, n])
+                    hits, indexed_at, *refused_at = execute(f"""SELECT
+                        `hits`,`indexed_at`,
+                        `refused_at_maxsize`,`refused_at_timeout`
+                        FROM `{self.aux_table}` {where}""", args).fetchone()
+                    refused = any(map(eq, refused_at, [
+                        self.maxdbsize, self.build_timeout,
+                    ]))
+                    if (indexed_at is None) and (hits >= self.min_hits):
+                        if not refused:
+                            to_build.append((table, part, column, index_name))
+        except GeneFabDatabaseException as e:
+            msg = f"{desc}: could not record {len(batch)} comparison(s)"
+            GeneFabLogger.warning(msg, exc_info=e)
+        else:
+            for table, part, column, index_name in to_build:
+                self.build(part, column, index_name, table=table)
+ 
+    def build(self, part, column, index_name, table=None, desc="tables/index_advisor/build"):
+        """Create index on (`column`, `index_name`) of `part`, unless doing so would grow database past `self.maxdbsize` or take longer than `self.build_timeout` seconds (during which other writers wait), in which case the refusal is recorded, so that the index is not attempted again until the respective setting changes"""
+        index = validate_no_backtick(self.index_of(part, column), "index")
+        where = "WHERE `table` == ? AND `part` == ? AND `column` == ?"
+        args = [table or self.table, part, column]
+        deadline = monotonic() + self.build_timeout
+        try:
+            _transaction = self.sqltransactions.unconditional
+            with _transaction(desc) as (connection, execute):
+                connection.set_progress_handler( # interrupts CREATE INDEX
+                    lambda: monotonic() > deadline, 10000,
+                )
+                try:
+                    execute(f"""CREATE INDEX IF NOT EXISTS `{index}`
+                        ON `{part}` (`{column}`, `{index_name}`)""")
+                except OperationalError as e:
+                    if "interrupted" not in str(e):
+                        raise
+                    refusal = "refused_at_timeout", self.build_timeout
+                else:
+                    page_count = execute("PRAGMA page_count").fetchone()[0]
+                    page_size = execute("PRAGMA page_size").fetchone()[0]
+                    if page_count * page_size > self.maxdbsize:
+                        refusal = "refused_at_maxsize", self.maxdbsize
+                    else:
+                        refusal = None
+                connection.set_progress_handler(None, 0)
+                if refusal is None:
+                    indexed_at = int(datetime.now().timestamp())
+                    execute(f"""UPDATE `{self.aux_table}`
+                        SET `indexed_at` = ? {where}""", [indexed_at, *args])
+                    GeneFabLogger.info(f"{desc}: created {index}")
+                else:
+                    connection.rollback()
+                    field, value = refusal
+                    execute(f"""UPDATE `{self.aux_table}`
+                        SET `{field}` = ? {where}""", [value, *args])
+                    msg = f"{desc}: not building {index}, {field} = {value}"
+                    GeneFabLogger.info(msg)
+        except GeneFabDatabaseException as e:
+            msg = f"{desc}: could not create {index}"
+            GeneFabLogger.warning(msg, exc_info=e)
+ 
+    def drop(self, *, connection, other=None):
+        """During an open connection, forget comparison counts for `self.table` (or `other`); indexes themselves are dropped together with table parts"""
+        table = other or self.table
+        connection.execute(f"""DELETE FROM `{self.aux_table}`
+            WHERE `table` == "{table}" """)
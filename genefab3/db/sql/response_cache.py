@@ -1,33 +1,206 @@
 from genefab3.common.exceptions import GeneFabLogger
-from genefab3.db.sql.utils import SQLTransactions
+from genefab3.db.sql.utils import SQLTransactions, ensure_table_schema
+from genefab3.db.sql.utils import get_used_size
 from functools import wraps
 from genefab3.common.types import ResponseContainer
 from flask import Response
 from collections.abc import Callable
 from zlib import compressobj, decompressobj, Z_FINISH, error as ZlibError
-from sqlite3 import Binary, OperationalError
+from zlib import crc32, decompress
+from codecs import getincrementaldecoder
+from sqlite3 import Binary, OperationalError, DatabaseError
 from datetime import datetime
-from threading import Thread
+from threading import Thread, Lock
+from time import monotonic
 from genefab3.common.hacks import apply_hack, bypass_uncached_views
-from os import path
+from genefab3.common.exceptions import GeneFabDatabaseException
+from os import stat, replace, getpid
+from tempfile import SpooledTemporaryFile
+from collections import OrderedDict, Counter
+from json import dumps, loads
+from itertools import chain, islice
+from genefab3.common.utils import random_unique_string
 
 
-RESPONSE_CACHE_SCHEMAS = (
-    ("response_cache", """(
-        `context_identity` TEXT, `i` INTEGER, `chunk` BLOB,
-        `mimetype` TEXT, `retrieved_at` INTEGER
-    )"""),
-    ("accessions_used", """(
-        `context_identity` TEXT, `accession` TEXT
-    )"""),
-)
+RESPONSE_CACHE_SCHEMA_VERSION = 4 # stored in database as PRAGMA user_version
+
+RESPONSE_CACHE_SCHEMAS = {
+    "response_cache": {
+        "context_identity": "TEXT", "i": "INTEGER", "chunk": "BLOB",
+    },
+    "accessions_used": {"context_identity": "TEXT", "accession": "TEXT"},
+    "response_cache_headers": {
+        "context_identity": "TEXT PRIMARY KEY", "mimetype": "TEXT",
+        "n_chunks": "INTEGER", "length": "INTEGER", "checksum": "INTEGER",
+        "encoding": "TEXT", "headers": "TEXT", "query": "TEXT",
+        "unwind": "TEXT", "canonical_identity": "TEXT",
+        "retrieved_at": "INTEGER",
+    },
+    "response_cache_requests": {
+        "context_identity": "TEXT PRIMARY KEY", "url_root": "TEXT",
+        "full_path": "TEXT", "n_requests": "INTEGER",
+        "last_requested_at": "INTEGER",
+    },
+}
+
+RESPONSE_CACHE_INDEXES = { # name: (table, columns, unique)
+    "ix_response_cache_context_identity_i": (
+        "response_cache", ["context_identity", "i"], True,
+    ),
+    "ix_accessions_used_context_identity_accession": (
+        "accessions_used", ["context_identity", "accession"], True,
+    ),
+    "ix_accessions_used_accession_context_identity": (
+        "accessions_used", ["accession", "context_identity"], False,
+    ),
+    "ix_response_cache_headers_retrieved_at": (
+        "response_cache_headers", ["retrieved_at"], False,
+    ),
+}
+
+RESPONSE_CACHE_ENCODING = "gzip" # servable to clients as Content-Encoding
+RESPONSE_CACHE_FRAME_SIZE = 65536
+RESPONSE_CACHE_SPOOL_SIZE = 16777216 # compressed bytes kept in memory per put
+RESPONSE_CACHE_HOT_TIER_SIZE = 67108864 # compressed bytes per worker process
+RESPONSE_CACHE_HOT_TIER_ENTRY_SIZE = 1048576 # larger responses skip hot tier
+RESPONSE_CACHE_REQUESTS_FLUSH_INTERVAL = 60 # seconds between flushing counts
+RESPONSE_CACHE_REQUESTS_TTL = 604800 # forget identities unrequested for a week
+RESPONSE_CACHE_TEXT_MIMETYPES = {"text/plain", "text/html", "application/json"}
 
 _logi, _logw = GeneFabLogger.info, GeneFabLogger.warning
 _loge = GeneFabLogger.error
 
 
+class ResponseCacheHotTier():
+    """Byte-bounded in-process LRU of small compressed responses, keyed by SQLite cache file and context.identity; invalidated across worker processes via a generation file next to the SQLite cache, replaced whenever responses are dropped from it"""
+ 
+    def __init__(self, maxsize=RESPONSE_CACHE_HOT_TIER_SIZE, max_entry_size=RESPONSE_CACHE_HOT_TIER_ENTRY_SIZE):
+        self.maxsize, self.max_entry_size = maxsize, max_entry_size
+        self._entries, self._generations, self.size = OrderedDict(), {}, 0
+        self.hits, self.misses, self.evictions = 0, 0, 0
+        self._lock = Lock()
+ 
+    def generation(self, sqlite_db):
+        """Identify current generation of SQLite cache by inode and mtime of its generation file (one stat, no read)"""
+        try:
+            st = stat(f"{sqlite_db}.generation")
+        except FileNotFoundError:
+            return None
+        else:
+            return st.st_ino, st.st_mtime_ns
+ 
+    def bump(self, sqlite_db):
+        """Atomically replace generation file of SQLite cache, invalidating hot tiers of all processes that use it"""
+        filename = f"{sqlite_db}.generation"
+        tempfile = f"{filename}.{getpid()}-{random_unique_string()}"
+        with open(tempfile, mode="w") as handle:
+            handle.write(random_unique_string())
+        replace(tempfile, filename)
+        self._sync(sqlite_db, self.generation(sqlite_db))
+ 
+    def _sync(self, sqlite_db, generation):
+        """Under lock, forget entries of `sqlite_db` if they belong to a different generation; return True if generation had changed"""
+        if self._generations.get(sqlite_db, generation) == generation:
+            self._generations[sqlite_db] = generation
+            return False
+        else:
+            for key in [k for k in self._entries if k[0] == sqlite_db]:
+                self.size -= len(self._entries.pop(key)[1])
+            self._generations[sqlite_db] = generation
+            return True
+ 
+    def get(self, sqlite_db, identity):
+        """Return (mimetype, gzip-compressed bytes, extra headers) if present and current, otherwise None; count hits and misses"""
+        generation = self.generation(sqlite_db)
+        with self._lock:
+            self._sync(sqlite_db, generation)
+            entry = self._entries.get((sqlite_db, identity))
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._entries.move_to_end((sqlite_db, identity))
+            return entry
+ 
+    def put(self, sqlite_db, identity, mimetype, data, headers, generation):
+        """Store gzip-compressed `data` and extra `headers` unless too large or SQLite cache generation changed since `generation` was observed; evict least recently used entries to stay under `self.maxsize`"""
+        if len(data) > self.max_entry_size:
+            return
+        with self._lock:
+            if self._sync(sqlite_db, self.generation(sqlite_db)):
+                return
+            elif self._generations.get(sqlite_db) != generation:
+                return
+            previous = self._entries.pop((sqlite_db, identity), None)
+            if previous is not None:
+                self.size -= len(previous[1])
+            self._entries[(sqlite_db, identity)] = (mimetype, data, headers)
+            self.size += len(data)
+            while self.size > self.maxsize:
+                _, (_, evicted, _) = self._entries.popitem(last=False)
+                self.size -= len(evicted)
+                self.evictions += 1
+ 
+    def report(self):
+        """Summarize counters and occupancy of hot tier of current process"""
+        with self._lock:
+            return dict(
+                pid=getpid(), hits=self.hits, misses=self.misses,
+                evictions=self.evictions, entries=len(self._entries),
+                size=self.size, maxsize=self.maxsize,
+            )
+
+
+RESPONSE_CACHE_HOT_TIER = ResponseCacheHotTier()
+
+
+class ResponseCacheRequestCounter():
+    """Counts requests of cacheable responses by SQLite cache file and context.identity in memory of each worker process, to be flushed to response_cache_requests table in batches"""
+ 
+    def __init__(self, flush_interval=RESPONSE_CACHE_REQUESTS_FLUSH_INTERVAL):
+        self.flush_interval = flush_interval
+        self._counts, self._full_paths, self._flushed_at = Counter(), {}, {}
+        self._lock = Lock()
+ 
+    def count(self, sqlite_db, identity, url_root, full_path):
+        """Count request; if `self.flush_interval` has passed since last flush for `sqlite_db`, drain and return its counts as list of (identity, URL root, full path, count), otherwise return None"""
+        with self._lock:
+            self._counts[(sqlite_db, identity)] += 1
+            self._full_paths[(sqlite_db, identity)] = url_root, full_path
+            flushed_at = self._flushed_at.setdefault(sqlite_db, monotonic())
+            if monotonic() - flushed_at >= self.flush_interval:
+                return self._drain(sqlite_db)
+            else:
+                return None
+ 
+    def drain(self, sqlite_db):
+        """Return and forget counts for `sqlite_db` as list of (identity, URL root, full path, count)"""
+        with self._lock:
+            return self._drain(sqlite_db)
+ 
+    def _drain(self, sqlite_db):
+        """Return and forget counts for `sqlite_db`; caller holds lock"""
+        batch = [
+            (identity, *self._full_paths.pop((db, identity)), n)
+            for (db, identity), n in list(self._counts.items())
+            if db == sqlite_db
+        ]
+        for identity, *_ in batch:
+            del self._counts[(sqlite_db, identity)]
+        self._flushed_at[sqlite_db] = monotonic()
+        return batch
+
+
+RESPONSE_CACHE_REQUEST_COUNTER = ResponseCacheRequestCounter()
+
+
+class BinaryPassthroughDecoder():
+    """Stands in for incremental UTF-8 decoder for responses in binary formats, which are served as bytes"""
+    def decode(self, data, final=False): return data
+
+
 class ResponseCache():
-    """LRU response cache; responses are identified by context.identity, dropped if underlying (meta)data changed"""
+    """LRU response cache; responses are identified by context.identity (digest of context.canonical_identity, which is stored once per response for debugging), dropped if underlying (meta)data changed; small responses are also kept in RESPONSE_CACHE_HOT_TIER of each worker process"""
  
     def __init__(self, sqlite_dbs):
         self.sqlite_db = sqlite_dbs.response_cache["db"]
@@ -37,16 +210,60 @@ class ResponseCache():
             _logw(f"ResponseCache():\n  {msg}")
         else:
             self.sqltransactions = SQLTransactions(self.sqlite_db)
-            desc = "response_cache/ensure_schema"
-            with self.sqltransactions.concurrent(desc) as (_, execute):
-                for table, schema in RESPONSE_CACHE_SCHEMAS:
-                    execute(f"CREATE TABLE IF NOT EXISTS `{table}` {schema}")
+            self._ensure_schema()
  
     bypass_if_disabled = lambda f: wraps(f)(lambda self, *args, **kwargs:
         ResponseContainer(content=None) if self.sqlite_db is None
         else f(self, *args, **kwargs)
     )
  
+    def _ensure_schema(self, desc="response_cache/ensure_schema"):
+        """Create or migrate tables and indexes in place if PRAGMA user_version of database is behind RESPONSE_CACHE_SCHEMA_VERSION; otherwise only read version"""
+        with self.sqltransactions.concurrent(desc) as (_, execute):
+            version = execute("PRAGMA user_version").fetchone()[0]
+        if version < RESPONSE_CACHE_SCHEMA_VERSION:
+            with self.sqltransactions.exclusive(desc) as (_, execute):
+                version = execute("PRAGMA user_version").fetchone()[0]
+                if version < RESPONSE_CACHE_SCHEMA_VERSION:
+                    self._migrate_schema(execute, version)
+        elif version > RESPONSE_CACHE_SCHEMA_VERSION:
+            msg = f"schema version {version} is newer than expected"
+            _logw(f"ResponseCache():\n  {msg}, {self.sqlite_db}")
+ 
+    def _migrate_schema(self, execute, version):
+        """During an open exclusive transaction, bring schema from `version` to RESPONSE_CACHE_SCHEMA_VERSION: ensure tables and columns; move timestamps from chunk rows to headers; drop chunks without headers (written by previous versions, not readable by `get()`) and duplicate accession links; create indexes"""
+        tables = {t for t, *_ in execute("""SELECT `name` FROM `sqlite_master`
+            WHERE `type` == 'table'""")}
+        legacy_chunks = ("response_cache" in tables) and any(
+            f == "retrieved_at" for _, f, *_ in
+            execute("PRAGMA table_info(`response_cache`)")
+        )
+        for table, schema in RESPONSE_CACHE_SCHEMAS.items():
+            ensure_table_schema(execute, table, schema)
+        if legacy_chunks:
+            execute("""UPDATE `response_cache_headers` SET `retrieved_at` = (
+                SELECT MIN(`retrieved_at`) FROM `response_cache`
+                WHERE `response_cache`.`context_identity` ==
+                `response_cache_headers`.`context_identity`)
+                WHERE `retrieved_at` IS NULL""")
+        execute("""DELETE FROM `response_cache_headers`
+            WHERE `retrieved_at` IS NULL""")
+        execute("""DELETE FROM `response_cache` WHERE `context_identity`
+            NOT IN (SELECT `context_identity` FROM `response_cache_headers`)""")
+        execute("""DELETE FROM `accessions_used` WHERE `context_identity`
+            NOT IN (SELECT `context_identity` FROM `response_cache_headers`)""")
+        execute("""DELETE FROM `accessions_used` WHERE `rowid` NOT IN (
+            SELECT MIN(`rowid`) FROM `accessions_used`
+            GROUP BY `context_identity`, `accession`)""")
+        for index, (table, columns, unique) in RESPONSE_CACHE_INDEXES.items():
+            execute("CREATE {}INDEX IF NOT EXISTS `{}` ON `{}` ({})".format(
+                "UNIQUE " if unique else "", index, table,
+                ",".join(f"`{c}`" for c in columns),
+            ))
+        execute(f"PRAGMA user_version = {RESPONSE_CACHE_SCHEMA_VERSION}")
+        msg = f"migrated schema from version {version}"
+        _logi(f"ResponseCache():\n  {msg} to {RESPONSE_CACHE_SCHEMA_VERSION}")
+ 
     def _validate_content_type(self, response_container):
         """Check if type of passed content is supported by ResponseCache"""
         _is = lambda _type: isinstance(response_container.content, _type)
@@ -57,62 +274,176 @@ class ResponseCache():
         else:
             return None
  
-    def _itercompress(self, content, isinstance=isinstance, str=str, bytes=bytes, Binary=Binary):
-        """Iteratively compress chunks generated by callable `content`"""
-        compressor = compressobj()
+    def _tee(self, content, spool, header, frame_size=RESPONSE_CACHE_FRAME_SIZE, isinstance=isinstance, str=str, bytes=bytes, crc32=crc32, len=len):
+        """Yield chunks generated by callable `content` as-is, while compressing them into a single gzip stream written to `spool` in frames of `frame_size` bytes (the last one may be shorter); accumulate number of frames, length and checksum of written bytes in `header`; stop teeing if a chunk is not str or bytes"""
+        compressor, buffer = compressobj(wbits=31), bytearray()
+        def _write_frames(final=False):
+            while (len(buffer) >= frame_size) or (final and buffer):
+                frame = bytes(buffer[:frame_size])
+                del buffer[:frame_size]
+                header["n_chunks"] += 1
+                header["length"] += len(frame)
+                header["checksum"] = crc32(frame, header["checksum"])
+                spool.write(frame)
         for uncompressed_chunk in content():
-            if isinstance(uncompressed_chunk, str):
-                chunk = compressor.compress(uncompressed_chunk.encode())
+            if header["problem"]:
+                pass
+            elif isinstance(uncompressed_chunk, str):
+                buffer += compressor.compress(uncompressed_chunk.encode())
+                _write_frames()
             elif isinstance(uncompressed_chunk, bytes):
-                chunk = compressor.compress(uncompressed_chunk)
+                buffer += compressor.compress(uncompressed_chunk)
+                _write_frames()
             else:
                 _type = type(uncompressed_chunk).__name__
-                raise TypeError("Content chunk is not str or bytes", _type)
-            if chunk:
-                yield Binary(chunk)
-        chunk = compressor.flush(Z_FINISH)
-        if chunk:
-            yield Binary(chunk)
+                header["problem"] = f"content chunk is {_type}, not str/bytes"
+            yield uncompressed_chunk
+        buffer += compressor.flush(Z_FINISH)
+        _write_frames(final=True)
  
     @bypass_if_disabled
     def put(self, response_container, context):
-        """Store response object blob in response_cache table, if possible; this will happen in a parallel thread"""
+        """Tee content of `response_container` as it is streamed to client, compressing it into a spool (in memory up to RESPONSE_CACHE_SPOOL_SIZE, then in a temporary file); once streamed completely, store it in response_cache table, together with extra headers of `response_container` (such as link to next page), in a parallel thread"""
         problem = self._validate_content_type(response_container)
         if problem:
             msg = f"{context.identity}\n  {problem}"
             _logw(f"ResponseCache(), did not store:\n  {msg}")
             return
-        def _put(desc="response_cache/put"):
-            retrieved_at = int(datetime.now().timestamp())
+        self._count_request(context)
+        content = response_container.content
+        mimetype = response_container.mimetype
+        accessions = response_container.obj.accessions
+        headers = dumps(response_container.headers or {}, sort_keys=True)
+        try:
+            query = dumps(context.query, sort_keys=True)
+            unwind = dumps(sorted(context.unwind))
+        except (AttributeError, TypeError): # will be invalidated conservatively
+            query, unwind = None, None
+        generation = RESPONSE_CACHE_HOT_TIER.generation(self.sqlite_db)
+        def _teed_content():
+            spool = SpooledTemporaryFile(max_size=RESPONSE_CACHE_SPOOL_SIZE)
+            header = dict(n_chunks=0, length=0, checksum=0, problem=None)
+            try:
+                yield from self._tee(content, spool, header)
+            except BaseException: # incl. GeneratorExit when client disconnects
+                spool.close()
+                raise
+            if header["problem"]:
+                msg = f"{context.identity}\n  {header['problem']}"
+                _logw(f"ResponseCache(), did not store:\n  {msg}")
+                spool.close()
+            else:
+                _kw = dict(
+                    context_identity=context.identity, mimetype=mimetype,
+                    headers=headers, accessions=accessions, spool=spool,
+                    header=header,
+                    query=query, unwind=unwind, generation=generation,
+                    canonical_identity=getattr(
+                        context, "canonical_identity", None,
+                    ),
+                )
+                Thread(target=self._store, kwargs=_kw).start()
+        response_container.content = _teed_content
+ 
+    def _store(self, *, context_identity, mimetype, headers, accessions, spool, header, query, unwind, generation, canonical_identity, frame_size=RESPONSE_CACHE_FRAME_SIZE, desc="response_cache/put"):
+        """Insert compressed frames from `spool`, their header (with extra response headers as JSON) and metadata query that produced them into response_cache tables in one short transaction; then put small responses into hot tier, unless SQLite cache generation changed since `generation`"""
+        retrieved_at = int(datetime.now().timestamp())
+        try:
+            spool.seek(0)
             with self.sqltransactions.exclusive(desc) as (_, execute):
                 try:
-                    execute("""DELETE FROM `response_cache` WHERE
-                        `context_identity` == ?""", [context.identity])
-                    _it = self._itercompress
-                    for i, chunk in enumerate(_it(response_container.content)):
+                    self._drop_by_context_identity(execute, context_identity)
+                    for i in range(header["n_chunks"]):
                         execute("""INSERT INTO `response_cache`
-                            (context_identity, i, chunk, mimetype, retrieved_at)
-                            VALUES (?,?,?,?,?)""", [context.identity, i, chunk,
-                            response_container.mimetype, retrieved_at])
-                    for accession in response_container.obj.accessions:
-                        execute("""DELETE FROM `accessions_used` WHERE
-                            `accession` == ? AND `context_identity` == ?""", [
-                            accession, context.identity])
+                            (context_identity, i, chunk) VALUES (?,?,?)""", [
+                            context_identity, i,
+                            Binary(spool.read(frame_size))])
+                    execute("""INSERT INTO `response_cache_headers`
+                        (context_identity, mimetype, n_chunks, length, checksum,
+                        encoding, headers, query, unwind, canonical_identity,
+                        retrieved_at) VALUES (?,?,?,?,?,?,?,?,?,?,?)""", [
+                        context_identity, mimetype, header["n_chunks"],
+                        header["length"], header["checksum"],
+                        RESPONSE_CACHE_ENCODING, headers, query, unwind,
+                        canonical_identity, retrieved_at])
+                    for accession in accessions:
                         execute("""INSERT INTO `accessions_used`
                             (accession, context_identity) VALUES (?, ?)""", [
-                            accession, context.identity])
-                except (OperationalError, ZlibError, TypeError) as e:
-                    msg = f"{context.identity}, {e!r}"
+                            accession, context_identity])
+                except OperationalError as e:
+                    msg = f"{context_identity}, {e!r}"
                     _loge(f"ResponseCache(), could not store:\n  {msg}")
                     raise
                 else:
-                    _logi(f"ResponseCache(), stored:\n  {context.identity}")
-        Thread(target=_put).start()
+                    _logi(f"ResponseCache(), stored:\n  {context_identity}")
+            if header["length"] <= RESPONSE_CACHE_HOT_TIER.max_entry_size:
+                spool.seek(0)
+                RESPONSE_CACHE_HOT_TIER.put(
+                    self.sqlite_db, context_identity, mimetype, spool.read(),
+                    loads(headers), generation,
+                )
+        finally:
+            spool.close()
+ 
+    def _count_request(self, context):
+        """Count request of cacheable response by context.identity (along with URL root and path to replay it, if it is a GET request), flushing counts of this process in a parallel thread once in a while; requests replayed to warm up the cache are not counted, so that they do not feed their own popularity"""
+        if getattr(context, "is_warmup", False):
+            return
+        elif getattr(context, "method", "GET") == "GET":
+            url_root = getattr(context, "url_root", None)
+            full_path = getattr(context, "full_path", None)
+        else:
+            url_root, full_path = None, None
+        batch = RESPONSE_CACHE_REQUEST_COUNTER.count(
+            self.sqlite_db, context.identity, url_root, full_path,
+        )
+        if batch:
+            Thread(target=self.flush_requests, kwargs={"batch": batch}).start()
+ 
+    @bypass_if_disabled
+    def flush_requests(self, batch=None, desc="response_cache/flush_requests"):
+        """Add request counts of this process (or `batch`) to response_cache_requests table, forget identities not requested for RESPONSE_CACHE_REQUESTS_TTL seconds"""
+        if batch is None:
+            batch = RESPONSE_CACHE_REQUEST_COUNTER.drain(self.sqlite_db)
+        now = int(datetime.now().timestamp())
+        with self.sqltransactions.exclusive(desc) as (connection, execute):
+            try:
+                connection.executemany("""INSERT INTO `response_cache_requests`
+                    (context_identity, url_root, full_path, n_requests,
+                    last_requested_at) VALUES (?,?,?,?,?)
+                    ON CONFLICT(context_identity) DO UPDATE
+                    SET `n_requests` = `n_requests` + excluded.`n_requests`,
+                    `url_root` = excluded.`url_root`,
+                    `full_path` = excluded.`full_path`,
+                    `last_requested_at` = excluded.`last_requested_at`""", [
+                    (identity, url_root, full_path, n, now)
+                    for identity, url_root, full_path, n in batch
+                ])
+                execute("""DELETE FROM `response_cache_requests`
+                    WHERE `last_requested_at` < ?""", [
+                    now - RESPONSE_CACHE_REQUESTS_TTL])
+            except OperationalError as e:
+                _logw(f"ResponseCache(), could not count requests:\n  {e!r}")
+ 
+    @bypass_if_disabled
+    def get_most_requested(self, n, desc="response_cache/get_most_requested"):
+        """List URL roots and paths of up to `n` most requested GET requests whose responses are not currently cached, as (url_root, full_path)"""
+        with self.sqltransactions.concurrent(desc) as (_, execute):
+            query = """SELECT `r`.`url_root`, `r`.`full_path`
+                FROM `response_cache_requests` AS `r`
+                LEFT JOIN `response_cache_headers` AS `h`
+                ON `r`.`context_identity` == `h`.`context_identity`
+                WHERE `h`.`context_identity` IS NULL
+                AND `r`.`url_root` IS NOT NULL AND `r`.`full_path` IS NOT NULL
+                ORDER BY `r`.`n_requests` DESC LIMIT ?"""
+            return execute(query, [n]).fetchall()
  
     def _drop_by_context_identity(self, execute, context_identity):
         """Drop responses with given context.identity"""
         execute("""DELETE FROM `accessions_used`
             WHERE `context_identity` == ?""", [context_identity])
+        execute("""DELETE FROM `response_cache_headers`
+            WHERE `context_identity` == ?""", [context_identity])
         execute("""DELETE FROM `response_cache`
             WHERE `context_identity` == ?""", [context_identity])
  
@@ -133,6 +464,55 @@ class ResponseCache():
             else:
                 msg = "ResponseCache():\n  dropped %s cached response(s) for %s"
                 _logi(msg, len(identity_entries), accession)
+        if identity_entries:
+            RESPONSE_CACHE_HOT_TIER.bump(self.sqlite_db)
+ 
+    @bypass_if_disabled
+    def drop_affected(self, accessions, query_matches, desc="response_cache/drop_affected"):
+        """Drop responses that used any of `accessions`, and responses whose stored metadata query may now match documents of `accessions`, i.e. for which `query_matches(query=..., unwind=...)` is True; responses without stored query, or stored while queries were being evaluated, are dropped conservatively; return number of dropped responses"""
+        with self.sqltransactions.concurrent(desc) as (_, execute):
+            stored = execute("""SELECT DISTINCT `query`,`unwind`
+                FROM `response_cache_headers`""").fetchall()
+        matching = set()
+        for query, unwind in stored:
+            if (query is None) or (unwind is None):
+                matching.add((query, unwind))
+                continue
+            try:
+                _kw = dict(query=loads(query), unwind=loads(unwind))
+                if query_matches(**_kw):
+                    matching.add((query, unwind))
+            except Exception as e:
+                msg = f"could not evaluate, will drop:\n  {query}, {e!r}"
+                _logw(f"ResponseCache(): {msg}")
+                matching.add((query, unwind))
+        evaluated = set(stored) - matching
+        with self.sqltransactions.exclusive(desc) as (_, execute):
+            try:
+                query = """SELECT `context_identity` FROM `accessions_used`
+                    WHERE `accession` == ?"""
+                to_drop = {
+                    cid for accession in accessions
+                    for cid, *_ in execute(query, [accession])
+                }
+                to_drop.update(
+                    cid for cid, query, unwind in execute("""SELECT
+                        `context_identity`,`query`,`unwind`
+                        FROM `response_cache_headers`""")
+                    if (query, unwind) not in evaluated
+                )
+                for context_identity in to_drop:
+                    self._drop_by_context_identity(execute, context_identity)
+            except OperationalError as e:
+                msg = "ResponseCache():\n  could not drop responses for %s: %s"
+                _loge(msg, sorted(accessions), repr(e))
+                raise
+            else:
+                msg = "ResponseCache():\n  dropped %s cached response(s) for %s"
+                _logi(msg, len(to_drop), ", ".join(sorted(accessions)))
+        if to_drop:
+            RESPONSE_CACHE_HOT_TIER.bump(self.sqlite_db)
+        return len(to_drop)
  
     @bypass_if_disabled
     def drop_all(self, desc="response_cache/drop_all"):
@@ -140,71 +520,137 @@ class ResponseCache():
         with self.sqltransactions.exclusive(desc) as (_, execute):
             try:
                 execute("DELETE FROM `accessions_used`")
+                execute("DELETE FROM `response_cache_headers`")
                 execute("DELETE FROM `response_cache`")
             except OperationalError as e:
                 _loge(f"ResponseCache().drop_all():\n  failed with {e!r}")
                 raise
             else:
                 _logi("ResponseCache():\n  dropped all cached Flask responses")
+        RESPONSE_CACHE_HOT_TIER.bump(self.sqlite_db)
  
-    def _iterdecompress(self, cid, desc="response_cache/_iterdecompress"):
-        """Iteratively decompress chunks retrieved from database by `context_identity`"""
-        decompressor = decompressobj()
+    def _iterframes(self, cid, accept_encodings=(), generation=None, desc="response_cache/_iterframes"):
+        """Iterate frames retrieved from database by `context_identity` in a single read transaction, yielding mimetype, content encoding and extra headers first; frames are passed through as-is if client accepts their encoding, otherwise decompressed; verify number of frames, length and checksum of stored bytes against header stored by `put()` as they stream; drop response and abort stream if they do not match or cannot be read; promote small verified responses to hot tier"""
+        n_chunks, length, checksum, problem = 0, 0, 0, None
+        hot_frames = None
         with self.sqltransactions.concurrent(desc) as (_, execute):
-            query = """SELECT `mimetype` FROM `response_cache`
-                WHERE `context_identity` == ? LIMIT 1"""
-            mimetype, = execute(query, [cid]).fetchone() or [None]
-            if mimetype is None:
-                raise EOFError("No chunks found in response_cache")
+            query = """SELECT `mimetype`,`encoding`,`headers`,`n_chunks`,
+                `length`,`checksum` FROM `response_cache_headers`
+                WHERE `context_identity` == ? AND `encoding` == ?"""
+            header = execute(query, [cid, RESPONSE_CACHE_ENCODING]).fetchone()
+            if header is None:
+                raise EOFError("No header found in response_cache")
             else:
-                yield mimetype
-            query = """SELECT `chunk`,`mimetype` FROM `response_cache`
+                mimetype, encoding, headers, *expected = header
+                headers = loads(headers or "{}")
+                passthrough = (encoding in accept_encodings)
+                if expected[1] <= RESPONSE_CACHE_HOT_TIER.max_entry_size:
+                    hot_frames = []
+                yield mimetype, (encoding if passthrough else None), headers
+            decompressor = decompressobj(wbits=31)
+            if mimetype in RESPONSE_CACHE_TEXT_MIMETYPES:
+                decoder = getincrementaldecoder("utf-8")()
+            else:
+                decoder = BinaryPassthroughDecoder()
+            query = """SELECT `i`,`chunk` FROM `response_cache`
                 WHERE `context_identity` == ? ORDER BY `i` ASC"""
-            for chunk, _mimetype in execute(query, [cid]):
-                if mimetype != _mimetype:
-                    raise OperationalError("Stored mimetypes of chunks differ")
-                decompressed_chunk = decompressor.decompress(chunk)
-                if decompressed_chunk:
-                    yield decompressed_chunk.decode()
-            decompressed_chunk = decompressor.flush()
-            if decompressed_chunk:
-                yield decompressed_chunk.decode()
+            try:
+                for i, chunk in execute(query, [cid]):
+                    if i != n_chunks:
+                        problem = f"chunk {n_chunks} missing"
+                        break
+                    n_chunks += 1
+                    length += len(chunk)
+                    checksum = crc32(chunk, checksum)
+                    if hot_frames is not None:
+                        hot_frames.append(chunk)
+                    if passthrough:
+                        yield chunk
+                    else:
+                        decoded_chunk = decoder.decode(
+                            decompressor.decompress(chunk),
+                        )
+                        if decoded_chunk:
+                            yield decoded_chunk
+                else:
+                    if not passthrough:
+                        decoded_chunk = decoder.decode(decompressor.flush(), 1)
+                        if decoded_chunk:
+                            yield decoded_chunk
+                        if not decompressor.eof:
+                            problem = "compressed stream truncated"
+                    if [n_chunks, length, checksum] != expected:
+                        problem = "length or checksum does not match header"
+            except (ZlibError, UnicodeDecodeError, DatabaseError) as e:
+                problem = repr(e)
+        if problem is not None:
+            msg = f"{cid}, {problem}"
+            _loge(f"ResponseCache(), corrupted, dropping:\n  {msg}")
+            with self.sqltransactions.exclusive(desc) as (_, execute):
+                self._drop_by_context_identity(execute, cid)
+            RESPONSE_CACHE_HOT_TIER.bump(self.sqlite_db)
+            raise GeneFabDatabaseException("Cached response is corrupted")
+        elif hot_frames is not None:
+            RESPONSE_CACHE_HOT_TIER.put(
+                self.sqlite_db, cid, mimetype, b"".join(hot_frames), headers,
+                generation,
+            )
  
     @apply_hack(bypass_uncached_views)
     @bypass_if_disabled
     def get(self, context):
-        """Retrieve cached response object blob from response_cache table if possible; otherwise return empty ResponseContainer()"""
+        """Retrieve cached response (with its stored extra headers) from hot tier, or object blob from response_cache table if possible, to be verified while streaming; serve as-is if client accepts its content encoding; otherwise, or if first frame cannot be read (the response is then dropped), return empty ResponseContainer(); responses served from cache vary by Accept-Encoding either way, which shared caches must know"""
+        accept_encodings = getattr(context, "accept_encodings", ())
+        hot = RESPONSE_CACHE_HOT_TIER.get(self.sqlite_db, context.identity)
+        headers = {"Vary": "Accept-Encoding"}
+        if hot is not None:
+            mimetype, data, stored_headers = hot
+            headers.update(stored_headers)
+            self._count_request(context)
+            _logi(f"ResponseCache(), from hot tier:\n  {context.identity}")
+            if RESPONSE_CACHE_ENCODING in accept_encodings:
+                headers["Content-Encoding"] = RESPONSE_CACHE_ENCODING
+                return ResponseContainer(data, mimetype, None, headers)
+            else:
+                content = decompress(data, wbits=31)
+                if mimetype in RESPONSE_CACHE_TEXT_MIMETYPES:
+                    content = content.decode()
+                return ResponseContainer(content, mimetype, None, headers)
+        iterator = self._iterframes(
+            context.identity, accept_encodings,
+            RESPONSE_CACHE_HOT_TIER.generation(self.sqlite_db),
+        )
         try:
-            for value in self._iterdecompress(context.identity):
-                pass # test retrieval and decompression before returning
+            mimetype, encoding, stored_headers = next(iterator)
+            head = list(islice(iterator, 1)) # read before anything is sent
         except EOFError:
             _logi(f"ResponseCache(), nothing yet for:\n  {context.identity}")
             return ResponseContainer(content=None)
-        except OperationalError as e:
+        except (OperationalError, GeneFabDatabaseException) as e:
             msg = "could not retrieve, staging replacement"
             _logw(f"ResponseCache() {msg}:\n  {context.identity}, {e!r}")
             return ResponseContainer(content=None)
-        except ZlibError as e:
-            msg = "could not decompress, staging replacement"
-            _logw(f"ResponseCache() {msg}:\n  {context.identity}, {e!r}")
-            return ResponseContainer(content=None)
         else:
+            self._count_request(context)
             _logi(f"ResponseCache(), retrieving:\n  {context.identity}")
-            iterator = self._iterdecompress(context.identity) # second pass # TODO PhoenixIterator?
-            mimetype = next(iterator)
-            return ResponseContainer(lambda: iterator, mimetype)
+            headers.update(stored_headers)
+            if encoding:
+                headers["Content-Encoding"] = encoding
+            content = lambda: chain(head, iterator)
+            return ResponseContainer(content, mimetype, None, headers)
  
     @bypass_if_disabled
     def shrink(self, max_iter=100, max_skids=20, desc="response_cache/shrink"):
-        """Drop oldest cached responses to keep file size on disk under `self.maxdbsize`"""
+        """Drop oldest cached responses to keep size of database (not counting free pages) under `self.maxdbsize`"""
         # TODO: DRY: very similar to genefab3.db.sql.core SQLiteTable.cleanup()
         n_dropped, n_skids = 0, 0
         for _ in range(max_iter):
-            current_size = path.getsize(self.sqlite_db)
+            current_size = get_used_size(self.sqlite_db)
             if (n_skids < max_skids) and (current_size > self.maxdbsize):
                 with self.sqltransactions.concurrent(desc) as (_, execute):
                     query_oldest = """SELECT `context_identity`
-                        FROM `response_cache` ORDER BY `retrieved_at` ASC"""
+                        FROM `response_cache_headers`
+                        ORDER BY `retrieved_at` ASC LIMIT 1"""
                     cid = (execute(query_oldest).fetchone() or [None])[0]
                     if cid is None:
                         break
@@ -221,12 +667,13 @@ class ResponseCache():
                     else:
                         connection.commit()
                         n_dropped += 1
-                n_skids += (path.getsize(self.sqlite_db) >= current_size)
+                n_skids += (get_used_size(self.sqlite_db) >= current_size)
             else:
                 break
         if n_dropped:
+            RESPONSE_CACHE_HOT_TIER.bump(self.sqlite_db)
             _logi(f"ResponseCache():\n  shrunk by {n_dropped} entries")
-        elif path.getsize(self.sqlite_db) > self.maxdbsize:
+        elif get_used_size(self.sqlite_db) > self.maxdbsize:
             _logw("ResponseCache():\n  could not drop entries to shrink")
         if n_skids:
             _logw(f"ResponseCache():\n  file did not shrink {n_skids} times")
@@ -3,7 +3,11 @@ from genefab3.db.sql.utils import SQLTransactions, reraise_operational_error
 from sqlite3 import OperationalError
 from genefab3.common.exceptions import GeneFabLogger, GeneFabDatabaseException
 from genefab3.common.types import StreamedDataTable, NaN
+from genefab3.common.types import StreamedAggregatedDataTable
+from genefab3.common.exceptions import GeneFabFormatException
 from genefab3.common.exceptions import GeneFabFileException
+from genefab3.common.exceptions import GeneFabParserException
+from genefab3.common.utils import encode_page_cursor, decode_page_cursor
 from collections import Counter, OrderedDict
 from collections.abc import Iterable
 from urllib.request import unquote
@@ -14,7 +18,8 @@ from genefab3.common.hacks import apply_hack, speed_up_data_schema
 class TempSelect():
     """Temporary table or view generated from `query`"""
  
-    def __init__(self, *, sqlite_db, query, targets, kind="TABLE", _depends_on=None, msg=None):
+    def __init__(self, *, sqlite_db, query, targets, kind="TABLE", query_params=(), index_name=None, _depends_on=None, msg=None):
+        """Create table or view (only tables can be created from `query` with placeholders filled by `query_params`); if `kind` is TABLE and `index_name` is given, also index it on that column to speed up subsequent joins"""
         self.sqlite_db = sqlite_db
         self._depends_on = _depends_on # keeps sources from being deleted early
         self.query, self.targets, self.kind = query, targets, kind
@@ -24,7 +29,13 @@ class TempSelect():
             if msg:
                 GeneFabLogger.info(msg)
             try:
-                execute(f"CREATE {self.kind} `{self.name}` as {query}")
+                execute(
+                    f"CREATE {self.kind} `{self.name}` as {query}",
+                    query_params,
+                )
+                if (self.kind == "TABLE") and (index_name is not None):
+                    execute(f"""CREATE INDEX `{self.name}/{index_name}`
+                        ON `{self.name}` (`{index_name}`)""")
             except OperationalError as e:
                 reraise_operational_error(self, e)
             else:
@@ -49,6 +60,7 @@ class SQLiteIndexName(str): pass
 
 class StreamedDataTableWizard():
     """StreamedDataTable to be retrieved from SQLite, possibly from multiple parts of same or multiple tabular files"""
+    _rows = ()
  
     @property
     def columns(self):
@@ -108,8 +120,17 @@ class StreamedDataTableWizard():
                 self._column_passed2full(unquote(c)) for c in context.data_columns
             ]
  
-    def _sanitize_where(self, context):
-        """Infer column names for SQLite WHERE as columns are presented in table or view"""
+    def constrain_rows(self, context):
+        """Constrain rows to specified index values, if any"""
+        self._rows = tuple(getattr(context, "data_rows", ()))
+ 
+    def _rows_filter(self):
+        """Make SQLite condition on index column for self._rows (to be used with self._rows as placeholder values)"""
+        qmarks = ",".join("?" * len(self._rows))
+        return f"`{self._index_name}` IN ({qmarks})"
+ 
+    def _sanitize_column(self, passed_name):
+        """Infer column name for SQLite WHERE or ORDER BY as column is presented in table or view; report it to index advisor, if any"""
         passed2full = getattr(
             self,
             # defined in StreamedDataTableWizard_OuterJoined:
@@ -117,28 +138,212 @@ class StreamedDataTableWizard():
             # defined in StreamedDataTableWizard/StreamedDataTableWizard_Single:
             self._column_passed2full,
         )
+        full_name = passed2full(unquote(passed_name))
+        self._advise_index(full_name)
+        return "/".join(full_name)
+ 
+    def _sanitize_where(self, context):
+        """Infer column names for SQLite WHERE as columns are presented in table or view"""
         for dc in getattr(context, "data_comparisons", []):
             match = search(r'(`)([^`]*)(`)', dc)
             if not match:
                 msg = "Not a valid column in data comparison"
                 raise GeneFabFileException(msg, comparison=dc)
             else:
-                sanitized_name = "/".join(passed2full(unquote(match.group(2))))
+                sanitized_name = self._sanitize_column(match.group(2))
                 yield sub(r'(`)([^`]*)(`)', f"`{sanitized_name}`", dc, count=1)
  
+    def _advise_index(self, full_name):
+        """Report column used in data comparison or sort to index advisor, if any"""
+        pass
+ 
+    def _parse_sort(self, context):
+        """Interpret `sort` (column to order rows by) and `order` ('asc', default, or 'desc') passed in context"""
+        sort = getattr(context, "sort", None)
+        order = getattr(context, "order", None)
+        if sort is None:
+            if order is not None:
+                msg = "'order' requires 'sort'"
+                raise GeneFabParserException(msg, order=order)
+            else:
+                return None, None
+        elif order not in {None, "asc", "desc"}:
+            msg, sug = "Unsupported sort order", "Use 'asc' or 'desc'"
+            raise GeneFabParserException(msg, suggestion=sug, order=order)
+        else:
+            return self._sanitize_column(sort), (order or "asc").upper()
+ 
+    def _make_order_filter(self, sort, direction):
+        """Make ORDER BY clause: by index, or by `sort` column (missing values last) with index as tiebreak in the same `direction`, so that an index on both columns can be used"""
+        if sort is None:
+            return f"ORDER BY `{self._index_name}`"
+        else:
+            nulls_last = " NULLS LAST" if (direction == "ASC") else ""
+            return (f"ORDER BY `{sort}` {direction}{nulls_last}, " +
+                f"`{self._index_name}` {direction}")
+ 
+    def _make_keyset_filter(self, sort, direction, last, cursor):
+        """Make SQLite condition (with values for placeholders) selecting rows at or after `last` key (index value, or [sort value, index value]) of previous page; rows tied with it are skipped by OFFSET"""
+        _index = f"`{self._index_name}`"
+        _after = "<=" if (direction == "DESC") else ">="
+        if sort is None:
+            if isinstance(last, list):
+                raise GeneFabParserException("Invalid cursor", cursor=cursor)
+            elif last is None: # NULLs come first, are skipped by OFFSET
+                return None, ()
+            else:
+                return f"{_index} >= ?", (last,)
+        elif not (isinstance(last, list) and (len(last) == 2)):
+            raise GeneFabParserException("Invalid cursor", cursor=cursor)
+        else:
+            (last_sort, last_index), _sort = last, f"`{sort}`"
+            if last_index is None: # NULLs come first (ASC) or last (DESC)
+                nulls = "" if (direction == "ASC") else f" AND {_index} IS NULL"
+                tie, tie_params = f"({_sort} IS ?{nulls})", (last_sort,)
+            else:
+                tie = f"({_sort} IS ? AND {_index} {_after} ?)"
+                tie_params = (last_sort, last_index)
+            if last_sort is None: # in the tail of missing sort values
+                return tie, tie_params
+            else:
+                _beyond = ">" if (direction == "ASC") else "<"
+                beyond = f"{_sort} {_beyond} ? OR {_sort} IS NULL"
+                return f"({beyond} OR {tie})", (last_sort, *tie_params)
+ 
+    def _parse_page(self, context):
+        """Interpret `limit` (page size) and `cursor` (token encoding last index value of previous page) passed in context"""
+        limit = getattr(context, "limit", None)
+        cursor = getattr(context, "cursor", None)
+        if limit is None:
+            if cursor is not None:
+                msg = "Paging with 'cursor' requires 'limit'"
+                raise GeneFabParserException(msg, cursor=cursor)
+            else:
+                return None, None
+        elif not (limit.isdigit() and (int(limit) > 0)):
+            msg = "'limit' must be a positive integer"
+            raise GeneFabParserException(msg, limit=limit)
+        elif cursor is None:
+            return int(limit), None
+        else:
+            return int(limit), decode_page_cursor(cursor)
+ 
+    def _parse_aggregate(self, context):
+        """Interpret `aggregate` (aggregation function) and `per` ('column', default, or 'row') passed in context"""
+        aggregate = getattr(context, "aggregate", None)
+        per = getattr(context, "per", None)
+        _aggregators = StreamedAggregatedDataTable.numpy_aggregators
+        if aggregate is None:
+            if per is not None:
+                msg = "'per' requires 'aggregate'"
+                raise GeneFabParserException(msg, per=per)
+            else:
+                return None, None
+        elif aggregate not in _aggregators:
+            msg = "Unsupported aggregation function"
+            sug = f"Use one of: {', '.join(_aggregators)}"
+            _kw = dict(aggregate=aggregate)
+            raise GeneFabParserException(msg, suggestion=sug, **_kw)
+        elif per not in {None, "column", "row"}:
+            msg, sug = "Unsupported aggregation axis", "Use 'column' or 'row'"
+            raise GeneFabParserException(msg, suggestion=sug, per=per)
+        elif getattr(context, "format", None) == "gct":
+            msg = "GCT format is disabled for aggregated tables"
+            raise GeneFabFormatException(msg, aggregate=aggregate)
+        elif (per in {None, "column"}) and getattr(context, "limit", None):
+            msg = "Paging is not valid for per-column aggregation"
+            raise GeneFabParserException(msg, aggregate=aggregate)
+        else:
+            return aggregate, (per or "column")
+ 
+    def _constrain_page(self, last, n_rows):
+        """Constrain sources to rows that can make it onto page of `n_rows` rows at or after `last` index value; only joined objects have sources to constrain"""
+        pass
+ 
     def _make_query_filter(self, context, limit, offset):
-        """Validate arguments for StreamedDataTableWizard.get() and append WHERE, LIMIT, OFFSET clauses"""
-        where = list(self._sanitize_where(context))
+        """Validate arguments for StreamedDataTableWizard.get() and append WHERE, ORDER BY, LIMIT, OFFSET clauses with values for placeholders; infer number of rows without running query, if possible; also return paging parameters, including filter that peeks one row past the page"""
+        where, query_params = list(self._sanitize_where(context)), ()
+        has_comparisons = bool(where)
+        if self._rows:
+            where.append(self._rows_filter())
+            query_params = self._rows
         if (offset != 0) and (limit is None):
             msg = "StreamedDataTableWizard: `offset` without `limit`"
             raise GeneFabDatabaseException(msg, table=self.name)
+        sort, direction = self._parse_sort(context)
+        page_size, after = self._parse_page(context)
+        if page_size is None:
+            order_filter = "" if sort is None else (
+                self._make_order_filter(sort, direction)
+            )
+        elif (limit is not None) or (offset != 0):
+            msg = "StreamedDataTableWizard: both `limit` and paging requested"
+            raise GeneFabDatabaseException(msg, table=self.name)
+        else: # keyset pagination; ties at page boundary are skipped by OFFSET
+            last = None
+            if after is not None:
+                last, offset = after
+                keyset_filter, keyset_params = self._make_keyset_filter(
+                    sort, direction, last, getattr(context, "cursor", None),
+                )
+                if keyset_filter is not None:
+                    where.append(keyset_filter)
+                    query_params = (*query_params, *keyset_params)
+            if (sort is None) and (not has_comparisons) and (not self._rows):
+                self._constrain_page(last, offset + page_size + 1)
+            order_filter = self._make_order_filter(sort, direction)
+            limit = page_size
         where_filter = "" if not where else f"WHERE {' AND '.join(where)}"
         limit_filter = "" if limit is None else f"LIMIT {limit} OFFSET {offset}"
-        return f"{where_filter} {limit_filter}"
+        n_rows = None if where else self._n_rows
+        if (n_rows is not None) and (limit is not None):
+            n_rows = min(max(n_rows - offset, 0), limit)
+        query_filter = f"{where_filter} {order_filter} {limit_filter}"
+        peek_filter = None if (page_size is None) else (
+            f"{where_filter} {order_filter} " +
+            f"LIMIT {page_size + 1} OFFSET {offset}"
+        )
+        paging = page_size, after, sort, direction, peek_filter
+        return query_filter, query_params, n_rows, paging
+ 
+    @property
+    def _n_rows(self):
+        """Number of rows known without running query; None if unknown"""
+        return None
+ 
+    def _make_next_page_cursor(self, data, paging, desc="tables/StreamedDataTableWizard/page"):
+        """Fetch keys (index value, or [sort value, index value]) of rows of current page of `data` and of one row past it in a single query; encode key of last row of page and how many rows with that key have been returned so far as cursor for next page; None if this is the last page"""
+        page_size, after, sort, direction, peek_filter = paging
+        _index = f"`{self._index_name}`"
+        key = [_index] if (sort is None) else [f"`{sort}`", _index]
+        with data.sqltransactions.concurrent(desc) as (_, execute):
+            try:
+                keys = execute(
+                    f"""SELECT {','.join(key)}
+                    FROM `{data.source_select.name}` {peek_filter}""",
+                    data.query_params,
+                ).fetchall()
+            except OperationalError as e:
+                reraise_operational_error(data, e)
+        data._n_rows = min(len(keys), page_size)
+        if len(keys) <= page_size:
+            return None
+        else:
+            last = keys[page_size - 1]
+            n_last = sum(1 for k in keys[:page_size] if k == last)
+            last = last[0] if (sort is None) else list(last)
+            if (after is not None) and (after[0] == last):
+                return encode_page_cursor(last, after[1] + n_last)
+            else:
+                return encode_page_cursor(last, n_last)
  
     @apply_hack(speed_up_data_schema)
     def get(self, *, context, limit=None, offset=0):
-        """Interpret arguments and retrieve data as StreamedDataTable by running SQL queries"""
+        """Interpret arguments and retrieve data as StreamedDataTable by running SQL queries; if paging was requested, data carries cursor for next page (cached with response as its Link header); if aggregation was requested, data is reduced before being streamed"""
+        aggregate, per = self._parse_aggregate(context)
+        query_filter, query_params, n_rows, paging = (
+            self._make_query_filter(context, limit, offset)
+        )
         data = StreamedDataTable(
             sqlite_db=self.sqlite_db,
             source_select=self.make_select(kind="VIEW"),
@@ -146,9 +351,15 @@ class StreamedDataTableWizard():
                 f"`{self._index_name}`",
                 *(f"`{'/'.join(c)}`" for c in self.columns),
             )),
-            query_filter=self._make_query_filter(context, limit, offset),
-            na_rep=NaN,
+            query_filter=query_filter, query_params=query_params,
+            n_rows=n_rows, na_rep=NaN,
         )
+        if paging[0] is not None:
+            data.next_cursor = self._make_next_page_cursor(data, paging)
+        if aggregate is not None:
+            data = StreamedAggregatedDataTable(
+                data, aggregate=aggregate, per=per,
+            )
         msg = "staged to retrieve from SQLite as StreamedDataTable"
         GeneFabLogger.info(f"{self.name};\n  {msg}")
         return data
@@ -174,11 +385,14 @@ class StreamedDataTableWizard():
 
 class StreamedDataTableWizard_Single(StreamedDataTableWizard):
     """StreamedDataTable to be retrieved from SQLite, possibly from multiple parts of same tabular file"""
+    _index_range = None, None
  
-    def __init__(self, sqlite_db, column_dispatcher, identifier=None):
-        """Interpret `column_dispatcher`"""
+    def __init__(self, sqlite_db, column_dispatcher, identifier=None, n_rows=None, keyed=False, index_advisor=None, column_stats=None):
+        """Interpret `column_dispatcher`; retain number of rows stored at the time of caching, if known, whether parts are keyed by a unique index, and index advisor and column statistics of source table, if any"""
         self.sqlite_db = sqlite_db
         self.identifier = identifier
+        self._n_rows_stored, self._keyed = n_rows, keyed
+        self.index_advisor, self.column_stats = index_advisor, column_stats
         self.sqltransactions = SQLTransactions(sqlite_db, identifier)
         self._column_dispatcher = column_dispatcher
         self.name = None
@@ -201,6 +415,50 @@ class StreamedDataTableWizard_Single(StreamedDataTableWizard):
             raise GeneFabDatabaseException(msg, **_kw)
         self._index_name = _index_names.pop()
  
+    @property
+    def _n_rows(self):
+        """Number of rows known without running query: only valid if requested columns come from a single table part, or if parts are keyed by a unique index (NATURAL JOIN may change it otherwise)"""
+        if self._keyed or (len(self._inverse_column_dispatcher) == 1):
+            return self._n_rows_stored
+        else:
+            return None
+ 
+    def constrain_index_range(self, lower, upper):
+        """Constrain rows to index values between `lower` and `upper` (inclusive; None if unbounded), if exposed as SQL table"""
+        self._index_range = lower, upper
+ 
+    def _index_range_filter(self):
+        """Make SQLite condition on index column for self._index_range (with values for placeholders); None if unbounded"""
+        conditions, params = [], []
+        for op, bound in zip((">=", "<="), self._index_range):
+            if bound is not None:
+                conditions.append(f"`{self._index_name}` {op} ?")
+                params.append(bound)
+        return " AND ".join(conditions) or None, tuple(params)
+ 
+    def get_nth_index_value(self, lower, n, desc="tables/StreamedDataTableWizard_Single/nth"):
+        """Retrieve `n`-th index value at or after `lower` (None: from the start) in index order, from part of first requested column; return (value, True), or (None, False) if there are fewer rows"""
+        part = next(iter(self._inverse_column_dispatcher))
+        _index = f"`{self._index_name}`"
+        where = "" if (lower is None) else f"WHERE {_index} >= ?"
+        with self.sqltransactions.concurrent(desc) as (_, execute):
+            try:
+                row = execute(
+                    f"""SELECT {_index} FROM `{part}` {where}
+                    ORDER BY {_index} LIMIT 1 OFFSET {n - 1}""",
+                    () if (lower is None) else (lower,),
+                ).fetchone()
+            except OperationalError as e:
+                reraise_operational_error(self, e)
+        return (None, False) if (row is None) else (row[0], True)
+ 
+    def _advise_index(self, full_name):
+        """Report column used in data comparison to index advisor, which may index it on the table part that stores it"""
+        if self.index_advisor is not None:
+            rawcol = full_name[-1]
+            part = self._column_dispatcher[rawcol]
+            self.index_advisor.record(part, rawcol, self._index_name)
+ 
     @property
     def _inverse_column_dispatcher(self):
         """Make dictionary {table_part -> [col, col, col, ...]}"""
@@ -226,11 +484,23 @@ class StreamedDataTableWizard_Single(StreamedDataTableWizard):
         query = f"""
             SELECT `{self._index_name}`,{','.join(columns_as_slashed_columns)}
             FROM {join_statement}"""
+        conditions, query_params = [], ()
+        if kind == "TABLE": # otherwise filtered by consumer
+            if self._rows:
+                conditions.append(self._rows_filter())
+                query_params = self._rows
+            range_filter, range_params = self._index_range_filter()
+            if range_filter is not None:
+                conditions.append(range_filter)
+                query_params = (*query_params, *range_params)
+        if conditions:
+            query += f" WHERE {' AND '.join(conditions)}"
         return TempSelect(
             sqlite_db=self.sqlite_db, kind=kind, query=query, msg=msg, targets=[
                 f"`{self._columns_raw2slashed[rawcol]}`"
                 for *_, rawcol in self.columns
             ],
+            query_params=query_params, index_name=self._index_name,
         )
 
 
@@ -251,6 +521,29 @@ class StreamedDataTableWizard_OuterJoined(StreamedDataTableWizard):
             names = ", ".join(str(obj.name) for obj in objs)
             self.name = f"FullOuterJoin({names})"
  
+    def constrain_rows(self, context):
+        """Constrain rows to specified index values, if any, both in joined result and in each joined object (so that only matching rows get joined)"""
+        StreamedDataTableWizard.constrain_rows(self, context)
+        for obj in self.objs:
+            obj.constrain_rows(context)
+ 
+    def _constrain_page(self, last, n_rows):
+        """Constrain index of each joined object to range that contains first `n_rows` rows of joined result at or after `last` index value: from `last` up to smallest of `n_rows`-th index values of objects (each object contributes at least as many rows to result as it has), so that only rows that can make it onto page get selected and joined"""
+        upper = None
+        for obj in self.objs:
+            value, found = obj.get_nth_index_value(last, n_rows)
+            if found and (value is None): # in NULLs, which sort first
+                return
+            elif found and (upper is None):
+                upper = value
+            elif found:
+                try:
+                    upper = min(upper, value)
+                except TypeError: # index values of differing types
+                    return
+        for obj in self.objs:
+            obj.constrain_index_range(last, upper)
+ 
     def _unique_column_passed2full(self, passed_name):
         """Match passed column name to unique full column name found in self.objs[*].columns"""
         matches_and_misses = {
@@ -290,6 +583,7 @@ class StreamedDataTableWizard_OuterJoined(StreamedDataTableWizard):
             agg_select = TempSelect(
                 sqlite_db=self.sqlite_db, query=agg_query, targets=agg_targets,
                 kind=kind if (i == len(self.objs) - 1) else "TABLE",
+                index_name=self._index_name,
                 _depends_on=(agg_select, next_select),
             )
         return agg_select
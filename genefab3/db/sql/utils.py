@@ -5,8 +5,8 @@ from datetime import datetime
 from filelock import Timeout as FileLockTimeoutError, FileLock
 from glob import iglob
 from hashlib import md5
-from contextlib import contextmanager, closing
-from genefab3.common.utils import timestamp36
+from contextlib import contextmanager, closing, ExitStack
+from genefab3.common.utils import timestamp36, validate_no_backtick
 from sqlite3 import connect, OperationalError
 from threading import Thread
 from subprocess import call
@@ -33,13 +33,50 @@ def apply_pragma(execute, pragma, value, sqlite_db):
 
 
 def apply_all_pragmas(sqlite_db, execute, timeout):
-    """Apply all relevant PRAGMAs at once: auto_vacuum, WAL, wal_autocheckpoint, busy_timeout"""
-    apply_pragma(execute, "auto_vacuum", "1", sqlite_db)
+    """Apply all relevant PRAGMAs at once: auto_vacuum (incremental; free pages are reclaimed by IncrementalVacuumScheduler), WAL, wal_autocheckpoint, busy_timeout"""
+    apply_pragma(execute, "auto_vacuum", "2", sqlite_db)
     apply_pragma(execute, "journal_mode", "wal", sqlite_db)
     apply_pragma(execute, "wal_autocheckpoint", "0", sqlite_db)
     apply_pragma(execute, "busy_timeout", str(int(timeout*1000)), sqlite_db)
 
 
+def get_page_stats(sqlite_db):
+    """Read page size, number of pages, number of free pages and auto_vacuum mode of database, without locks"""
+    with closing(connect(sqlite_db)) as connection:
+        return {
+            pragma: connection.execute(f"PRAGMA {pragma}").fetchone()[0]
+            for pragma in ("page_size", "page_count", "freelist_count",
+                "auto_vacuum")
+        }
+
+
+def get_used_size(sqlite_db):
+    """Size of database in bytes, not counting free pages (which remain in file until reclaimed by incremental vacuum)"""
+    stats = get_page_stats(sqlite_db)
+    return (stats["page_count"] - stats["freelist_count"]) * stats["page_size"]
+
+
+def ensure_table_schema(execute, table, schema):
+    """Create `table` with fields and types in `schema` if it does not exist; add fields that are missing from an existing `table`"""
+    execute("CREATE TABLE IF NOT EXISTS `{}` ({})".format(
+        validate_no_backtick(table, "table"), ", ".join(
+            "`" + validate_no_backtick(f, "field") + "` " + k
+            for f, k in schema.items()
+        ),
+    ))
+    table_info = execute(f"PRAGMA table_info(`{table}`)").fetchall()
+    existing_fields = {f for _, f, *_ in table_info}
+    for f, k in schema.items():
+        if f not in existing_fields:
+            try:
+                execute(f"ALTER TABLE `{table}` ADD COLUMN `{f}` {k}")
+            except OperationalError as e:
+                if "duplicate column" not in str(e).lower():
+                    raise # otherwise, was added concurrently; nothing to do
+            else:
+                _logd(f"Added field {f!r} to existing table {table!r}")
+
+
 def clear_lock_if_stale(lockfilename, max_filelock_age_seconds=7200, raise_errors=True):
     """If lockfile has not been accessed in `max_filelock_age_seconds`, assume junk and remove"""
     try:
@@ -215,6 +252,31 @@ class SQLTransactions():
                 yield connection, execute
                 _logd(f"{prelude}: releasing write lock")
 
+    @contextmanager
+    def exclusive_if_idle(self, desc=None):
+        """2PL across identifiers: if no transactions under any identifier currently hold or wait for locks on `self.sqlite_db`, hold all their locks, so that none can begin while transaction runs, and initiate it; otherwise yield (None, None) without waiting; transactions under identifiers first seen after the check are still serialized with this one by SQLite itself"""
+        fulldesc = f"{desc or ''}:{self.sqlite_db}:*"
+        _tid = timestamp36()
+        prelude = f"SQLTransactions.exclusive_if_idle @ {_tid} ({fulldesc})"
+        _, name = path.split(self.sqlite_db)
+        with ExitStack() as stack:
+            for lockfilename in iglob(path.join(self.cwd, f"{name}.*lock")):
+                try: # `timeout=0`: try once, do not wait for lock
+                    stack.enter_context(FileLock(lockfilename, timeout=0))
+                except FileLockTimeoutError:
+                    is_idle = False
+                else: # no read handles besides own:
+                    is_idle = not fds_exceed(lockfilename, 1)
+                if not is_idle:
+                    _logd(f"{prelude}: database is busy")
+                    yield None, None
+                    break
+            else:
+                _logd(f"{prelude}: all locks obtained!")
+                with self._connect(fulldesc, _tid) as (connection, execute):
+                    yield connection, execute
+                    _logd(f"{prelude}: releasing all locks")
+
 
 def reraise_operational_error(obj, e):
     """If OperationalError is due to too many columns in request, tell user; otherwise, raise generic error"""
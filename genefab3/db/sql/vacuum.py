@@ -0,0 +1,47 @@
+from genefab3.db.sql.utils import SQLTransactions, get_page_stats
+from genefab3.common.exceptions import GeneFabLogger
+from time import sleep, monotonic
+
+
+class IncrementalVacuumScheduler():
+    """Reclaims free pages of SQLite databases (in incremental auto_vacuum mode) in small bounded steps, only while databases are idle"""
+ 
+    def __init__(self, sqlite_dbs, *, step_pages=4096, min_free_pages=1024, step_interval=1):
+        """Collect SQLite databases to be vacuumed; each step frees at most `step_pages` pages, and only if at least `min_free_pages` are free"""
+        self.sqlite_dbs = [
+            descriptor["db"] for descriptor in sqlite_dbs.__dict__.values()
+            if descriptor.get("db")
+        ]
+        self.step_pages, self.min_free_pages = step_pages, min_free_pages
+        self.step_interval = step_interval
+ 
+    def step(self, sqlite_db, desc="vacuum/step"):
+        """If `sqlite_db` has enough free pages, free up to `self.step_pages` of them in one short transaction, unless database is busy; return number of freed pages, or None if there was nothing to reclaim"""
+        if get_page_stats(sqlite_db)["freelist_count"] < self.min_free_pages:
+            return None
+        sqltransactions = SQLTransactions(sqlite_db)
+        with sqltransactions.exclusive_if_idle(desc) as (_, execute):
+            if execute is None:
+                return 0
+            n_free = execute("PRAGMA freelist_count").fetchone()[0]
+            for _ in range(min(n_free, self.step_pages)):
+                # sqlite3 steps this PRAGMA once per execute, i.e. one page:
+                execute("PRAGMA incremental_vacuum(1)")
+            n_freed = n_free - execute("PRAGMA freelist_count").fetchone()[0]
+        msg = f"IncrementalVacuumScheduler():\n  freed {n_freed} pages"
+        GeneFabLogger.debug(f"{msg} of {sqlite_db}")
+        return n_freed
+ 
+    def run_until(self, deadline):
+        """Step through databases in rotation, pausing `self.step_interval` seconds between rounds, until `deadline` (as returned by time.monotonic()); sleep through remaining time once there is nothing to reclaim"""
+        while monotonic() < deadline:
+            try:
+                pending = [self.step(db) for db in self.sqlite_dbs]
+            except Exception as e:
+                msg = f"IncrementalVacuumScheduler():\n  {e!r}"
+                GeneFabLogger.warning(msg, exc_info=e)
+                pending = [None]
+            if all(n_freed is None for n_freed in pending):
+                sleep(max(0, deadline - monotonic()))
+            else:
+                sleep(max(0, min(self.step_interval, deadline - monotonic())))
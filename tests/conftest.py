@@ -0,0 +1,52 @@
+from pytest import fixture
+from types import SimpleNamespace
+from contextlib import contextmanager
+from genefab3.db.sql.files import CachedTableFile
+
+
+CONTEXT_DEFAULTS = dict(
+    data_columns=[], data_comparisons=[], data_rows=[], schema="0",
+    format=None, limit=None, cursor=None, aggregate=None, per=None,
+    sort=None, order=None,
+)
+
+
+def make_context(**kwargs):
+    """Stand-in for genefab3.api.parser.Context with arguments relevant to StreamedDataTableWizard"""
+    return SimpleNamespace(**{**CONTEXT_DEFAULTS, **kwargs})
+
+
+@contextmanager
+def local_request_get(url, stream=True):
+    """Stand-in for requests.get() that serves local files"""
+    with open(url, mode="rb") as handle:
+        yield SimpleNamespace(raw=SimpleNamespace(read=handle.read))
+
+
+@fixture
+def make_table(tmp_path, monkeypatch):
+    """Factory of StreamedDataTableWizard objects over tables cached from CSV text into a shared SQLite database; each call retrieves a fresh object"""
+    monkeypatch.setattr(
+        "genefab3.db.sql.files.request_get", local_request_get,
+    )
+    sqlite_db, cached_table_files = str(tmp_path / "tables.db"), {}
+    def _make_table(name, csv, accession="GLDS-1", assay_name="a1", **kwargs):
+        if name in cached_table_files: # already cached, skip staleness check
+            table = cached_table_files[name].retrieve()
+        else:
+            csv_file = tmp_path / f"{name}.csv"
+            csv_file.write_text(csv)
+            cached_table_files[name] = CachedTableFile(
+                name=name, identifier=f"TABLE:{name}", urls=[str(csv_file)],
+                timestamp=1, sqlite_db=sqlite_db, index_col=0, **kwargs,
+            )
+            table = cached_table_files[name].data
+        table.columns = [(accession, assay_name, c[-1]) for c in table.columns]
+        return table
+    return _make_table
+
+
+def fetch(table, context):
+    """Retrieve StreamedDataTable from `table` and return it along with its rows as lists of index value and values"""
+    data = table.get(context=context)
+    return data, [[i[0], *v] for i, v in data.iter_rows()]
@@ -0,0 +1,82 @@
+from pytest import raises, mark
+from conftest import make_context, fetch
+from math import isinf
+from genefab3.db.sql.streamed_tables import StreamedDataTableWizard
+from genefab3.common.exceptions import GeneFabParserException
+from genefab3.common.exceptions import GeneFabFormatException
+
+
+def test_variance_survives_non_finite_means(make_table):
+    csv = "gene,big,small\nG1,1e308,1\nG2,1e308,2\nG3,1e308,4\n"
+    table = make_table("a", csv)
+    _, rows = fetch(table, make_context(aggregate="var"))
+    [(index, big, small)] = rows
+    assert index == "var"
+    assert isinf(big) or (big != big)
+    assert abs(small - 7 / 3) < 1e-9
+
+
+CSV = """gene,S0,S1,label
+G1,1,10,x
+G2,2,,y
+G3,4,30,z
+G4,,40,w
+"""
+
+
+def test_per_column_aggregates_skip_missing_and_non_numeric_values(make_table):
+    expected = {
+        "mean": [7 / 3, 80 / 3], "sum": [7, 80], "min": [1, 10],
+        "max": [4, 40], "count": [3, 3], "var": [7 / 3, 2100 / 9],
+    }
+    for aggregate, (s0, s1) in expected.items():
+        data, rows = fetch(make_table("a", CSV), make_context(
+            aggregate=aggregate, per="column",
+        ))
+        [(index, *values)] = rows
+        assert (index, data.shape) == (aggregate, (1, 3))
+        assert abs(values[0] - s0) < 1e-9, aggregate
+        assert abs(values[1] - s1) < 1e-9, aggregate
+        if aggregate == "count":
+            assert values[2] == 0
+        else:
+            assert values[2] != values[2] # NaN: label is not numeric
+
+
+def test_per_row_aggregates_reduce_each_assay(make_table):
+    make = lambda: StreamedDataTableWizard.concat([
+        make_table("a", CSV),
+        make_table("b", "gene,T0,T1\nG1,3,5\nG3,,\n", accession="GLDS-2"),
+    ])
+    data, rows = fetch(make(), make_context(aggregate="max", per="row"))
+    assert [list(c) for c in data.columns] == [
+        ["GLDS-1", "a1", "max"], ["GLDS-2", "a1", "max"],
+    ]
+    assert [row[:2] for row in rows] == [
+        ["G1", 10], ["G2", 2], ["G3", 30], ["G4", 40],
+    ]
+    assert rows[0][2] == 5
+    assert all(row[2] != row[2] for row in rows[1:]) # NaN: all missing
+
+
+def test_per_row_aggregates_can_be_paged(make_table):
+    make = lambda: make_table("a", CSV)
+    context = make_context(aggregate="sum", per="row", limit="3")
+    data, rows = fetch(make(), context)
+    assert rows == [["G1", 11], ["G2", 2], ["G3", 34]]
+    assert data.next_cursor is not None
+    context.cursor = data.next_cursor
+    data, rows = fetch(make(), context)
+    assert (rows, data.next_cursor) == ([["G4", 40]], None)
+
+
+@mark.parametrize("kwargs, exception", [
+    (dict(per="row"), GeneFabParserException),
+    (dict(aggregate="median"), GeneFabParserException),
+    (dict(aggregate="sum", per="cell"), GeneFabParserException),
+    (dict(aggregate="sum", limit="10"), GeneFabParserException),
+    (dict(aggregate="sum", format="gct"), GeneFabFormatException),
+])
+def test_invalid_aggregation_arguments_are_rejected(make_table, kwargs, exception):
+    with raises(exception):
+        make_table("a", CSV).get(context=make_context(**kwargs))
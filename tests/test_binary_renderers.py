@@ -0,0 +1,102 @@
+from io import BytesIO
+from sqlite3 import connect
+from contextlib import closing
+from types import SimpleNamespace
+from pytest import raises, importorskip
+from numpy import load as npload, isnan
+from conftest import make_context, fetch
+from genefab3.api.renderers.BinaryStreamedTableRenderers import npy
+from genefab3.api.renderers.BinaryStreamedTableRenderers import arrow, parquet
+from genefab3.common.types import StreamedDataTable
+from genefab3.common.exceptions import GeneFabFormatException
+
+
+CSV = "gene,a,b,c\nG1,1,,x\nG2,2,,\nG3,3,3.5,z\n"
+
+
+def fetch_blockwise(make_table, csv=CSV, columns=None, **kwargs):
+    table = make_table("t", csv)
+    if columns is not None:
+        table.columns = [c for c in table.columns if c[-1] in columns]
+    data, _ = fetch(table, make_context(**kwargs))
+    data.cells_per_block = 1 # one row per block
+    return data
+
+
+def read_arrow(content):
+    pyarrow = importorskip("pyarrow")
+    return pyarrow.ipc.open_stream(b"".join(content())).read_all()
+
+
+def read_parquet(content):
+    parquet_module = importorskip("pyarrow.parquet")
+    return parquet_module.read_table(BytesIO(b"".join(content())))
+
+
+def test_arrow_types_are_inferred_from_all_rows(make_table):
+    data = fetch_blockwise(make_table)
+    na_rep, n_index_levels = data.na_rep, data.n_index_levels
+    content, mimetype = arrow(data)
+    assert mimetype == "application/vnd.apache.arrow.stream"
+    assert (data.na_rep, data.n_index_levels) == (na_rep, n_index_levels)
+    table = read_arrow(content)
+    assert [str(t) for t in table.schema.types] == [
+        "string", "int64", "double", "string",
+    ]
+    assert table.to_pydict() == {
+        "gene": ["G1", "G2", "G3"], "GLDS-1/a1/a": [1, 2, 3],
+        "GLDS-1/a1/b": [None, None, 3.5], "GLDS-1/a1/c": ["x", None, "z"],
+    }
+
+
+def test_parquet_of_empty_and_aggregated_tables(make_table):
+    data = fetch_blockwise(make_table, data_comparisons=["`a` > 100"])
+    table = read_parquet(parquet(data)[0])
+    assert table.num_rows == 0
+    assert [str(t) for t in table.schema.types][:3] == [
+        "double", "double", "double", # no values to infer types from
+    ]
+    data = fetch_blockwise(
+        make_table, columns={"a", "b"}, aggregate="mean", per="column",
+    )
+    table = read_parquet(parquet(data)[0])
+    assert table.to_pydict() == {
+        "gene": ["mean"], "GLDS-1/a1/a": [2.0], "GLDS-1/a1/b": [3.5],
+    }
+
+
+def test_inconsistent_types_fail_before_streaming(make_table):
+    data = fetch_blockwise(make_table, "gene,a\nG1,1\nG2,2\nG3,3\n")
+    with closing(connect(data.sqlite_db)) as connection:
+        connection.execute("UPDATE `TABLE:t` SET `a` = 'x' WHERE `gene`='G3'")
+        connection.commit()
+    for renderer in arrow, parquet, npy:
+        with raises(GeneFabFormatException):
+            renderer(data)
+
+
+def test_npy_fails_on_text_before_streaming(make_table):
+    data = fetch_blockwise(make_table, columns={"c"})
+    table = read_arrow(arrow(data)[0])
+    assert table.column(1).to_pylist() == ["x", None, "z"]
+    with raises(GeneFabFormatException):
+        npy(data)
+
+
+def test_npy(make_table):
+    data = fetch_blockwise(make_table, columns={"a", "b"})
+    content, mimetype = npy(data)
+    assert mimetype == "application/octet-stream"
+    array = npload(BytesIO(b"".join(content())))
+    assert (array.shape, array.dtype.str) == ((3, 2), "<f8")
+    assert array[:, 0].tolist() == [1, 2, 3]
+    assert isnan(array[:2, 1]).all() and (array[2, 1] == 3.5)
+
+
+def test_npy_of_table_without_columns(make_table):
+    data = StreamedDataTable(
+        sqlite_db=fetch_blockwise(make_table).sqlite_db, targets="`gene`",
+        source_select=SimpleNamespace(name="TABLE:t"), query_filter="",
+    )
+    array = npload(BytesIO(b"".join(npy(data)[0]())))
+    assert array.shape == (3, 0)
@@ -0,0 +1,148 @@
+from types import SimpleNamespace
+from flask import Flask
+from genefab3.db.mongo.epochs import ensure_metadata_epoch_index
+from genefab3.db.mongo.epochs import bump_metadata_epochs, get_metadata_epochs
+from genefab3.db.mongo.epochs import get_constrained_accessions
+from genefab3.db.mongo.epochs import METADATA_EPOCH_KIND
+from genefab3.api.renderer import CacheableRenderer
+
+
+class Collection():
+    """Stand-in for pymongo collection, supporting operations on metadata epochs"""
+ 
+    def __init__(self):
+        self.name, self.documents, self.indexes = "records", [], {}
+ 
+    def index_information(self):
+        return dict(self.indexes)
+ 
+    def create_index(self, *, name, keys, **kwargs):
+        self.indexes[name] = dict(key=keys, **kwargs)
+ 
+    def _matches(self, document, query):
+        return all(
+            (document.get(k) in v["$in"]) if isinstance(v, dict)
+            else (document.get(k) == v) for k, v in query.items()
+        )
+ 
+    def find(self, query, projection):
+        for document in self.documents:
+            if self._matches(document, query):
+                yield {k: document[k] for k, v in projection.items() if v}
+ 
+    def replace_one(self, query, replacement, upsert=False):
+        for i, document in enumerate(self.documents):
+            if self._matches(document, query):
+                self.documents[i] = replacement
+                return
+        if upsert:
+            self.documents.append(replacement)
+
+
+def bump(collection, accessions, timestamp, monkeypatch):
+    now = SimpleNamespace(timestamp=lambda: timestamp)
+    monkeypatch.setattr(
+        "genefab3.db.mongo.epochs.datetime", SimpleNamespace(now=lambda: now),
+    )
+    bump_metadata_epochs(collection, accessions)
+
+
+def test_index_is_ensured_once():
+    collection = Collection()
+    ensure_metadata_epoch_index(collection)
+    index = collection.indexes[METADATA_EPOCH_KIND]
+    assert [k for k, _ in index["key"]] == ["kind", "accession"]
+    assert index["partialFilterExpression"] == {"kind": METADATA_EPOCH_KIND}
+    collection.create_index = None # would fail if called again
+    ensure_metadata_epoch_index(collection)
+
+
+def test_bumped_epochs_replace_previous_ones(monkeypatch):
+    collection = Collection()
+    assert get_metadata_epochs(collection) == {None: 0}
+    bump(collection, {"GLDS-2", "GLDS-1"}, 100, monkeypatch)
+    bump(collection, {"GLDS-1"}, 200, monkeypatch)
+    assert len(collection.documents) == 3
+    assert get_metadata_epochs(collection) == {None: 200}
+    assert get_metadata_epochs(collection, {"GLDS-1", "GLDS-2", "GLDS-3"}) == {
+        "GLDS-1": 200, "GLDS-2": 100, "GLDS-3": 0,
+    }
+
+
+def test_constrained_accessions():
+    assert get_constrained_accessions(None) is None
+    assert get_constrained_accessions({"$and": [{"id.study": "x"}]}) is None
+    assert get_constrained_accessions({"$and": [
+        {"id.accession": {"$in": ["GLDS-1", "GLDS-2"]}},
+        {"$or": [{"id.accession": "GLDS-2"}, {"id.accession": "GLDS-3"}]},
+        {"id.accession": {"$exists": True}},
+    ]}) == {"GLDS-2"}
+
+
+def make_renderer(collection, app_version="1"):
+    return CacheableRenderer(SimpleNamespace(
+        mongo_collections=SimpleNamespace(records=collection),
+        app_version=app_version,
+    ))
+
+
+def make_context(view="data", accessions=("GLDS-1",)):
+    query = {"$and": [{"id.accession": {"$in": list(accessions)}}]}
+    identity = f"{view}?{accessions}"
+    return SimpleNamespace(view=view, identity=identity, query=query)
+
+
+def request_validators(renderer, context, **headers):
+    with Flask(__name__).test_request_context(headers=headers):
+        validators = renderer.make_validators(context)
+        if validators is None:
+            return None, None
+        else:
+            return validators, renderer.make_not_modified_response(validators)
+
+
+def test_validators_change_with_epochs_of_constrained_accessions(monkeypatch):
+    collection, context = Collection(), make_context()
+    renderer = make_renderer(collection)
+    (etag, last_modified), _ = request_validators(renderer, context)
+    assert last_modified is None
+    bump(collection, {"GLDS-2"}, 100, monkeypatch)
+    assert request_validators(renderer, context)[0] == (etag, None)
+    bump(collection, {"GLDS-1"}, 200, monkeypatch)
+    (new_etag, last_modified), _ = request_validators(renderer, context)
+    assert (new_etag != etag) and (last_modified.timestamp() == 200)
+    assert request_validators(make_renderer(collection, "2"), context)[0][0] \
+        != new_etag
+
+
+def test_not_modified_response(monkeypatch):
+    collection, context = Collection(), make_context()
+    renderer = make_renderer(collection)
+    bump(collection, {"GLDS-1"}, 200, monkeypatch)
+    (etag, _), response = request_validators(renderer, context)
+    assert response is None
+    _, response = request_validators(
+        renderer, context, **{"If-None-Match": f'W/"{etag}"'},
+    )
+    assert response.status_code == 304
+    assert response.headers["ETag"] == f'W/"{etag}"'
+    _, response = request_validators(
+        renderer, context, **{"If-None-Match": '"other"'},
+    )
+    assert response is None
+    since = "Thu, 01 Jan 1970 00:03:20 GMT" # timestamp 200
+    _, response = request_validators(
+        renderer, context, **{"If-Modified-Since": since},
+    )
+    assert response.status_code == 304
+    bump(collection, {"GLDS-1"}, 300, monkeypatch)
+    _, response = request_validators(
+        renderer, context, **{"If-Modified-Since": since},
+    )
+    assert response is None
+
+
+def test_unconditional_views_have_no_validators():
+    renderer = make_renderer(Collection())
+    assert request_validators(renderer, make_context(view="status")) \
+        == (None, None)
@@ -0,0 +1,90 @@
+from sqlite3 import connect
+from contextlib import closing
+from genefab3.db.sql.utils import SQLTransactions, ensure_table_schema
+from genefab3.db.sql.index_advisor import SQLiteIndexAdvisor
+from genefab3.db.sql.index_advisor import SQLiteIndexAdvisorHitCounter
+
+
+PART, COLUMN, INDEX_NAME = "TABLE:x", "value", "entry"
+
+
+def make_index_advisor(tmp_path, n_rows=2000, **kwargs):
+    sqlite_db = str(tmp_path / "tables.db")
+    with closing(connect(sqlite_db)) as connection:
+        connection.execute(f"CREATE TABLE `{PART}` (`entry`, `value` REAL)")
+        connection.executemany(f"INSERT INTO `{PART}` VALUES (?,?)", [
+            (f"G{i:05d}", i / 7) for i in range(n_rows)
+        ])
+        ensure_table_schema(
+            connection.execute, "AUX:index_advisor", SQLiteIndexAdvisor.schema,
+        )
+        connection.commit()
+    return SQLiteIndexAdvisor(
+        sqltransactions=SQLTransactions(sqlite_db), table=PART, **kwargs,
+    )
+
+
+def get_entry(index_advisor):
+    with index_advisor.sqltransactions.concurrent() as (_, execute):
+        return execute("""SELECT `hits`,`indexed_at`,`refused_at_maxsize`,
+            `refused_at_timeout` FROM `AUX:index_advisor`""").fetchone()
+
+
+def is_indexed(index_advisor):
+    with index_advisor.sqltransactions.concurrent() as (_, execute):
+        return execute("""SELECT 1 FROM `sqlite_master`
+            WHERE `type` == 'index' AND `name` == ?""", [
+            SQLiteIndexAdvisor.index_of(PART, COLUMN),
+        ]).fetchone() is not None
+
+
+def flush(index_advisor, n):
+    index_advisor.flush(batch=[(PART, PART, COLUMN, INDEX_NAME, n)])
+
+
+def test_hit_counter_drains_batch_after_interval():
+    key = PART, PART, COLUMN, INDEX_NAME
+    counter = SQLiteIndexAdvisorHitCounter(flush_interval=0)
+    assert counter.count("a.db", "AUX", *key) == [(*key, 1)]
+    counter = SQLiteIndexAdvisorHitCounter(flush_interval=3600)
+    for _ in range(3):
+        assert counter.count("a.db", "AUX", *key) is None
+    assert counter._drain("a.db", "AUX") == [(*key, 3)]
+    assert counter._drain("a.db", "AUX") == []
+
+
+def test_builds_index_once_hits_reach_min_hits(tmp_path):
+    index_advisor = make_index_advisor(tmp_path, min_hits=5)
+    flush(index_advisor, 4)
+    assert get_entry(index_advisor)[:2] == (4, None)
+    assert not is_indexed(index_advisor)
+    flush(index_advisor, 1)
+    hits, indexed_at, *_ = get_entry(index_advisor)
+    assert (hits, indexed_at is not None) == (5, True)
+    assert is_indexed(index_advisor)
+
+
+def test_refusal_at_maxsize_is_remembered_until_maxsize_changes(tmp_path):
+    index_advisor = make_index_advisor(tmp_path, min_hits=1, maxdbsize=1)
+    flush(index_advisor, 1)
+    assert get_entry(index_advisor)[1:3] == (None, 1)
+    assert not is_indexed(index_advisor)
+    built = []
+    index_advisor.build = lambda *args, **kwargs: built.append(args)
+    flush(index_advisor, 1)
+    assert built == []
+    index_advisor.maxdbsize = 2
+    flush(index_advisor, 1)
+    assert built == [(PART, COLUMN, INDEX_NAME)]
+
+
+def test_build_exceeding_timeout_is_abandoned_and_remembered(tmp_path):
+    index_advisor = make_index_advisor(
+        tmp_path, n_rows=50000, min_hits=1, build_timeout=0,
+    )
+    flush(index_advisor, 1)
+    assert get_entry(index_advisor)[1:] == (None, None, 0)
+    assert not is_indexed(index_advisor)
+    index_advisor.build_timeout = 60
+    flush(index_advisor, 1)
+    assert is_indexed(index_advisor)
@@ -0,0 +1,29 @@
+from json import loads, dumps
+from conftest import make_context, fetch
+from genefab3.api.renderers.PlaintextStreamedTableRenderers import json
+
+
+CSV = "gene,a,b\nG1,1,\nG2,2.5,3\nG3,4,x\n"
+
+
+def render_json(data):
+    content, mimetype = json(data)
+    assert mimetype == "application/json"
+    return "".join(content())
+
+
+def test_json_streams_index_before_data(make_table):
+    data, rows = fetch(make_table("t", CSV), make_context())
+    data.rows_per_block = 2
+    parsed = loads(render_json(data))
+    assert list(parsed) == ["meta", "columns", "index", "data"]
+    parsed_rows = [[i, *v] for (i,), v in zip(parsed["index"], parsed["data"])]
+    assert dumps(parsed_rows) == dumps(rows) # NaN compares by representation
+
+
+def test_json_of_empty_page(make_table):
+    data, _ = fetch(make_table("t", CSV), make_context(
+        data_comparisons=["`a` > 100"],
+    ))
+    parsed = loads(render_json(data))
+    assert (parsed["index"], parsed["data"]) == ([], [])
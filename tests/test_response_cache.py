@@ -0,0 +1,112 @@
+from pytest import raises
+from types import SimpleNamespace
+from time import sleep
+from random import Random
+from contextlib import contextmanager
+from sqlite3 import OperationalError
+from genefab3.db.sql.response_cache import ResponseCache
+from genefab3.db.sql.response_cache import RESPONSE_CACHE_HOT_TIER
+from genefab3.common.types import ResponseContainer
+from genefab3.common.exceptions import GeneFabDatabaseException
+
+
+def make_response_cache(tmp_path):
+    sqlite_dbs = SimpleNamespace(response_cache={
+        "db": str(tmp_path / "response-cache.db"), "maxsize": None,
+    })
+    return ResponseCache(sqlite_dbs)
+
+
+def make_context(identity, **context_kwargs):
+    return SimpleNamespace(
+        identity=identity, view="data", accept_encodings=[], **context_kwargs,
+    )
+
+
+def put_and_wait(response_cache, identity, accessions, headers=None, chunks=("a,b\n", "1,2\n"), **context_kwargs):
+    """Stream response through ResponseCache.put() and wait until it is stored"""
+    context = make_context(identity, **context_kwargs)
+    obj = SimpleNamespace(accessions=accessions)
+    content = lambda: iter(chunks)
+    container = ResponseContainer(content, "text/plain", obj, headers)
+    response_cache.put(container, context)
+    "".join(container.content())
+    for _ in range(100):
+        if is_stored(response_cache, identity):
+            return
+        sleep(.05)
+    raise TimeoutError(f"{identity} was not stored")
+
+
+def is_stored(response_cache, identity):
+    with response_cache.sqltransactions.concurrent() as (_, execute):
+        return execute("""SELECT 1 FROM `response_cache_headers`
+            WHERE `context_identity` == ?""", [identity]).fetchone() is not None
+
+
+def test_drop_affected_drops_responses_without_stored_query(tmp_path):
+    response_cache = make_response_cache(tmp_path)
+    put_and_wait(
+        response_cache, "with query", {"GLDS-2"},
+        query={"id.accession": "GLDS-2"}, unwind=set(),
+    )
+    put_and_wait(response_cache, "without query", {"GLDS-3"})
+    n_dropped = response_cache.drop_affected(
+        {"GLDS-1"}, lambda query, unwind: False,
+    )
+    assert n_dropped == 1
+    assert is_stored(response_cache, "with query")
+    assert not is_stored(response_cache, "without query")
+
+
+def test_extra_headers_are_served_from_cache(tmp_path):
+    response_cache = make_response_cache(tmp_path)
+    link = '<http://localhost/data/?limit=1&cursor=x>; rel="next"'
+    put_and_wait(response_cache, "paged", {"GLDS-1"}, headers={"Link": link})
+    RESPONSE_CACHE_HOT_TIER.bump(response_cache.sqlite_db)
+    for tier in "frames", "hot tier":
+        response = response_cache.get(make_context("paged")).make_response()
+        assert response.headers["Link"] == link, tier
+        assert response.get_data(as_text=True) == "a,b\n1,2\n", tier
+
+
+def make_frames_unreadable(monkeypatch, response_cache, from_frame):
+    """Make reading frames from `from_frame` on fail with OperationalError, like reading from a damaged database would"""
+    concurrent = response_cache.sqltransactions.concurrent
+    def _failing(rows):
+        for i, chunk in rows:
+            if i >= from_frame:
+                raise OperationalError("disk I/O error")
+            yield i, chunk
+    @contextmanager
+    def _concurrent(desc=None):
+        with concurrent(desc) as (connection, execute):
+            yield connection, lambda query, *args: (
+                _failing(execute(query, *args)) if "`chunk`" in query
+                else execute(query, *args)
+            )
+    sqltransactions = response_cache.sqltransactions
+    monkeypatch.setattr(sqltransactions, "concurrent", _concurrent)
+
+
+def test_unreadable_first_frame_drops_response_and_falls_through(tmp_path, monkeypatch):
+    response_cache = make_response_cache(tmp_path)
+    put_and_wait(response_cache, "unreadable", {"GLDS-1"})
+    RESPONSE_CACHE_HOT_TIER.bump(response_cache.sqlite_db)
+    make_frames_unreadable(monkeypatch, response_cache, from_frame=0)
+    assert response_cache.get(make_context("unreadable")).empty
+    assert not is_stored(response_cache, "unreadable")
+
+
+def test_unreadable_frame_mid_stream_drops_response(tmp_path, monkeypatch):
+    response_cache = make_response_cache(tmp_path)
+    rng = Random(0)
+    chunks = ["".join(rng.choice("ACGT") for _ in range(65536))] * 8
+    put_and_wait(response_cache, "long", {"GLDS-1"}, chunks=chunks)
+    RESPONSE_CACHE_HOT_TIER.bump(response_cache.sqlite_db)
+    make_frames_unreadable(monkeypatch, response_cache, from_frame=1)
+    container = response_cache.get(make_context("long"))
+    assert not container.empty
+    with raises(GeneFabDatabaseException):
+        "".join(container.content())
+    assert not is_stored(response_cache, "long")
@@ -0,0 +1,64 @@
+from pytest import raises, mark
+from conftest import make_context, fetch
+from genefab3.common.exceptions import GeneFabParserException
+from genefab3.common.exceptions import GeneFabFileException
+
+
+CSV = """gene,score,other
+G1,5,1
+G2,,2
+G3,1,3
+G4,5,4
+G5,3,
+G6,,6
+G7,5,7
+G8,2,8
+"""
+
+ASCENDING = ["G3", "G8", "G5", "G1", "G4", "G7", "G2", "G6"]
+DESCENDING = ["G7", "G4", "G1", "G5", "G8", "G3", "G6", "G2"]
+
+
+@mark.parametrize("order, expected", [
+    (None, ASCENDING), ("asc", ASCENDING), ("desc", DESCENDING),
+])
+def test_sort_puts_missing_values_last_and_breaks_ties_by_index(make_table, order, expected):
+    context = make_context(sort="score", order=order)
+    _, rows = fetch(make_table("a", CSV), context)
+    assert [row[0] for row in rows] == expected
+
+
+@mark.parametrize("order, expected", [
+    ("asc", ASCENDING), ("desc", DESCENDING),
+])
+@mark.parametrize("limit", ["1", "2", "3", "5"])
+def test_sorted_pages_add_up_to_sorted_table(make_table, order, expected, limit):
+    cursor, genes = None, []
+    while True:
+        data, rows = fetch(make_table("a", CSV), make_context(
+            sort="score", order=order, limit=limit, cursor=cursor,
+        ))
+        genes.extend(row[0] for row in rows)
+        cursor = data.next_cursor
+        if cursor is None:
+            break
+    assert genes == expected
+
+
+def test_top_k_is_cacheable_and_links_to_next_page(make_table):
+    data, rows = fetch(make_table("a", CSV), make_context(
+        sort="score", order="desc", limit="3",
+    ))
+    assert [row[0] for row in rows] == DESCENDING[:3]
+    assert data.cacheable is True
+    assert data.next_cursor is not None
+
+
+@mark.parametrize("kwargs, exception", [
+    (dict(order="asc"), GeneFabParserException),
+    (dict(sort="score", order="up"), GeneFabParserException),
+    (dict(sort="missing"), GeneFabFileException),
+])
+def test_invalid_sort_arguments_are_rejected(make_table, kwargs, exception):
+    with raises(exception):
+        make_table("a", CSV).get(context=make_context(**kwargs))
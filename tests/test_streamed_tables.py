@@ -0,0 +1,84 @@
+from pytest import raises, mark
+from conftest import make_context, fetch
+from genefab3.db.sql.streamed_tables import StreamedDataTableWizard
+from genefab3.common.exceptions import GeneFabParserException
+
+
+def make_csv(genes, n_columns=3, seed=0):
+    lines = ["gene," + ",".join(f"S{j}" for j in range(n_columns))]
+    for i, gene in enumerate(genes):
+        values = (
+            (i * 31 + j * 17 + seed) % 97 for j in range(n_columns)
+        )
+        lines.append(f"{gene}," + ",".join(
+            "" if (v % 11 == 0) else str(v) for v in values
+        ))
+    return "\n".join(lines) + "\n"
+
+
+def iterate_pages(make, limit, **kwargs):
+    cursor, pages = None, []
+    while True:
+        context = make_context(limit=limit, cursor=cursor, **kwargs)
+        data, rows = fetch(make(), context)
+        assert data.shape[0] == len(rows) <= int(limit)
+        pages.append(rows)
+        cursor = data.next_cursor
+        if cursor is None:
+            return pages
+
+
+@mark.parametrize("limit", ["3", "7", "50", "200"])
+def test_pages_add_up_to_full_table(make_table, limit):
+    genes = [f"G{i:03d}" for i in range(50)]
+    make = lambda: make_table("a", make_csv(genes))
+    pages = iterate_pages(make, limit)
+    _, full = fetch(make(), make_context())
+    assert sum(pages, []) == sorted(full, key=lambda row: row[0])
+    assert len(pages) == -(-50 // int(limit))
+
+
+@mark.parametrize("limit", ["2", "9", "40"])
+def test_pages_of_outer_joined_tables_add_up_to_full_join(make_table, limit):
+    genes_a = [f"G{i:03d}" for i in range(0, 60, 2)]
+    genes_b = [f"G{i:03d}" for i in range(0, 60, 3)]
+    make = lambda: StreamedDataTableWizard.concat([
+        make_table("a", make_csv(genes_a)),
+        make_table("b", make_csv(genes_b, seed=1), accession="GLDS-2"),
+    ])
+    pages = iterate_pages(make, limit)
+    _, full = fetch(make(), make_context())
+    assert sum(pages, []) == sorted(full, key=lambda row: row[0])
+
+
+def test_pages_skip_rows_tied_with_cursor_key(make_table):
+    genes = ["G1", "G2", "G2", "G2", "G3", "G4"]
+    make = lambda: make_table("dup", make_csv(genes))
+    pages = iterate_pages(make, "2")
+    assert [row[0] for row in sum(pages, [])] == sorted(genes)
+
+
+def test_pages_follow_comparisons(make_table):
+    genes = [f"G{i:03d}" for i in range(80)]
+    make = lambda: make_table("a", make_csv(genes))
+    comparisons = ["`S1` > 40"]
+    pages = iterate_pages(make, "6", data_comparisons=comparisons)
+    _, full = fetch(make(), make_context(data_comparisons=comparisons))
+    assert sum(pages, []) == sorted(full, key=lambda row: row[0])
+
+
+def test_paged_data_is_cacheable(make_table):
+    table = make_table("a", make_csv([f"G{i:03d}" for i in range(5)]))
+    data = table.get(context=make_context(limit="2"))
+    assert data.cacheable is True
+    assert data.next_cursor is not None
+
+
+@mark.parametrize("kwargs", [
+    dict(limit="0"), dict(limit="x"), dict(cursor="abc"),
+    dict(limit="5", cursor="!!"),
+])
+def test_invalid_paging_arguments_are_rejected(make_table, kwargs):
+    table = make_table("a", make_csv(["G1", "G2"]))
+    with raises(GeneFabParserException):
+        table.get(context=make_context(**kwargs))
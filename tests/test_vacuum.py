@@ -0,0 +1,98 @@
+from types import SimpleNamespace
+from threading import Thread, Event
+from time import monotonic
+from genefab3.db.sql.utils import SQLTransactions, get_page_stats
+from genefab3.db.sql.vacuum import IncrementalVacuumScheduler
+
+
+def make_fragmented_db(tmp_path, n_rows=500):
+    sqlite_db = str(tmp_path / f"{tmp_path.name}.db")
+    with SQLTransactions(sqlite_db).unconditional() as (_, execute):
+        execute("CREATE TABLE `x` (`blob` BLOB)")
+        execute("""WITH RECURSIVE `n`(`i`) AS (SELECT 1 UNION ALL
+            SELECT `i`+1 FROM `n` WHERE `i` < ?)
+            INSERT INTO `x` SELECT randomblob(2000) FROM `n`""", [n_rows])
+    with SQLTransactions(sqlite_db).unconditional() as (_, execute):
+        execute("DELETE FROM `x`")
+    return sqlite_db
+
+
+def make_scheduler(sqlite_db, **kwargs):
+    return IncrementalVacuumScheduler(
+        SimpleNamespace(tables={"db": sqlite_db}, nothing={"db": None}),
+        **kwargs,
+    )
+
+
+def n_free_pages(sqlite_db):
+    return get_page_stats(sqlite_db)["freelist_count"]
+
+
+def test_step_frees_at_most_step_pages(tmp_path):
+    sqlite_db = make_fragmented_db(tmp_path)
+    assert get_page_stats(sqlite_db)["auto_vacuum"] == 2
+    n_free = n_free_pages(sqlite_db)
+    assert n_free > 200
+    scheduler = make_scheduler(sqlite_db, step_pages=100, min_free_pages=10)
+    assert scheduler.sqlite_dbs == [sqlite_db]
+    assert scheduler.step(sqlite_db) == 100
+    assert n_free_pages(sqlite_db) == n_free - 100
+
+
+def test_step_skips_database_with_few_free_pages(tmp_path):
+    sqlite_db = make_fragmented_db(tmp_path, n_rows=5)
+    n_free = n_free_pages(sqlite_db)
+    scheduler = make_scheduler(sqlite_db, min_free_pages=n_free+1)
+    assert scheduler.step(sqlite_db) is None
+    assert n_free_pages(sqlite_db) == n_free
+
+
+def test_step_yields_to_transactions_under_other_identifiers(tmp_path):
+    sqlite_db = make_fragmented_db(tmp_path)
+    n_free = n_free_pages(sqlite_db)
+    scheduler = make_scheduler(sqlite_db, min_free_pages=10)
+    with SQLTransactions(sqlite_db, "reader").concurrent() as (_, execute):
+        execute("SELECT COUNT(*) FROM `x`").fetchone()
+        assert scheduler.step(sqlite_db) == 0
+    with SQLTransactions(sqlite_db, "writer").exclusive() as (_, execute):
+        assert scheduler.step(sqlite_db) == 0
+    assert n_free_pages(sqlite_db) == n_free
+    assert scheduler.step(sqlite_db) == n_free
+
+
+def test_transactions_wait_for_step_to_finish(tmp_path):
+    sqlite_db = make_fragmented_db(tmp_path)
+    sqltransactions = SQLTransactions(sqlite_db)
+    with SQLTransactions(sqlite_db, "writer").exclusive():
+        pass # creates lock file of identifier
+    in_step, observed = Event(), []
+    def _write():
+        in_step.wait()
+        with SQLTransactions(sqlite_db, "writer").exclusive() as (_, execute):
+            observed.append(execute("PRAGMA freelist_count").fetchone()[0])
+    writer = Thread(target=_write)
+    writer.start()
+    with sqltransactions.exclusive_if_idle() as (_, execute):
+        assert execute is not None
+        in_step.set()
+        writer.join(timeout=.5)
+        assert writer.is_alive() and (observed == [])
+        while execute("PRAGMA freelist_count").fetchone()[0]:
+            execute("PRAGMA incremental_vacuum(1)")
+    writer.join()
+    assert observed == [0]
+
+
+def test_run_until_reclaims_all_free_pages(tmp_path):
+    sqlite_db = make_fragmented_db(tmp_path)
+    scheduler = make_scheduler(
+        sqlite_db, step_pages=64, min_free_pages=1, step_interval=0,
+    )
+    steps, _step = [], scheduler.step
+    scheduler.step = lambda db: steps.append(_step(db)) or steps[-1]
+    scheduler.run_until(deadline=0) # already passed, nothing happens
+    assert steps == []
+    scheduler.run_until(deadline=monotonic()+1)
+    assert n_free_pages(sqlite_db) == 0
+    assert len(steps) > 2 and max(steps[:-1]) == 64
+    assert steps[-1] is None